@@ -0,0 +1,219 @@
+# activity_store.py — локальное SQLite-зеркало crm.activity.list с инкрементальной синхронизацией
+from __future__ import annotations
+
+import json
+import os
+import threading
+import time
+import typing as t
+from datetime import datetime, timezone
+
+from bitrix import iter_activities
+from storage import ensure_schema, get_state, set_state, transaction
+
+# Не чаще одного похода в Bitrix за дельтой в N секунд (параллельные читатели одного скана)
+SYNC_MIN_INTERVAL = float(os.getenv("ACTIVITY_SYNC_MIN_INTERVAL", "30"))
+# Перекрытие дельты: строки, изменённые пока мы листали прошлую выгрузку, не теряются
+SYNC_OVERLAP_SEC = int(os.getenv("ACTIVITY_SYNC_OVERLAP_SEC", "120"))
+# Удаление в Bitrix не меняет LAST_UPDATED — дельта его не видит. Раз в N секунд сверяем ID окна
+# с порталом (одна выгрузка только ID) и убираем пропавшие строки; 0 — не сверяем
+RECONCILE_INTERVAL = float(os.getenv("ACTIVITY_RECONCILE_SEC", "21600"))
+
+# Поля, которые нужны всем проверкам (входящие, ответы, звонки, диалоги ОЛ)
+SELECT = [
+    "ID", "CREATED", "LAST_UPDATED", "PROVIDER_ID", "PROVIDER_TYPE_ID", "DIRECTION",
+    "COMPLETED", "SUBJECT", "OWNER_TYPE_ID", "OWNER_ID", "COMMUNICATIONS", "AUTHOR_ID",
+    "DESCRIPTION", "SETTINGS", "PROVIDER_PARAMS",
+]
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS activities (
+    id               INTEGER PRIMARY KEY,
+    owner_type_id    TEXT NOT NULL,
+    owner_id         TEXT NOT NULL,
+    direction        TEXT NOT NULL,
+    provider_id      TEXT NOT NULL,
+    provider_type_id TEXT NOT NULL,
+    created_ts       REAL NOT NULL,
+    updated_ts       REAL NOT NULL,
+    data             TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS activities_owner_created ON activities(owner_type_id, owner_id, created_ts);
+CREATE INDEX IF NOT EXISTS activities_direction_created ON activities(direction, created_ts);
+"""
+
+_HWM_KEY = "activities.last_updated"
+_MAX_ID_KEY = "activities.max_id"
+_COVERED_KEY = "activities.covered_since"
+_RECONCILED_KEY = "activities.reconciled_ts"
+
+_sync_lock = threading.Lock()
+_last_sync = 0.0
+
+
+def _ts(value: t.Any) -> float:
+    s = str(value or "")
+    if not s:
+        return 0.0
+    if s.endswith("Z"):
+        s = s[:-1] + "+00:00"
+    return datetime.fromisoformat(s).timestamp()
+
+
+def _iso(ts: float) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _upsert(rows: t.List[dict]) -> None:
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT INTO activities(id, owner_type_id, owner_id, direction, provider_id, "
+            "provider_type_id, created_ts, updated_ts, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET owner_type_id = excluded.owner_type_id, "
+            "owner_id = excluded.owner_id, direction = excluded.direction, "
+            "provider_id = excluded.provider_id, provider_type_id = excluded.provider_type_id, "
+            "created_ts = excluded.created_ts, updated_ts = excluded.updated_ts, data = excluded.data",
+            [
+                (
+                    int(r["ID"]),
+                    str(r.get("OWNER_TYPE_ID") or ""),
+                    str(r.get("OWNER_ID") or ""),
+                    str(r.get("DIRECTION") or ""),
+                    str(r.get("PROVIDER_ID") or "").upper(),
+                    str(r.get("PROVIDER_TYPE_ID") or "").upper(),
+                    _ts(r.get("CREATED")),
+                    _ts(r.get("LAST_UPDATED") or r.get("CREATED")),
+                    json.dumps(r, ensure_ascii=False),
+                )
+                for r in rows
+            ],
+        )
+
+
+def _fetch(flt: dict, select: t.List[str] = SELECT) -> t.List[dict]:
+    # порядок не важен (hwm — максимум по выгрузке), поэтому keyset по ID без подсчёта total
+    return list(iter_activities(flt, select))
+
+
+def _reconcile(since: datetime, types: t.List[int]) -> int:
+    """Удаляет строки окна, которых больше нет в Bitrix; возвращает их число."""
+    alive = {
+        int(r["ID"])
+        for r in _fetch({">=CREATED": since.astimezone(timezone.utc).isoformat(), "OWNER_TYPE_ID": types}, ["ID"])
+    }
+    with transaction() as conn:
+        local = conn.execute("SELECT id FROM activities WHERE created_ts >= ?", (since.timestamp(),)).fetchall()
+        gone = [(r["id"],) for r in local if r["id"] not in alive]
+        conn.executemany("DELETE FROM activities WHERE id = ?", gone)
+    return len(gone)
+
+
+def forget(ids: t.Iterable[t.Any]) -> int:
+    """Удаляет активности из зеркала (событие ONCRMACTIVITYDELETE); возвращает число удалённых строк."""
+    ensure_schema("activities", _DDL)
+    with transaction() as conn:
+        return conn.executemany("DELETE FROM activities WHERE id = ?", [(int(i),) for i in ids]).rowcount
+
+
+def sync(since: datetime, owner_type_ids: t.Iterable[str], *, force: bool = False) -> int:
+    """
+    Подтягивает в зеркало строки, созданные или изменённые после прошлой синхронизации
+    (high-water mark по LAST_UPDATED), и удаляет строки старше окна.
+    Первый запуск или расширение окна — полная выгрузка недостающего диапазона по CREATED.
+    Раз в RECONCILE_INTERVAL — сверка ID окна: удалённые в Bitrix строки уходят из зеркала.
+    Возвращает число полученных строк.
+    """
+    global _last_sync
+    ensure_schema("activities", _DDL)
+    types = sorted(int(x) for x in owner_type_ids)
+
+    with _sync_lock:
+        if not force and time.time() - _last_sync < SYNC_MIN_INTERVAL:
+            return 0
+
+        fetched: t.List[dict] = []
+        since_ts = since.timestamp()
+        covered = float(get_state(_COVERED_KEY) or 0) or None
+        hwm = get_state(_HWM_KEY)
+
+        if covered is None or since_ts < covered:
+            flt: dict = {">=CREATED": since.astimezone(timezone.utc).isoformat(), "OWNER_TYPE_ID": types}
+            if covered is not None:
+                flt["<CREATED"] = _iso(covered)
+            fetched += _fetch(flt)
+
+        if hwm is not None:
+            fetched += _fetch({
+                ">=LAST_UPDATED": _iso(float(hwm) - SYNC_OVERLAP_SEC),
+                "OWNER_TYPE_ID": types,
+            })
+
+        if fetched:
+            _upsert(fetched)
+        if hwm is None:
+            # полная выгрузка окна — удалённых строк в зеркале нет
+            set_state(_RECONCILED_KEY, str(time.time()))
+        elif RECONCILE_INTERVAL > 0 and time.time() - float(get_state(_RECONCILED_KEY) or 0) >= RECONCILE_INTERVAL:
+            deleted = _reconcile(since, types)
+            if deleted:
+                print(f"[ACTIVITIES] reconcile: {deleted} rows deleted in Bitrix")
+            set_state(_RECONCILED_KEY, str(time.time()))
+        new_hwm = max([_ts(r.get("LAST_UPDATED") or r.get("CREATED")) for r in fetched] + [float(hwm or 0)])
+        max_id = max([int(r["ID"]) for r in fetched] + [int(get_state(_MAX_ID_KEY) or 0)])
+
+        with transaction() as conn:
+            conn.execute("DELETE FROM activities WHERE created_ts < ?", (since_ts,))
+        set_state(_HWM_KEY, str(new_hwm or time.time()))
+        set_state(_MAX_ID_KEY, str(max_id))
+        # строки старше окна удалены — зеркало полно ровно с since
+        set_state(_COVERED_KEY, str(since_ts))
+        _last_sync = time.time()
+        return len(fetched)
+
+
+def query(
+    *,
+    since: datetime,
+    direction: int | None = None,
+    provider_ids: t.Iterable[str] | None = None,
+    owner_type_ids: t.Iterable[str] | None = None,
+    newest_first: bool = True,
+    limit: int | None = None,
+) -> t.List[dict]:
+    """Строки зеркала в формате crm.activity.list, отсортированные по CREATED."""
+    ensure_schema("activities", _DDL)
+    sql = ["SELECT data FROM activities WHERE created_ts >= ?"]
+    args: t.List[t.Any] = [since.timestamp()]
+    if direction is not None:
+        sql.append("AND direction = ?")
+        args.append(str(direction))
+    for col, values in (("provider_id", provider_ids), ("owner_type_id", owner_type_ids)):
+        if values is not None:
+            values = [str(v).upper() for v in values]
+            sql.append(f"AND {col} IN ({','.join('?' * len(values)) or 'NULL'})")
+            args += values
+    sql.append("ORDER BY created_ts DESC, id DESC" if newest_first else "ORDER BY created_ts ASC, id ASC")
+    if limit is not None:
+        sql.append("LIMIT ?")
+        args.append(int(limit))
+    with transaction() as conn:
+        rows = conn.execute(" ".join(sql), args).fetchall()
+    return [json.loads(r["data"]) for r in rows]
+
+
+def stats() -> dict:
+    ensure_schema("activities", _DDL)
+    with transaction() as conn:
+        n = conn.execute("SELECT COUNT(*) AS n FROM activities").fetchone()["n"]
+    hwm = get_state(_HWM_KEY)
+    reconciled = get_state(_RECONCILED_KEY)
+    return {
+        "rows": n,
+        "last_updated_hwm": _iso(float(hwm)) if hwm else None,
+        "max_id": int(get_state(_MAX_ID_KEY) or 0),
+        "reconciled_at": _iso(float(reconciled)) if reconciled else None,
+        "last_sync_age_sec": round(time.time() - _last_sync, 1) if _last_sync else None,
+    }
+
+
+__all__ = ["sync", "query", "forget", "stats"]
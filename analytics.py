@@ -0,0 +1,270 @@
+# analytics.py — время первого ответа клиенту за длинный период (30–90 дней) одним проходом
+from __future__ import annotations
+
+import os
+import threading
+import time
+import typing as t
+from datetime import datetime, timedelta, timezone
+
+from bitrix import call_entity_type_id, iter_activities, list_call_log, parallel_map, time_slices
+
+# Период режется на куски по ANALYTICS_SLICE_DAYS, куски выгружаются параллельно
+# (bitrix.time_slices / parallel_map; все запросы всё равно идут через общий лимитер)
+ANALYTICS_SLICE_DAYS = float(os.getenv("ANALYTICS_SLICE_DAYS", "7"))
+ANALYTICS_CONCURRENCY = int(os.getenv("ANALYTICS_CONCURRENCY", "4"))
+ANALYTICS_MAX_DAYS = int(os.getenv("ANALYTICS_MAX_DAYS", "180"))
+# Готовый отчёт отдаётся из памяти N секунд: выгрузка 90 дней — это минуты
+ANALYTICS_TTL = float(os.getenv("ANALYTICS_TTL", "3600"))
+
+_CALL_PROVIDERS = ["VOXIMPLANT_CALL", "CALL"]
+_PERCENTILES = (50, 90, 95, 99)
+
+_lock = threading.Lock()
+_cache: t.Dict[tuple[int, int], tuple[float, dict]] = {}
+
+
+def _slices(since: datetime, until: datetime) -> t.List[tuple[datetime, datetime]]:
+    return time_slices(since, until, timedelta(days=max(ANALYTICS_SLICE_DAYS, 0.01)))
+
+
+def _fetch_slice(kind: str, start: datetime, end: datetime) -> t.List[tuple]:
+    """
+    Одна выгрузка куска периода -> компактные кортежи (полные строки в памяти не держим):
+      in:    (ts, etype, eid, provider, ptype, ответственный, телефоны)
+      out:   (ts, etype, eid, AUTHOR_ID, ID)
+      call:  (ts, etype, eid, AUTHOR_ID, ID)             — активности-звонки
+      log:   (ts, etype, eid, PORTAL_USER_ID, CALL_ID, телефон) — журнал телефонии
+    """
+    from logic import (
+        TRACK_ENTITY_TYPES, _call_succeeded, _iso, call_activity_succeeded, communications_phones,
+        is_message_activity, normalize_phone, parse_b24_iso,
+    )
+
+    types = sorted(int(x) for x in TRACK_ENTITY_TYPES)
+    flt = {">=CREATED": _iso(start), "<CREATED": _iso(end), "OWNER_TYPE_ID": types}
+    rows: t.List[tuple] = []
+
+    if kind == "log":
+        calls, _ = list_call_log(_iso(start), max_rows=None, until_iso=_iso(end))
+        for c in calls:
+            if not _call_succeeded(c):
+                continue
+            rows.append((
+                parse_b24_iso(c.get("CALL_START_DATE")).timestamp(),
+                call_entity_type_id(c),
+                str(c.get("CRM_ENTITY_ID", c.get("ENTITY_ID", "")) or ""),
+                str(c.get("PORTAL_USER_ID") or ""),
+                str(c.get("CALL_ID") or c.get("ID") or ""),
+                normalize_phone(c.get("PHONE_NUMBER")),
+            ))
+        return rows
+
+    if kind == "in":
+        select = ["ID", "CREATED", "PROVIDER_ID", "PROVIDER_TYPE_ID", "OWNER_TYPE_ID", "OWNER_ID",
+                  "AUTHOR_ID", "RESPONSIBLE_ID", "COMMUNICATIONS"]
+        for r in iter_activities({**flt, "DIRECTION": 2}, select):
+            if not is_message_activity(r):
+                continue
+            rows.append((
+                parse_b24_iso(r.get("CREATED")).timestamp(),
+                str(r.get("OWNER_TYPE_ID")), str(r.get("OWNER_ID")),
+                str(r.get("PROVIDER_ID") or "").upper(), str(r.get("PROVIDER_TYPE_ID") or "").upper(),
+                str(r.get("RESPONSIBLE_ID") or r.get("AUTHOR_ID") or ""),
+                tuple(communications_phones(r.get("COMMUNICATIONS"))),
+            ))
+        return rows
+
+    select = ["ID", "CREATED", "PROVIDER_ID", "PROVIDER_TYPE_ID", "OWNER_TYPE_ID", "OWNER_ID",
+              "AUTHOR_ID", "DIRECTION", "COMPLETED"]
+    if kind == "out":
+        source, ok = iter_activities({**flt, "DIRECTION": 1}, select), is_message_activity
+    else:
+        source, ok = iter_activities({**flt, "PROVIDER_ID": _CALL_PROVIDERS}, select), call_activity_succeeded
+    for r in source:
+        if ok(r):
+            rows.append((
+                parse_b24_iso(r.get("CREATED")).timestamp(),
+                str(r.get("OWNER_TYPE_ID")), str(r.get("OWNER_ID")),
+                str(r.get("AUTHOR_ID") or ""), str(r.get("ID") or ""),
+            ))
+    return rows
+
+
+def fetch(since: datetime, until: datetime) -> t.Dict[str, t.List[tuple]]:
+    """Все четыре источника за период, куски — параллельно в ANALYTICS_CONCURRENCY потоков."""
+    jobs = [(kind, a, b) for a, b in _slices(since, until) for kind in ("in", "out", "call", "log")]
+    out: t.Dict[str, t.List[tuple]] = {"in": [], "out": [], "call": [], "log": []}
+    for (kind, _, _), rows in zip(jobs, parallel_map(_fetch_slice, jobs, ANALYTICS_CONCURRENCY, "analytics")):
+        out[kind].extend(rows)
+    return out
+
+
+def _percentile(sorted_values: t.List[float], p: float) -> float | None:
+    """Перцентиль методом ближайшего ранга."""
+    if not sorted_values:
+        return None
+    k = max(int(-(-p * len(sorted_values) // 100)) - 1, 0)
+    return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+class _Group:
+    __slots__ = ("latencies", "unanswered", "pending", "breached")
+
+    def __init__(self):
+        self.latencies: t.List[float] = []
+        self.unanswered = 0   # ответа нет, SLA истёк
+        self.pending = 0      # ответа нет, SLA ещё не истёк
+        self.breached = 0
+
+    def summary(self) -> dict:
+        lat = sorted(self.latencies)
+        decided = len(lat) + self.unanswered
+        out = {
+            "episodes": decided + self.pending,
+            "answered": len(lat),
+            "unanswered": self.unanswered,
+            "pending": self.pending,
+            "breached": self.breached,
+            "breach_rate": round(self.breached / decided, 4) if decided else None,
+            "mean_min": round(sum(lat) / len(lat) / 60, 2) if lat else None,
+        }
+        for p in _PERCENTILES:
+            v = _percentile(lat, p)
+            out[f"p{p}_min"] = round(v / 60, 2) if v is not None else None
+        return out
+
+
+def build_report(data: t.Mapping[str, t.List[tuple]], until: datetime, sla_min: int) -> dict:
+    """
+    Эпизод — первое входящее после последнего ответа (или с начала периода); закрывает его
+    первый ответ в тот же момент или позже: исходящее сообщение, состоявшийся звонок
+    (активность, звонок из журнала с привязкой к сущности или на её телефон).
+    Ответ, которого нет в CRM (только сообщение оператора в чате ОЛ), здесь не виден.
+    Менеджер эпизода — автор ответа, у неотвеченных — ответственный за входящее.
+    """
+    sla_sec = sla_min * 60
+    until_ts = until.timestamp()
+
+    # Ответы по сущностям: отсортированные (ts, автор, ID)
+    responses: t.Dict[tuple[str, str], t.List[tuple[float, str, str]]] = {}
+    for ts, etype, eid, author, rid in (*data.get("out", ()), *data.get("call", ())):
+        responses.setdefault((etype, eid), []).append((ts, author, rid))
+
+    inbound: t.Dict[tuple[str, str], t.List[tuple]] = {}
+    entities_by_phone: t.Dict[str, t.Set[tuple[str, str]]] = {}
+    for row in data.get("in", ()):
+        key = (row[1], row[2])
+        inbound.setdefault(key, []).append(row)
+        for phone in row[6]:
+            entities_by_phone.setdefault(phone, set()).add(key)
+
+    for ts, etype, eid, author, call_id, phone in data.get("log", ()):
+        if etype and eid:
+            targets = {(etype, eid)}
+        else:
+            targets = entities_by_phone.get(phone, set()) if phone else set()
+        for key in targets:
+            responses.setdefault(key, []).append((ts, author, call_id))
+
+    groups: t.Dict[str, t.Dict[str, _Group]] = {
+        "overall": {}, "by_author": {}, "by_provider": {}, "by_provider_type": {}, "by_entity_type": {},
+    }
+
+    def account(row: tuple, latency: float | None, author: str) -> None:
+        keys = {
+            "overall": "all",
+            "by_author": author or "-",
+            "by_provider": row[3] or "-",
+            "by_provider_type": row[4] or "-",
+            "by_entity_type": row[1],
+        }
+        for dim, key in keys.items():
+            g = groups[dim].get(key)
+            if g is None:
+                g = groups[dim][key] = _Group()
+            if latency is not None:
+                g.latencies.append(latency)
+                if latency > sla_sec:
+                    g.breached += 1
+            elif until_ts - row[0] > sla_sec:
+                g.unanswered += 1
+                g.breached += 1
+            else:
+                g.pending += 1
+
+    episodes = 0
+    for key, rows in inbound.items():
+        rows.sort()
+        resp = sorted(responses.get(key, ()))
+        i = 0
+        start: tuple | None = None
+        for row in rows:
+            # ответы до этого входящего закрывают открытый эпизод
+            while i < len(resp) and resp[i][0] < row[0]:
+                if start is not None:
+                    account(start, resp[i][0] - start[0], resp[i][1])
+                    start = None
+                i += 1
+            if start is None:
+                start = row
+                episodes += 1
+        if start is not None:
+            if i < len(resp):
+                account(start, resp[i][0] - start[0], resp[i][1])
+            else:
+                account(start, None, start[5])
+
+    def table(dim: str) -> t.List[dict]:
+        rows = [{"key": k, **g.summary()} for k, g in groups[dim].items()]
+        return sorted(rows, key=lambda r: -r["episodes"])
+
+    return {
+        "sla_min": sla_min,
+        "episodes": episodes,
+        "overall": (groups["overall"].get("all") or _Group()).summary(),
+        "by_author": table("by_author"),
+        "by_provider": table("by_provider"),
+        "by_provider_type": table("by_provider_type"),
+        "by_entity_type": table("by_entity_type"),
+    }
+
+
+def report(days: int = 30, sla_min: int | None = None, force: bool = False) -> dict:
+    """
+    Отчёт о времени первого ответа за days дней: перцентили, доля нарушений SLA по менеджерам,
+    каналам и типам сущностей. Один отчёт за раз; готовый — из памяти ANALYTICS_TTL секунд.
+    """
+    from logic import RESPONSE_SLA_MIN
+
+    days = max(1, min(int(days), ANALYTICS_MAX_DAYS))
+    sla_min = RESPONSE_SLA_MIN if sla_min is None else int(sla_min)
+    key = (days, sla_min)
+    with _lock:
+        cached = _cache.get(key)
+        if cached and not force and time.time() - cached[0] < ANALYTICS_TTL:
+            return cached[1]
+
+        started = time.perf_counter()
+        until = datetime.now(timezone.utc)
+        since = until - timedelta(days=days)
+        data = fetch(since, until)
+        result = {
+            "since": since.isoformat(),
+            "until": until.isoformat(),
+            "days": days,
+            "fetched": {
+                "incoming": len(data["in"]),
+                "outgoing": len(data["out"]),
+                "call_activities": len(data["call"]),
+                "calls": len(data["log"]),
+                "slices": len(_slices(since, until)),
+                "seconds": round(time.perf_counter() - started, 2),
+            },
+            **build_report(data, until, sla_min),
+        }
+        _cache[key] = (time.time(), result)
+        return result
+
+
+__all__ = ["report", "build_report", "fetch", "ANALYTICS_SLICE_DAYS", "ANALYTICS_CONCURRENCY", "ANALYTICS_TTL"]
@@ -0,0 +1,495 @@
+# bench/fake_portal.py — локальный «портал Битрикс24» для бенчмарка: REST по HTTP на сгенерированных данных
+from __future__ import annotations
+
+import json
+import random
+import re
+import threading
+import time
+import typing as t
+from dataclasses import dataclass
+from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+MSK = timezone(timedelta(hours=3))  # порталы отдают даты с часовым поясом портала
+PAGE = 50                           # размер страницы *.list и *.statistic.get
+ENTITY_NAMES = {"1": "LEAD", "2": "DEAL", "3": "CONTACT", "4": "COMPANY"}
+EMPLOYEES = 20                      # сотрудники портала: ID 1..20
+CLIENT_USER_BASE = 100000           # пользователи коннекторов (клиенты в ОЛ)
+
+
+@dataclass
+class PortalConfig:
+    entities: int = 500               # сущностей CRM всего (поровну по типам)
+    types: str = "1,2,3,4"
+    days: int = 14                    # за сколько дней генерировать переписку
+    messages: int = 3                 # входящих на сущность (в среднем)
+    noise: int = 2                    # «чужих» активностей (задачи, встречи) на сущность
+    latency_ms: float = 0.0           # задержка ответа
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0           # доля запросов с ошибкой
+    no_voximplant: bool = False       # портал без voximplant.statistic.get
+    seed: int = 1
+
+
+# ---------------------------
+#  Данные портала
+# ---------------------------
+class Portal:
+    """
+    Сгенерированные активности, журнал звонков и диалоги ОЛ.
+    Исходы по сущностям: ответили сообщением, позвонили (с привязкой к сущности или
+    только по номеру), последним в диалоге ОЛ написал оператор, либо ответа нет.
+    """
+
+    def __init__(self, cfg: PortalConfig):
+        self.cfg = cfg
+        self.rng = random.Random(cfg.seed)
+        self.now = datetime.now(MSK).replace(microsecond=0)
+        self.activities: t.List[dict] = []
+        self.calls: t.List[dict] = []
+        self.dialogs: t.Dict[str, t.List[dict]] = {}
+        self.entities: t.Dict[tuple[str, str], dict] = {}   # карточки для crm.item.list
+        self.users = [
+            {"ID": str(i), "NAME": f"Менеджер {i}", "LAST_NAME": "", "USER_TYPE": "employee", "ACTIVE": True}
+            for i in range(1, EMPLOYEES + 1)
+        ]
+        self.expected_unanswered = 0
+        self._next_id = 1
+        self._msg_id = 1
+        self._generate()
+        self.by_id = {a["ID"]: a for a in self.activities}
+
+    # --- генерация ---
+    def _activity(self, etype: str, eid: int, created: datetime, **fields: t.Any) -> dict:
+        row = {
+            "ID": str(self._next_id),
+            "CREATED": created.isoformat(),
+            "LAST_UPDATED": created.isoformat(),
+            "OWNER_TYPE_ID": etype,
+            "OWNER_ID": str(eid),
+            "DIRECTION": "2",
+            "COMPLETED": "N",
+            "SUBJECT": "",
+            "DESCRIPTION": "",
+            "AUTHOR_ID": str(self.rng.randint(1, EMPLOYEES)),
+            "COMMUNICATIONS": [],
+            "SETTINGS": {},
+            "PROVIDER_PARAMS": {},
+        }
+        row.update(fields)
+        self._next_id += 1
+        self.activities.append(row)
+        return row
+
+    def _dialog_message(self, dialog_id: str, at: datetime, author_id: int) -> None:
+        self.dialogs.setdefault(dialog_id, []).append(
+            {"id": self._msg_id, "chat_id": 1, "author_id": author_id, "date": at.isoformat(), "text": "..."}
+        )
+        self._msg_id += 1
+
+    def _call(self, at: datetime, phone: str, etype: str | None, eid: int | None, failed: bool = False) -> None:
+        self.calls.append({
+            "ID": str(len(self.calls) + 1),
+            "CALL_ID": f"call.{len(self.calls) + 1}",
+            "CALL_START_DATE": at.isoformat(),
+            "CALL_DURATION": "0" if failed else str(self.rng.randint(20, 600)),
+            "CALL_FAILED": "Y" if failed else "N",
+            "CALL_FAILED_CODE": "304" if failed else "200",
+            "CALL_TYPE": "1",
+            "PHONE_NUMBER": phone,
+            "PORTAL_USER_ID": str(self.rng.randint(1, EMPLOYEES)),
+            "CRM_ENTITY_TYPE": ENTITY_NAMES.get(etype or "", ""),
+            "CRM_ENTITY_ID": str(eid or ""),
+        })
+
+    @staticmethod
+    def _card(etype: str, eid: int) -> dict:
+        card = {"id": eid, "assignedById": eid % EMPLOYEES + 1}
+        if etype == "3":
+            card.update(name="Клиент", lastName=f"№{eid}")
+        else:
+            card["title"] = f"{ENTITY_NAMES.get(etype, etype).title()} <{eid}> & Co"
+        return card
+
+    def _generate(self) -> None:
+        cfg, rng = self.cfg, self.rng
+        types = [x.strip() for x in cfg.types.split(",") if x.strip()]
+        span = cfg.days * 86400
+        for n in range(cfg.entities):
+            etype = types[n % len(types)]
+            eid = n // len(types) + 1
+            self.entities[(etype, str(eid))] = self._card(etype, eid)
+            phone = f"+7 9{rng.randint(0, 99):02d} {rng.randint(0, 9999999):07d}"
+            channel = rng.choice(("CRM_EMAIL", "IMOPENLINES_SESSION", "WAZZUP"))
+            dialog_id = f"imol|wz_whatsapp_{etype}_{eid}|15|{n:08x}|1" if channel != "CRM_EMAIL" else ""
+
+            last_in = None
+            for _ in range(max(1, int(rng.expovariate(1 / cfg.messages)))):
+                created = self.now - timedelta(seconds=rng.randint(600, span))
+                comms = [{"TYPE": "PHONE", "VALUE": phone}]
+                if dialog_id:
+                    comms.append({"TYPE": "IM", "VALUE": dialog_id})
+                row = self._activity(
+                    etype, eid, created,
+                    PROVIDER_ID=channel,
+                    PROVIDER_TYPE_ID="EMAIL" if channel == "CRM_EMAIL" else "15",
+                    SUBJECT=f"Обращение клиента #{eid}",
+                    DESCRIPTION=f"Текст сообщения {'x' * rng.randint(50, 400)}",
+                    COMMUNICATIONS=comms,
+                )
+                if dialog_id:
+                    self._dialog_message(dialog_id, created, CLIENT_USER_BASE + n)
+                if last_in is None or row["CREATED"] > last_in["CREATED"]:
+                    last_in = row
+
+            for _ in range(cfg.noise):
+                self._activity(
+                    etype, eid, self.now - timedelta(seconds=rng.randint(60, span)),
+                    PROVIDER_ID=rng.choice(("CRM_TODO", "CRM_MEETING", "TASKS_TASK")),
+                    PROVIDER_TYPE_ID="TODO", DIRECTION=str(rng.choice((0, 1))),
+                )
+
+            t_in = datetime.fromisoformat(last_in["CREATED"])
+            after = min(t_in + timedelta(seconds=rng.randint(30, 3600)), self.now)
+            outcome = rng.random()
+            if outcome < 0.35:
+                self._activity(
+                    etype, eid, after, PROVIDER_ID=channel,
+                    PROVIDER_TYPE_ID=last_in["PROVIDER_TYPE_ID"], DIRECTION="1", COMPLETED="Y",
+                )
+                if dialog_id:
+                    self._dialog_message(dialog_id, after, rng.randint(1, EMPLOYEES))
+            elif outcome < 0.50:
+                self._call(after, phone, etype, eid)
+                self._activity(
+                    etype, eid, after, PROVIDER_ID="VOXIMPLANT_CALL", PROVIDER_TYPE_ID="CALL",
+                    DIRECTION="1", COMPLETED="Y",
+                )
+            elif outcome < 0.60:
+                # звонок с номера, не привязанный к CRM; телефония пишет номер в своём формате
+                self._call(after, "8" + re.sub(r"\D", "", phone)[1:], None, None)
+            elif outcome < 0.70 and dialog_id:
+                self._dialog_message(dialog_id, after, rng.randint(1, EMPLOYEES))  # ответ только в чате
+            else:
+                if rng.random() < 0.3:
+                    self._call(after, phone, etype, eid, failed=True)  # недозвон ответом не считается
+                self.expected_unanswered += 1
+
+        self.activities.sort(key=lambda a: int(a["ID"]))
+        self.calls.sort(key=lambda c: c["CALL_START_DATE"])
+
+    def summary(self) -> dict:
+        return {
+            "activities": len(self.activities),
+            "calls": len(self.calls),
+            "dialogs": len(self.dialogs),
+            "expected_unanswered": self.expected_unanswered,
+        }
+
+
+# ---------------------------
+#  Фильтры и сортировки в духе crm.*.list
+# ---------------------------
+_DATE_FIELDS = {"CREATED", "LAST_UPDATED", "CALL_START_DATE"}
+_INT_FIELDS = {"ID", "OWNER_ID", "OWNER_TYPE_ID", "CRM_ENTITY_ID"}
+
+
+@lru_cache(maxsize=None)
+def _date(v: str) -> datetime:
+    return datetime.fromisoformat(v.replace("Z", "+00:00"))
+
+
+def _value(field: str, v: t.Any) -> t.Any:
+    if v is None or v == "":
+        return None
+    if field in _DATE_FIELDS:
+        return _date(str(v))
+    if field in _INT_FIELDS:
+        return int(v)
+    return str(v).upper()
+
+
+def _matches(row: dict, flt: dict) -> bool:
+    for key, want in (flt or {}).items():
+        op, field = re.match(r"^(>=|<=|!=|>|<|=|@|!)?(.+)$", str(key)).groups()
+        have = _value(field, row.get(field))
+        if isinstance(want, dict):  # из batch списки приходят словарями {"0": ..., "1": ...}
+            want = list(want.values())
+        if isinstance(want, (list, tuple)):
+            ok = have in {_value(field, w) for w in want}
+            if op in ("!", "!="):
+                ok = not ok
+        else:
+            w = _value(field, want)
+            if have is None:
+                ok = op in ("!", "!=") and w is not None
+            elif op == ">=":
+                ok = have >= w
+            elif op == ">":
+                ok = have > w
+            elif op == "<=":
+                ok = have <= w
+            elif op == "<":
+                ok = have < w
+            elif op in ("!", "!="):
+                ok = have != w
+            else:
+                ok = have == w
+        if not ok:
+            return False
+    return True
+
+
+def _sorted(rows: t.List[dict], order: dict) -> t.List[dict]:
+    for field, direction in reversed(list((order or {}).items())):
+        rows = sorted(
+            rows,
+            key=lambda r, f=field: (_value(f, r.get(f)) is None, _value(f, r.get(f)) or 0),
+            reverse=str(direction).upper() == "DESC",
+        )
+    return rows
+
+
+def _page(rows: t.List[dict], start: t.Any) -> dict:
+    start = int(start or 0)
+    if start == -1:  # без подсчёта total, как в Битриксе
+        return {"result": rows[:PAGE]}
+    out: dict = {"result": rows[start:start + PAGE], "total": len(rows)}
+    if start + PAGE < len(rows):
+        out["next"] = start + PAGE
+    return out
+
+
+def _select(rows: t.List[dict], select: t.Any) -> t.List[dict]:
+    fields = list(select.values()) if isinstance(select, dict) else list(select or [])
+    if not fields or "*" in fields:
+        return rows
+    return [{f: r[f] for f in fields if f in r} for r in rows]
+
+
+def _ci(params: dict, key: str) -> t.Any:
+    """Битрикс принимает параметры в любом регистре (filter/FILTER)."""
+    for k in (key, key.upper(), key.lower()):
+        if k in params:
+            return params[k]
+    return None
+
+
+class BitrixError(Exception):
+    def __init__(self, code: str, description: str = "", status: int = 400):
+        super().__init__(code)
+        self.code, self.description, self.status = code, description, status
+
+
+# ---------------------------
+#  Методы REST
+# ---------------------------
+class Api:
+    def __init__(self, portal: Portal):
+        self.portal = portal
+        self.lock = threading.Lock()
+        self.http_calls: t.Dict[str, int] = {}
+        self.commands: t.Dict[str, int] = {}   # включая команды внутри batch
+        self.errors = 0
+
+    def _count(self, table: t.Dict[str, int], method: str) -> None:
+        with self.lock:
+            table[method] = table.get(method, 0) + 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"http": dict(self.http_calls), "commands": dict(self.commands), "errors": self.errors}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.http_calls.clear()
+            self.commands.clear()
+            self.errors = 0
+
+    def call(self, method: str, params: dict) -> dict:
+        self._count(self.commands, method)
+        handler = getattr(self, "m_" + method.replace(".", "_"), None)
+        if handler is None:
+            raise BitrixError("ERROR_METHOD_NOT_FOUND", "Method not found!", 404)
+        return handler(params)
+
+    def m_batch(self, params: dict) -> dict:
+        halt = str(_ci(params, "halt") or "0") not in ("0", "", "false")
+        res, err, nxt, tot, tm = {}, {}, {}, {}, {}
+        for key, cmd in (_ci(params, "cmd") or {}).items():
+            method, _, query = str(cmd).partition("?")
+            start = time.time()
+            try:
+                r = self.call(method, parse_php_query(query))
+                finish = time.time()
+                tm[key] = {"start": start, "finish": finish, "duration": finish - start,
+                           "processing": finish - start, "operating": round(finish - start, 6)}
+            except BitrixError as e:
+                err[key] = {"error": e.code, "error_description": e.description}
+                if halt:
+                    break
+                continue
+            res[key] = r.get("result")
+            if r.get("next") is not None:
+                nxt[key] = r["next"]
+            if r.get("total") is not None:
+                tot[key] = r["total"]
+        return {"result": {
+            "result": res or [], "result_error": err or [],
+            "result_total": tot or [], "result_next": nxt or [], "result_time": tm or [],
+        }}
+
+    def m_crm_activity_list(self, params: dict) -> dict:
+        rows = [a for a in self.portal.activities if _matches(a, _ci(params, "filter") or {})]
+        page = _page(_sorted(rows, _ci(params, "order") or {}), _ci(params, "start"))
+        page["result"] = _select(page["result"], _ci(params, "select"))
+        return page
+
+    def m_crm_activity_get(self, params: dict) -> dict:
+        row = self.portal.by_id.get(str(_ci(params, "id") or ""))
+        if row is None:
+            raise BitrixError("NOT_FOUND", "Not found")
+        return {"result": row}
+
+    def _statistic(self, params: dict) -> dict:
+        rows = [c for c in self.portal.calls if _matches(c, _ci(params, "FILTER") or {})]
+        return _page(_sorted(rows, _ci(params, "ORDER") or {}), _ci(params, "START"))
+
+    def m_voximplant_statistic_get(self, params: dict) -> dict:
+        if self.portal.cfg.no_voximplant:
+            raise BitrixError("ERROR_METHOD_NOT_FOUND", "Method not found!", 404)
+        return self._statistic(params)
+
+    def m_telephony_statistic_get(self, params: dict) -> dict:
+        return self._statistic(params)
+
+    def m_im_dialog_messages_get(self, params: dict) -> dict:
+        dialog_id = str(_ci(params, "DIALOG_ID") or "")
+        limit = int(_ci(params, "LIMIT") or 20)
+        msgs = sorted(self.portal.dialogs.get(dialog_id, []), key=lambda m: m["id"], reverse=True)[:limit]
+        users = {}
+        for m in msgs:
+            uid = m["author_id"]
+            if uid >= CLIENT_USER_BASE:
+                users[str(uid)] = {"id": uid, "name": "Клиент", "connector": True, "bot": False}
+            else:
+                users[str(uid)] = {"id": uid, "name": f"Менеджер {uid}", "connector": False, "bot": False}
+        return {"result": {"chat_id": 1, "messages": msgs, "users": list(users.values())}}
+
+    def m_crm_item_list(self, params: dict) -> dict:
+        etype = str(_ci(params, "entityTypeId") or "")
+        ids = (_ci(params, "filter") or {}).get("@id") or {}
+        ids = ids.values() if isinstance(ids, dict) else ids
+        rows = [self.portal.entities[k] for k in ((etype, str(i)) for i in ids) if k in self.portal.entities]
+        page = _page(rows, _ci(params, "start"))
+        page["result"] = {"items": page["result"]}
+        return page
+
+    def m_user_get(self, params: dict) -> dict:
+        rows = [u for u in self.portal.users if _matches(u, _ci(params, "FILTER") or {})]
+        return _page(rows, _ci(params, "start"))
+
+
+def parse_php_query(query: str) -> dict:
+    """filter[>=CREATED]=...&select[0]=ID -> вложенные словари (как parse_str в PHP)."""
+    out: dict = {}
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        parts = re.findall(r"[^\[\]]+", key)
+        if not parts:
+            continue
+        cur = out
+        for p in parts[:-1]:
+            nxt = cur.get(p)
+            if not isinstance(nxt, dict):
+                nxt = cur[p] = {}
+            cur = nxt
+        cur[parts[-1]] = value
+    return out
+
+
+# ---------------------------
+#  HTTP-сервер
+# ---------------------------
+def _handler(api: Api, cfg: PortalConfig) -> type:
+    rng = random.Random(cfg.seed + 1)
+    rng_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего портала
+        disable_nagle_algorithm = True  # заголовки и тело уходят разными write — без задержки ACK
+
+        def log_message(self, *args: t.Any) -> None:
+            pass
+
+        def _reply(self, status: int, body: dict) -> None:
+            data = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path == "/_stats":
+                self._reply(200, {**api.stats(), "portal": api.portal.summary()})
+            else:
+                self._reply(404, {"error": "NOT_FOUND"})
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path == "/_reset":
+                api.reset()
+                self._reply(200, {"ok": True})
+                return
+            m = re.match(r"^/rest/\d+/[^/]+/(.+?)\.json$", self.path)
+            if not m:
+                self._reply(404, {"error": "NOT_FOUND", "error_description": self.path})
+                return
+            method = m.group(1).lower()
+            api._count(api.http_calls, method)
+
+            with rng_lock:
+                delay = cfg.latency_ms + rng.uniform(0, cfg.jitter_ms)
+                fail = rng.random() < cfg.error_rate
+                overload = rng.random() < 0.5
+            start = time.time()
+            if delay:
+                time.sleep(delay / 1000)
+            if fail:
+                with api.lock:
+                    api.errors += 1
+                if overload:
+                    self._reply(503, {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"})
+                else:
+                    self._reply(500, {"error": "INTERNAL_SERVER_ERROR", "error_description": "Internal server error"})
+                return
+            try:
+                params = json.loads(body or b"{}")
+                out = api.call(method, params if isinstance(params, dict) else {})
+            except BitrixError as e:
+                self._reply(e.status, {"error": e.code, "error_description": e.description})
+                return
+            finish = time.time()
+            out["time"] = {
+                "start": start, "finish": finish, "duration": finish - start,
+                "processing": finish - start, "operating": round(finish - start - delay / 1000, 6),
+            }
+            self._reply(200, out)
+
+    return Handler
+
+
+def serve(cfg: PortalConfig, port: int = 0, ready: t.Any = None) -> None:
+    """Запускает портал (блокирующе); ready — multiprocessing-очередь, куда уйдёт (порт, summary)."""
+    portal = Portal(cfg)
+    server = ThreadingHTTPServer(("127.0.0.1", port), _handler(Api(portal), cfg))
+    server.daemon_threads = True
+    if ready is not None:
+        ready.put((server.server_address[1], portal.summary()))
+    server.serve_forever()
+
+
+__all__ = ["PortalConfig", "Portal", "serve", "parse_php_query"]
@@ -0,0 +1,147 @@
+# bench/run.py — бенчмарк скана: detect_alerts против локального портала (bench/fake_portal.py)
+#
+#   python bench/run.py --entities 2000 --latency-ms 80 --repeat 2
+#   python bench/run.py --env BATCH_CHECKS=0 --env REPLY_CHECK_MODE=query --json
+#
+# Портал работает в отдельном процессе, поэтому пик памяти (tracemalloc) — только наш скан.
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing as t
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path[:0] = [HERE, ROOT]
+
+from fake_portal import PortalConfig, serve  # noqa: E402
+
+# Настройки сервиса на время бенчмарка (перекрываются --env)
+BENCH_ENV = {
+    "B24_RATE_PER_SEC": "0",      # меряем сам скан, а не лимитер
+    "HTTP_RETRY_SLEEP": "0.05",
+    "CALL_METHOD_TTL": "21600",
+}
+
+
+def _parse_args(argv: t.List[str] | None) -> argparse.Namespace:
+    p = argparse.ArgumentParser(description="Бенчмарк detect_alerts на сгенерированном портале")
+    p.add_argument("--entities", type=int, default=500, help="сущностей CRM (поровну по типам)")
+    p.add_argument("--types", default="1,2,3,4", help="OWNER_TYPE_ID сущностей")
+    p.add_argument("--days", type=int, default=None, help="глубина переписки, по умолчанию WINDOW_DAYS")
+    p.add_argument("--messages", type=int, default=3, help="входящих на сущность в среднем")
+    p.add_argument("--noise", type=int, default=2, help="прочих активностей на сущность")
+    p.add_argument("--latency-ms", type=float, default=0.0)
+    p.add_argument("--jitter-ms", type=float, default=0.0)
+    p.add_argument("--error-rate", type=float, default=0.0, help="доля запросов, отвечающих 5xx")
+    p.add_argument("--no-voximplant", action="store_true", help="портал без voximplant.statistic.get")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--repeat", type=int, default=1, help="сколько сканов подряд (видно работу кэшей)")
+    p.add_argument("--async", dest="use_async", action="store_true", help="detect_alerts_async вместо detect_alerts")
+    p.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="переменная окружения сервиса")
+    p.add_argument("--json", action="store_true", help="результат одним JSON")
+    p.add_argument("--metrics", action="store_true", help="в конце вывести /metrics сервиса")
+    return p.parse_args(argv)
+
+
+def _start_portal(cfg: PortalConfig) -> tuple[mp.Process, int, dict]:
+    ctx = mp.get_context("spawn")
+    ready = ctx.Queue()
+    proc = ctx.Process(target=serve, args=(cfg, 0, ready), daemon=True)
+    proc.start()
+    port, summary = ready.get(timeout=120)
+    return proc, port, summary
+
+
+def _portal(port: int, path: str, post: bool = False) -> dict:
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=b"{}" if post else None)
+    with urllib.request.urlopen(req, timeout=30) as r:
+        return json.loads(r.read())
+
+
+def _run_scan(logic: t.Any, use_async: bool) -> list:
+    if use_async:
+        import asyncio
+        return asyncio.run(logic.detect_alerts_async())
+    return logic.detect_alerts()
+
+
+def _print_report(report: dict) -> None:
+    p = report["portal"]
+    print(f"portal: {p['activities']} activities, {p['calls']} calls, {p['dialogs']} dialogs, "
+          f"{p['expected_unanswered']} unanswered entities")
+    print("env: " + (" ".join(f"{k}={v}" for k, v in sorted(report["env"].items())) or "-"))
+    for i, scan in enumerate(report["scans"], 1):
+        print(f"\nscan #{i}: {scan['wall_sec']:.3f} s, peak memory {scan['peak_mb']:.1f} MiB, "
+              f"alerts {scan['alerts']}, http calls {scan['http_total']} (errors injected {scan['errors']})")
+        print(f"  {'method':<32}{'http':>8}{'commands':>10}")
+        for method in sorted(set(scan["http"]) | set(scan["commands"])):
+            print(f"  {method:<32}{scan['http'].get(method, 0):>8}{scan['commands'].get(method, 0):>10}")
+
+
+def main(argv: t.List[str] | None = None) -> dict:
+    args = _parse_args(argv)
+    overrides = dict(BENCH_ENV)
+    for item in args.env:
+        key, _, value = item.partition("=")
+        overrides[key.strip()] = value
+    days = args.days or int(overrides.get("WINDOW_DAYS") or os.getenv("WINDOW_DAYS") or "14")
+
+    cfg = PortalConfig(
+        entities=args.entities, types=args.types, days=days, messages=args.messages, noise=args.noise,
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        no_voximplant=args.no_voximplant, seed=args.seed,
+    )
+    proc, port, summary = _start_portal(cfg)
+    tmp = tempfile.TemporaryDirectory(prefix="bitrix-bench-")
+    try:
+        os.environ.update(overrides)
+        os.environ["B24_WEBHOOK"] = f"http://127.0.0.1:{port}/rest/1/bench/"
+        os.environ.setdefault("STORE_PATH", os.path.join(tmp.name, "bench.sqlite3"))
+        import logic  # после окружения: модули читают настройки при импорте
+
+        scans = []
+        for _ in range(max(args.repeat, 1)):
+            _portal(port, "/_reset", post=True)
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            alerts = _run_scan(logic, args.use_async)
+            wall = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            st = _portal(port, "/_stats")
+            scans.append({
+                "wall_sec": round(wall, 4),
+                "peak_mb": round(peak / 2**20, 2),
+                "alerts": len(alerts),
+                "http_total": sum(st["http"].values()),
+                "http": st["http"],
+                "commands": st["commands"],
+                "errors": st["errors"],
+            })
+        report = {"portal": summary, "config": vars(args), "env": overrides, "scans": scans}
+        if args.metrics:
+            import metrics
+            report["metrics"] = metrics.render()
+    finally:
+        proc.terminate()
+        tmp.cleanup()
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        _print_report(report)
+        if args.metrics:
+            print("\n" + report["metrics"])
+    return report
+
+
+if __name__ == "__main__":
+    main()
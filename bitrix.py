@@ -2,62 +2,318 @@
 from __future__ import annotations
 
 import os
+import random
+import threading
 import time
 import typing as t
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
 import requests
 
+import metrics
+from http_client import get_client
+from ratelimit import OperatingBudget, TokenBucket
+
 # === Базовый URL вебхука ===
+# Проверяется при первом вызове, а не при импорте: процесс-диспетчер нескольких порталов
+# (portals.py) импортирует модуль без своего B24_WEBHOOK
 _B24 = (os.getenv("B24_WEBHOOK") or "").rstrip("/")
-if not _B24:
-    raise RuntimeError("Env B24_WEBHOOK is empty")
 
 # === Сетевые таймауты/повторы ===
 _HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "25"))
-_RETRY = int(os.getenv("HTTP_RETRY", "2"))
-_RETRY_SLEEP = float(os.getenv("HTTP_RETRY_SLEEP", "0.8"))
+_RETRY = int(os.getenv("HTTP_RETRY", "2"))                        # повторы при 5xx и сетевых ошибках
+_RETRY_THROTTLED = int(os.getenv("HTTP_RETRY_THROTTLED", "6"))    # повторы при QUERY_LIMIT_EXCEEDED / 429
+_RETRY_SLEEP = float(os.getenv("HTTP_RETRY_SLEEP", "0.8"))        # первая пауза, дальше x2 (с jitter)
+_RETRY_MAX_SLEEP = float(os.getenv("HTTP_RETRY_MAX_SLEEP", "30"))
 
-def _method_url(method: str) -> str:
-    return f"{_B24}/{method}.json"
+# Пул keep-alive соединений к порталу (см. http_client.py)
+_HTTP = get_client("bitrix")
 
-def _post(method: str, payload: dict) -> dict:
+# Лимит запросов к порталу: token bucket чуть ниже квоты Битрикса (2 запроса/с, запас 50).
+# Общий для всех потоков и корутин процесса; каждая попытка (и повтор) берёт токен.
+_RATE_PER_SEC = float(os.getenv("B24_RATE_PER_SEC", "2"))
+_RATE_BURST = float(os.getenv("B24_RATE_BURST", "40"))
+_LIMITER = TokenBucket(_RATE_PER_SEC, _RATE_BURST)
+
+# Квота time.operating: 480 с работы метода за 10 минут, дальше портал блокирует метод.
+# Запас B24_OPERATING_SOFT — с этой доли вызовы метода придерживаются.
+_OPERATING = OperatingBudget(
+    float(os.getenv("B24_OPERATING_LIMIT", "480")),
+    float(os.getenv("B24_OPERATING_WINDOW", "600")),
+    float(os.getenv("B24_OPERATING_SOFT", "0.8")),
+)
+# После QUERY_LIMIT_EXCEEDED притормаживают все вызовы процесса, а не только упавший
+_throttled_until = 0.0
+
+# === Метрики (/metrics) ===
+B24_CALLS = metrics.counter(
+    "bitrix_calls_total", "Вызовы методов Bitrix (с повторами внутри), по итогу", ["method", "status"])
+B24_RETRIES = metrics.counter("bitrix_retries_total", "Повторные попытки вызова", ["method"])
+B24_ERRORS = metrics.counter("bitrix_errors_total", "Неудачные попытки по коду ошибки", ["method", "error"])
+B24_REQUEST_SECONDS = metrics.histogram("bitrix_request_seconds", "Время одной HTTP-попытки", ["method"])
+B24_CALL_SECONDS = metrics.histogram(
+    "bitrix_call_seconds", "Время вызова целиком: лимитер, попытки и паузы между ними", ["method"])
+B24_OPERATING = metrics.counter(
+    "bitrix_operating_seconds_total", "Сумма time.operating из ответов Битрикса (квота на метод)", ["method"])
+B24_OPERATING_WINDOW = metrics.gauge(
+    "bitrix_operating_window_seconds", "time.operating метода за скользящее окно квоты", ["method"])
+B24_BACKOFF_SECONDS = metrics.counter(
+    "bitrix_backoff_seconds_total", "Паузы перед вызовами: throttle, transient, operating", ["reason"])
+
+class BitrixError(RuntimeError):
     """
-    Вызов метода Bitrix с базовой обработкой ошибок.
-    Любые сетевые/HTTP/битрикс-ошибки -> RuntimeError (для верхнего уровня и фоллбеков).
+    Ошибка вызова Bitrix. kind:
+      throttle  — портал просит притормозить (QUERY_LIMIT_EXCEEDED, 429): повтор с растущей паузой;
+      transient — 5xx, сеть, таймаут: повтор;
+      permanent — 400/401/403/404, нет метода, нет прав: повтор не поможет.
     """
-    url = _method_url(method)
-    last_exc: Exception | None = None
 
-    for i in range(_RETRY + 1):
+    def __init__(self, message: str, code: str = "", status: int = 0, kind: str = "permanent"):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+        self.kind = kind
+
+# Коды ошибок Битрикса, при которых портал просит подождать
+_THROTTLE_CODES = {"QUERY_LIMIT_EXCEEDED", "OPERATION_TIME_LIMIT", "TOO_MANY_REQUESTS"}
+_TRANSIENT_CODES = {"INTERNAL_SERVER_ERROR", "ERROR_UNEXPECTED_ANSWER", "PORTAL_DELETED_TEMPORARILY"}
+
+def error_kind(code: str, status: int = 0) -> str:
+    """throttle / transient / permanent по коду ошибки Битрикса и HTTP-статусу (см. BitrixError)."""
+    if code in _THROTTLE_CODES or status == 429:
+        return "throttle"
+    if code in _TRANSIENT_CODES or status >= 500:
+        return "transient"
+    return "permanent"
+
+def _as_bitrix_error(exc: Exception) -> BitrixError:
+    if isinstance(exc, BitrixError):
+        return exc
+    if isinstance(exc, requests.RequestException):
+        return BitrixError(str(exc), type(exc).__name__, kind="transient")
+    return BitrixError(str(exc), kind="permanent")
+
+def _error_code(exc: Exception) -> str:
+    """Короткий код ошибки для метрик: QUERY_LIMIT_EXCEEDED, HTTP_503, ConnectionError..."""
+    if isinstance(exc, BitrixError) and exc.code:
+        return exc.code
+    if isinstance(exc, requests.RequestException):
+        return type(exc).__name__
+    msg = str(exc)
+    if msg.startswith("HTTP "):
+        return "HTTP_" + msg.split()[1]
+    code = msg.split(":", 1)[0].strip()
+    return code if code and code.replace("_", "").isalnum() and code.upper() == code else "OTHER"
+
+def _record_operating(method: str, data: t.Any) -> None:
+    tm = data.get("time") if isinstance(data, dict) else None
+    if isinstance(tm, dict) and tm.get("operating") is not None:
         try:
-            r = requests.post(url, json=payload, timeout=_HTTP_TIMEOUT)
-            # попробуем разобрать JSON даже при ошибочном статусе
-            try:
-                data = r.json()
-            except ValueError:
-                data = None
+            operating = float(tm["operating"])
+        except (TypeError, ValueError):
+            return
+        B24_OPERATING.inc(operating, method=method)
+        B24_OPERATING_WINDOW.set(_OPERATING.record(method, operating), method=method)
+
+def _budget_methods(method: str, payload: dict) -> t.Set[str]:
+    """Методы, чья квота расходуется вызовом: у batch — ещё и методы команд внутри."""
+    methods = {method}
+    if method == "batch":
+        for cmd in (payload.get("cmd") or {}).values():
+            methods.add(str(cmd).split("?", 1)[0])
+    return methods
 
-            if r.status_code >= 400:
-                if isinstance(data, dict) and "error" in data:
-                    raise RuntimeError(f"{data.get('error')}: {data.get('error_description')}")
-                raise RuntimeError(f"HTTP {r.status_code} for {method}")
+def _pause_before(method: str, payload: dict) -> float:
+    """Сколько подождать перед попыткой: общий откат после throttle и квота time.operating методов."""
+    wait_throttle = _throttled_until - time.monotonic()
+    wait_operating = max((_OPERATING.wait_time(m) for m in _budget_methods(method, payload)), default=0.0)
+    if wait_operating > 0 and wait_operating >= wait_throttle:
+        B24_BACKOFF_SECONDS.inc(wait_operating, reason="operating")
+    return max(wait_throttle, wait_operating, 0.0)
 
-            if isinstance(data, dict) and "error" in data:
-                raise RuntimeError(f"{data.get('error')}: {data.get('error_description')}")
+def operating_usage() -> t.Dict[str, float]:
+    """time.operating по методам за окно квоты (для /health)."""
+    return _OPERATING.usage()
 
-            return data or {}
+def _require_webhook() -> None:
+    if not _B24:
+        raise RuntimeError("Env B24_WEBHOOK is empty")
 
-        except (requests.RequestException, RuntimeError) as e:
-            last_exc = e
-            if i == _RETRY:
-                raise RuntimeError(str(e))
-            time.sleep(_RETRY_SLEEP)
+def _method_url(method: str) -> str:
+    _require_webhook()
+    return f"{_B24}/{method}.json"
 
-    raise RuntimeError(str(last_exc) if last_exc else "Unknown request failure")
+def _post_once(method: str, payload: dict) -> dict:
+    """Одна попытка вызова; ошибки -> RuntimeError / requests.RequestException."""
+    start = time.perf_counter()
+    try:
+        data = _request(method, payload)
+    except (requests.RequestException, RuntimeError) as e:
+        B24_ERRORS.inc(method=method, error=_error_code(e))
+        raise
+    finally:
+        B24_REQUEST_SECONDS.observe(time.perf_counter() - start, method=method)
+    _record_operating(method, data)
+    return data
+
+def _request(method: str, payload: dict) -> dict:
+    r = _HTTP.post(_method_url(method), json=payload, timeout=_HTTP_TIMEOUT)
+    # попробуем разобрать JSON даже при ошибочном статусе
+    try:
+        data = r.json()
+    except ValueError:
+        data = None
+
+    if isinstance(data, dict) and "error" in data:
+        code = str(data.get("error") or "").upper()
+        raise BitrixError(
+            f"{data.get('error')}: {data.get('error_description')}",
+            code, r.status_code, error_kind(code, r.status_code),
+        )
+    if r.status_code >= 400:
+        raise BitrixError(
+            f"HTTP {r.status_code} for {method}",
+            f"HTTP_{r.status_code}", r.status_code, error_kind("", r.status_code),
+        )
+
+    return data or {}
+
+def _retry_delay(attempt: int, exc: Exception) -> float | None:
+    """
+    Пауза перед следующей попыткой или None — больше не пробуем.
+    attempt — сколько раз уже повторяли после ошибок того же kind (у троттлинга и 5xx свои лимиты).
+    Экспонента от HTTP_RETRY_SLEEP с jitter (половина паузы случайна), чтобы потоки и
+    порталы не повторяли одновременно; permanent-ошибки не повторяются вовсе.
+    """
+    global _throttled_until
+    err = _as_bitrix_error(exc)
+    limit = {"throttle": _RETRY_THROTTLED, "transient": _RETRY}.get(err.kind, 0)
+    if attempt >= limit:
+        return None
+    delay = min(_RETRY_SLEEP * 2 ** attempt, _RETRY_MAX_SLEEP)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if err.kind == "throttle":
+        _throttled_until = max(_throttled_until, time.monotonic() + delay)
+    B24_BACKOFF_SECONDS.inc(delay, reason=err.kind)
+    return delay
+
+def _post(method: str, payload: dict) -> dict:
+    """
+    Вызов метода Bitrix с обработкой ошибок (см. BitrixError и _retry_delay).
+    Любые сетевые/HTTP/битрикс-ошибки -> BitrixError (это RuntimeError — для верхнего уровня и фоллбеков).
+    """
+    _require_webhook()  # без вебхука повторять нечего
+    attempts: t.Dict[str, int] = {}  # повторы по kind: троттлинг не съедает лимит на 5xx
+    with B24_CALL_SECONDS.time(method=method):
+        while True:
+            pause = _pause_before(method, payload)
+            if pause > 0:
+                time.sleep(pause)
+            _LIMITER.acquire()
+            try:
+                data = _post_once(method, payload)
+                B24_CALLS.inc(method=method, status="ok")
+                return data
+            except (requests.RequestException, RuntimeError) as e:
+                kind = _as_bitrix_error(e).kind
+                delay = _retry_delay(attempts.get(kind, 0), e)
+                if delay is None:
+                    B24_CALLS.inc(method=method, status="error")
+                    raise _as_bitrix_error(e)
+                B24_RETRIES.inc(method=method)
+                time.sleep(delay)
+                attempts[kind] = attempts.get(kind, 0) + 1
 
 # Экспортируем «сырой» вызов как публичный helper
 def b24(method: str, params: dict) -> dict:
     return _post(method, params)
 
+# ---------------------------
+#  batch: до 50 команд за один HTTP-вызов
+# ---------------------------
+_BATCH_MAX = 50
+
+def _flatten_params(value: t.Any, prefix: str, out: t.List[tuple[str, str]]) -> None:
+    """Параметры метода -> пары в стиле PHP http_build_query (filter[>=CREATED]=...)."""
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten_params(v, f"{prefix}[{k}]" if prefix else str(k), out)
+    elif isinstance(value, (list, tuple)):
+        for i, v in enumerate(value):
+            _flatten_params(v, f"{prefix}[{i}]", out)
+    elif isinstance(value, bool):
+        out.append((prefix, "Y" if value else "N"))
+    elif value is None:
+        out.append((prefix, ""))
+    else:
+        out.append((prefix, str(value)))
+
+def _batch_cmd(method: str, params: dict | None) -> str:
+    pairs: t.List[tuple[str, str]] = []
+    _flatten_params(params or {}, "", pairs)
+    query = urlencode(pairs)
+    return f"{method}?{query}" if query else method
+
+def _as_keyed(v: t.Any) -> dict:
+    # Битрикс отдаёт пустые секции batch как [] вместо {}
+    if isinstance(v, dict):
+        return v
+    if isinstance(v, list):
+        return {str(i): x for i, x in enumerate(v)}
+    return {}
+
+def _batch_payload(chunk: t.List[tuple[str, tuple[str, dict]]], halt: bool) -> dict:
+    return {
+        "halt": 1 if halt else 0,
+        "cmd": {key: _batch_cmd(method, params) for key, (method, params) in chunk},
+    }
+
+def _batch_results(chunk: t.List[tuple[str, tuple[str, dict]]], data: dict) -> t.Dict[str, dict]:
+    out: t.Dict[str, dict] = {}
+    res = data.get("result") or {}
+    results = _as_keyed(res.get("result"))
+    errors = _as_keyed(res.get("result_error"))
+    nexts = _as_keyed(res.get("result_next"))
+    totals = _as_keyed(res.get("result_total"))
+    times = _as_keyed(res.get("result_time"))
+
+    for key, (method, _) in chunk:
+        # квота time.operating у Битрикса своя у каждого метода, в том числе внутри batch
+        _record_operating(method, {"time": times.get(key)})
+
+    for key, _ in chunk:
+        if key in errors:
+            err = errors[key]
+            if isinstance(err, dict):
+                out[key] = {"error": err.get("error"), "error_description": err.get("error_description")}
+            else:
+                out[key] = {"error": str(err), "error_description": ""}
+        elif key in results:
+            out[key] = {"result": results[key], "next": nexts.get(key), "total": totals.get(key)}
+        else:
+            # halt=1 прервал пачку до этой команды
+            out[key] = {"error": "BATCH_SKIPPED", "error_description": "command was not executed"}
+    return out
+
+def _batch_chunks(commands: t.Mapping[str, tuple[str, dict]]) -> t.List[t.List[tuple[str, tuple[str, dict]]]]:
+    items = list(commands.items())
+    return [items[i:i + _BATCH_MAX] for i in range(0, len(items), _BATCH_MAX)]
+
+def batch(commands: t.Mapping[str, tuple[str, dict]], *, halt: bool = False) -> t.Dict[str, dict]:
+    """
+    Выполняет команды через метод batch пачками по 50.
+    commands: {ключ: (метод, параметры)}; ключи — строки без пробелов и спецсимволов.
+    Возвращает {ключ: ответ} в той же форме, что и обычный вызов:
+      {"result": ..., "next": ..., "total": ...} или {"error": ..., "error_description": ...}.
+    Ошибка одной команды не валит остальные; ошибка самого batch -> RuntimeError.
+    """
+    out: t.Dict[str, dict] = {}
+    for chunk in _batch_chunks(commands):
+        out.update(_batch_results(chunk, _post("batch", _batch_payload(chunk, halt))))
+    return out
+
 # ---------------------------
 #  crm.activity.list (постранично)
 # ---------------------------
@@ -91,9 +347,322 @@ def list_activities(
         start = next_start
     return result
 
+# ---------------------------
+#  crm.activity.list потоком: keyset-пагинация по ID
+# ---------------------------
+_PAGE_SIZE = 50  # фиксированный размер страницы crm.*.list
+
+def iter_activities(
+    flt: dict | None = None,
+    select: t.List[str] | None = None,
+    *,
+    descending: bool = False,
+    max_rows: int | None = None,
+) -> t.Iterator[dict]:
+    """
+    Строки crm.activity.list по одной, страница за страницей.
+    Вместо start/next — сортировка по ID и фильтр >ID (<ID при descending) от последней
+    строки страницы, а start=-1 отключает подсчёт total на стороне Битрикса.
+    В памяти только текущая страница; вызывающий может остановиться в любой момент.
+    """
+    sel = list(select or [])
+    if sel and "ID" not in sel:
+        sel.append("ID")
+    key = "<ID" if descending else ">ID"
+    last_id: int | None = None
+    yielded = 0
+
+    while True:
+        f = dict(flt or {})
+        if last_id is not None:
+            f[key] = last_id
+        data = _post("crm.activity.list", {
+            "filter": f,
+            "order": {"ID": "DESC" if descending else "ASC"},
+            "select": sel,
+            "start": -1,
+        })
+        page = data.get("result", []) or []
+        for row in page:
+            yield row
+            yielded += 1
+            if max_rows is not None and yielded >= max_rows:
+                return
+        if len(page) < _PAGE_SIZE:
+            return
+        last_id = int(page[-1]["ID"])
+
+# ---------------------------
+#  Выгрузка по временным срезам (параллельно)
+# ---------------------------
+# Длинный период режется на срезы по CREATED, срезы листаются одновременно: keyset-листание
+# внутри среза последовательно, а срезы друг от друга не зависят. Все запросы проходят через
+# общий лимитер, так что параллельность ограничивает ожидание ответов, а не квоту портала.
+def time_slices(since: datetime, until: datetime, step: timedelta | None) -> t.List[tuple[datetime, datetime]]:
+    """[since, until) кусками по step, новые первыми; step=None или 0 — один кусок."""
+    if until <= since:
+        return []
+    if not step or step.total_seconds() <= 0:
+        return [(since, until)]
+    out = []
+    end = until
+    while end > since:
+        start = max(end - step, since)
+        out.append((start, end))
+        end = start
+    return out
+
+def parallel_map(fn: t.Callable[..., t.Any], jobs: t.Sequence[tuple], concurrency: int, name: str = "bitrix") -> t.List[t.Any]:
+    """fn(*job) для каждого job не больше чем в concurrency потоков; результаты — в порядке jobs."""
+    if len(jobs) <= 1 or concurrency <= 1:
+        return [fn(*job) for job in jobs]
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(jobs)), thread_name_prefix=name) as pool:
+        return list(pool.map(lambda job: fn(*job), jobs))
+
+def list_activities_sliced(
+    filters: t.Sequence[dict],
+    select: t.List[str] | None,
+    since: datetime,
+    until: datetime,
+    *,
+    step: timedelta | None,
+    concurrency: int,
+    max_rows: int | None = None,
+) -> tuple[t.List[t.List[t.List[dict]]], dict]:
+    """
+    crm.activity.list за [since, until) по каждому фильтру: все пары (фильтр, срез) — одним пулом.
+    Возвращает (по фильтру — список срезов, новые первыми; внутри среза ID DESC) и покрытие:
+    сколько строк и запросов, упёрся ли какой-то срез в max_rows (тогда covered_since — с какого
+    момента выгрузка полная).
+    """
+    started = time.perf_counter()
+    slices = time_slices(since, until, step)
+    jobs = [
+        ({**flt, ">=CREATED": _iso_utc(a), "<CREATED": _iso_utc(b)}, a)
+        for flt in filters for a, b in slices
+    ]
+
+    def fetch(flt: dict, start: datetime) -> tuple[t.List[dict], datetime | None]:
+        rows = list(iter_activities(flt, select, descending=True, max_rows=max_rows))
+        if max_rows is not None and len(rows) >= max_rows:
+            oldest = min((_created_ts(r) for r in rows), default=None)
+            return rows, oldest or start
+        return rows, None
+
+    results = parallel_map(fetch, jobs, concurrency, "activities")
+    out: t.List[t.List[t.List[dict]]] = []
+    truncated_at: t.List[datetime] = []
+    for i in range(len(filters)):
+        part = results[i * len(slices):(i + 1) * len(slices)]
+        out.append([rows for rows, _ in part])
+        truncated_at.extend(cut for _, cut in part if cut is not None)
+    coverage = {
+        "since": _iso_utc(since),
+        "until": _iso_utc(until),
+        "slices": len(slices),
+        "queries": len(jobs),
+        "rows": sum(len(rows) for rows, _ in results),
+        "truncated": bool(truncated_at),
+        "covered_since": _iso_utc(max(truncated_at) if truncated_at else since),
+        "seconds": round(time.perf_counter() - started, 3),
+    }
+    return out, coverage
+
+def _iso_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).isoformat()
+
+def _created_ts(row: dict) -> datetime | None:
+    raw = str(row.get("CREATED") or "")
+    try:
+        return datetime.fromisoformat(raw.replace("Z", "+00:00")) if raw else None
+    except ValueError:
+        return None
+
 # ---------------------------
 #  Журнал звонков (телефония) + фоллбек на активности
 # ---------------------------
+# OWNER_TYPE_ID сущностей CRM -> CRM_ENTITY_TYPE в журнале звонков
+CRM_TYPE_NAMES = {"1": "LEAD", "2": "DEAL", "3": "CONTACT", "4": "COMPANY"}
+
+def call_entity_type_id(call: dict) -> str:
+    """CRM_ENTITY_TYPE звонка ('LEAD' или '1') -> '1'; пустая строка, если привязки нет."""
+    et = str(call.get("CRM_ENTITY_TYPE", call.get("ENTITY_TYPE", "")) or "").strip().upper()
+    for type_id, name in CRM_TYPE_NAMES.items():
+        if et == name:
+            return type_id
+    return et
+
+def filter_calls_by_entity(
+    calls: t.Iterable[dict],
+    entity_type_id: int | str | None,
+    entity_id: int | str | None,
+) -> t.List[dict]:
+    """Оставляет звонки этой сущности и звонки без привязки к CRM."""
+    filtered: t.List[dict] = []
+    for c in calls:
+        et = call_entity_type_id(c)
+        ei = str(c.get("CRM_ENTITY_ID", c.get("ENTITY_ID", "")) or "")
+        if entity_type_id and et and str(entity_type_id) != et:
+            continue
+        if entity_id and ei and str(entity_id) != ei:
+            continue
+        filtered.append(c)
+    return filtered
+
+# Методы журнала звонков в порядке предпочтения
+CALL_LOG_METHODS = ("voximplant.statistic.get", "telephony.statistic.get")
+
+def _calls_via(
+    method: str,
+    since_iso: str,
+    *,
+    phone: str | None = None,
+    max_rows: int | None = None,
+    order: str = "ASC",
+    until_iso: str | None = None,
+) -> t.List[dict]:
+    res: t.List[dict] = []
+    start = 0
+    base_filter = {">=CALL_START_DATE": since_iso}
+    if until_iso:
+        base_filter["<CALL_START_DATE"] = until_iso
+    if phone:
+        base_filter["PHONE_NUMBER"] = phone
+
+    while True:
+        payload = {
+            "FILTER": base_filter,
+            "ORDER": {"CALL_START_DATE": order},
+            "START": start,
+        }
+        try:
+            data = _post(method, payload)
+        except Exception as e:
+            # Вызывающий пробует следующий метод; kind решает, запоминать ли метод как недоступный
+            err = _as_bitrix_error(e)
+            raise BitrixError(f"{method} failed: {e}", err.code, err.status, err.kind)
+
+        page = data.get("result", []) or []
+        res.extend(page)
+
+        if max_rows is not None and len(res) >= max_rows:
+            return res[:max_rows]
+
+        next_start = data.get("next")
+        if next_start is None:
+            break
+        start = next_start
+    return res
+
+# ---------------------------
+#  Какие методы журнала звонков работают на портале
+# ---------------------------
+# Упавший метод запоминается на CALL_METHOD_TTL секунд: сканы его пропускают и не платят
+# за повторы. По истечении TTL метод перепроверяется в фоновом потоке, а не в скане.
+_CALL_METHOD_TTL = float(os.getenv("CALL_METHOD_TTL", "21600"))
+
+_call_methods_lock = threading.Lock()
+_call_methods: t.Dict[str, dict] = {}  # method -> {"ok", "checked_at", "error"}
+_call_methods_rechecking: t.Set[str] = set()
+
+def report_call_method(method: str, ok: bool, error: str = "") -> None:
+    with _call_methods_lock:
+        _call_methods[method] = {"ok": ok, "checked_at": time.time(), "error": error}
+
+def _recheck_call_method(method: str) -> None:
+    try:
+        # Дешёвый пробный запрос: звонков «с текущего момента» нет, ответ пустой
+        _post(method, {
+            "FILTER": {">=CALL_START_DATE": datetime.now(timezone.utc).isoformat()},
+            "START": 0,
+        })
+        report_call_method(method, True)
+    except Exception as e:
+        if _as_bitrix_error(e).kind == "permanent":
+            report_call_method(method, False, str(e))
+    finally:
+        with _call_methods_lock:
+            _call_methods_rechecking.discard(method)
+
+def _schedule_recheck(method: str) -> None:
+    with _call_methods_lock:
+        if method in _call_methods_rechecking:
+            return
+        _call_methods_rechecking.add(method)
+    threading.Thread(
+        target=_recheck_call_method, args=(method,), name=f"recheck-{method}", daemon=True
+    ).start()
+
+def call_log_methods() -> t.List[str]:
+    """Методы журнала звонков, которые стоит пробовать сейчас (по порядку предпочтения)."""
+    usable: t.List[str] = []
+    now = time.time()
+    for method in CALL_LOG_METHODS:
+        with _call_methods_lock:
+            st = _call_methods.get(method)
+        if st is None or st["ok"]:
+            usable.append(method)
+        elif now - st["checked_at"] >= _CALL_METHOD_TTL:
+            _schedule_recheck(method)
+    return usable
+
+def probe_call_methods() -> None:
+    """Фоновая проверка всех ещё не проверенных методов (при старте сервиса)."""
+    for method in CALL_LOG_METHODS:
+        with _call_methods_lock:
+            known = method in _call_methods
+        if not known:
+            _schedule_recheck(method)
+
+def call_log_status() -> dict:
+    """Для /health: какой источник звонков сейчас используется и что известно о методах."""
+    with _call_methods_lock:
+        methods = {
+            m: {
+                "ok": st["ok"],
+                "checked_at": datetime.fromtimestamp(st["checked_at"], timezone.utc).isoformat(),
+                "error": st["error"],
+            }
+            for m, st in _call_methods.items()
+        }
+    source = None
+    for m in CALL_LOG_METHODS:
+        st = methods.get(m)
+        if st is None:
+            break  # ещё не проверяли — источник пока неизвестен
+        if st["ok"]:
+            source = m
+            break
+    else:
+        source = "crm.activity.list"
+    return {"source": source, "ttl_sec": _CALL_METHOD_TTL, "methods": methods}
+
+def list_call_log(
+    since_iso: str,
+    *,
+    phone: str | None = None,
+    max_rows: int | None = 2000,
+    order: str = "ASC",
+    until_iso: str | None = None,
+) -> tuple[t.List[dict], str]:
+    """
+    Журнал звонков с since_iso (и до until_iso, если задан): voximplant.statistic.get,
+    затем telephony.statistic.get (без методов, которые недавно падали на этом портале).
+    Возвращает (звонки, метод-источник); ([], "") — если ни один метод недоступен.
+    """
+    for method in call_log_methods():
+        try:
+            calls = _calls_via(method, since_iso, phone=phone, max_rows=max_rows, order=order, until_iso=until_iso)
+        except RuntimeError as e:
+            # Недоступным метод считается только при permanent-ошибке: перегрузка портала
+            # или 5xx не должны переключать источник звонков на CALL_METHOD_TTL
+            if _as_bitrix_error(e).kind == "permanent":
+                report_call_method(method, False, str(e))
+            continue
+        report_call_method(method, True)
+        return calls, method
+    return [], ""
+
 def list_calls_since(
     since_iso: str,
     *,
@@ -108,58 +677,12 @@ def list_calls_since(
       2) telephony.statistic.get
       3) crm.activity.list (PROVIDER_ID in ["VOXIMPLANT_CALL","CALL"])
     """
-    def _calls_via(method: str) -> t.List[dict]:
-        res: t.List[dict] = []
-        start = 0
-        base_filter = {">=CALL_START_DATE": since_iso}
-        if phone:
-            base_filter["PHONE_NUMBER"] = phone
-
-        while True:
-            payload = {
-                "FILTER": base_filter,
-                "ORDER": {"CALL_START_DATE": "ASC"},
-                "START": start,
-            }
-            try:
-                data = _post(method, payload)
-            except Exception as e:
-                # Любая ошибка — считаем, что метод недоступен, пробуем следующий
-                raise RuntimeError(f"{method} failed: {e}")
-
-            page = data.get("result", []) or []
-            res.extend(page)
-
-            if max_rows is not None and len(res) >= max_rows:
-                return res[:max_rows]
-
-            next_start = data.get("next")
-            if next_start is None:
-                break
-            start = next_start
-        return res
-
     # 1) и 2)
-    try:
-        calls = _calls_via("voximplant.statistic.get")
-    except RuntimeError:
-        try:
-            calls = _calls_via("telephony.statistic.get")
-        except RuntimeError:
-            calls = []
+    calls, _ = list_call_log(since_iso, phone=phone, max_rows=max_rows)
 
     # Фильтрация по сущности, если указана
     if calls and (entity_type_id or entity_id):
-        filtered: t.List[dict] = []
-        for c in calls:
-            et = str(c.get("CRM_ENTITY_TYPE", c.get("ENTITY_TYPE", "")) or "")
-            ei = str(c.get("CRM_ENTITY_ID", c.get("ENTITY_ID", "")) or "")
-            if entity_type_id and et and str(entity_type_id) != et:
-                continue
-            if entity_id and ei and str(entity_id) != ei:
-                continue
-            filtered.append(c)
-        calls = filtered
+        calls = filter_calls_by_entity(calls, entity_type_id, entity_id)
 
     # 3) Фоллбек на активности звонков
     if not calls:
@@ -199,16 +722,20 @@ def list_calls_since(
 # ---------------------------
 #  OpenLines / Wazzup: чтение последних сообщений диалога
 # ---------------------------
+def openlines_messages_params(dialog_id: str, limit: int = 1) -> dict:
+    """Параметры im.dialog.messages.get: последние limit сообщений диалога (и для batch)."""
+    return {
+        "DIALOG_ID": dialog_id,
+        "LIMIT": int(limit),
+        "SORT": "DESC"
+    }
+
 def get_last_openlines_messages(dialog_id: str, limit: int = 1) -> dict:
     """
     Обёртка над im.dialog.messages.get.
     Возвращает dict с ключами: {"messages": [...], "users": {...}}
     """
-    data = _post("im.dialog.messages.get", {
-        "DIALOG_ID": dialog_id,
-        "LIMIT": int(limit),
-        "SORT": "DESC"
-    })
+    data = _post("im.dialog.messages.get", openlines_messages_params(dialog_id, limit))
     res = data.get("result") or {}
     # Нормализуем
     return {
@@ -227,10 +754,42 @@ def get_last_openlines_message(dialog_id: str) -> tuple[dict, dict] | None:
         return None
     return msgs[0], (payload.get("users") or {})
 
+# ---------------------------
+#  Пользователи портала (user.get постранично)
+# ---------------------------
+def list_users(flt: dict | None = None) -> t.List[dict]:
+    result: t.List[dict] = []
+    start: t.Any = 0
+    while True:
+        data = _post("user.get", {"FILTER": flt or {}, "start": start})
+        result.extend(data.get("result", []) or [])
+        next_start = data.get("next")
+        if next_start is None:
+            return result
+        start = next_start
+
 __all__ = [
+    "BitrixError",
     "b24",
+    "batch",
     "list_activities",
+    "iter_activities",
+    "list_activities_sliced",
+    "time_slices",
+    "parallel_map",
     "list_calls_since",
+    "list_call_log",
+    "call_log_methods",
+    "call_log_status",
+    "operating_usage",
+    "probe_call_methods",
+    "report_call_method",
+    "filter_calls_by_entity",
+    "call_entity_type_id",
+    "error_kind",
+    "CRM_TYPE_NAMES",
+    "openlines_messages_params",
     "get_last_openlines_messages",
     "get_last_openlines_message",
+    "list_users",
 ]
@@ -0,0 +1,164 @@
+# dialogs.py — кэш последних сообщений диалогов ОЛ и справочник сотрудников портала
+from __future__ import annotations
+
+import os
+import threading
+import time
+import typing as t
+
+from bitrix import batch, get_last_openlines_messages, list_users, openlines_messages_params
+from cache import TTLCache
+
+DIALOG_CACHE_SIZE = int(os.getenv("DIALOG_CACHE_SIZE", "5000"))
+DIALOG_CACHE_TTL = float(os.getenv("DIALOG_CACHE_TTL", "600"))
+USER_DIRECTORY_TTL = float(os.getenv("USER_DIRECTORY_TTL", "3600"))
+
+# dialog_id -> {"marker": ..., "lm": (message, users) | None}
+_dialogs = TTLCache(DIALOG_CACHE_SIZE, DIALOG_CACHE_TTL)
+
+LastMessage = t.Optional[t.Tuple[dict, dict]]
+
+
+# ---------------------------
+#  Последнее сообщение диалога
+# ---------------------------
+def _normalize_users(users: t.Any) -> dict:
+    """users из im.* бывает и словарём {id: user}, и списком [{id: ...}]."""
+    if isinstance(users, dict):
+        return {str(k): v for k, v in users.items()}
+    if isinstance(users, list):
+        return {str(u.get("id") or u.get("ID")): u for u in users if isinstance(u, dict)}
+    return {}
+
+
+def _last_message(payload: t.Any) -> LastMessage:
+    if not isinstance(payload, dict):
+        return None
+    msgs = payload.get("messages") or []
+    if not msgs:
+        return None
+    return msgs[0], _normalize_users(payload.get("users"))
+
+
+def _cached(dialog_id: str, marker: str | None) -> tuple[bool, LastMessage]:
+    """
+    marker — отпечаток того, что мы знаем о диалоге со стороны CRM (ID/изменение активности).
+    Сменился маркер — в диалоге что-то новое, кэш не годится.
+    """
+    entry = _dialogs.get(dialog_id)
+    if entry is None or (marker is not None and entry["marker"] != marker):
+        return False, None
+    return True, entry["lm"]
+
+
+def _remember(dialog_id: str, lm: LastMessage, marker: str | None) -> None:
+    _dialogs.set(dialog_id, {"marker": marker, "lm": lm})
+
+
+def get_last_message(dialog_id: str, marker: str | None = None) -> LastMessage:
+    hit, lm = _cached(dialog_id, marker)
+    if hit:
+        return lm
+    lm = _last_message(get_last_openlines_messages(dialog_id, limit=1))
+    _remember(dialog_id, lm, marker)
+    return lm
+
+
+def get_last_messages(markers: t.Mapping[str, str | None]) -> t.Dict[str, LastMessage]:
+    """
+    {dialog_id: marker} -> {dialog_id: (message, users) | None}.
+    Промахи кэша запрашиваются одним batch; диалоги, по которым запрос упал, в ответ не попадают.
+    """
+    out: t.Dict[str, LastMessage] = {}
+    misses: t.List[str] = []
+    for dialog_id, marker in markers.items():
+        hit, lm = _cached(dialog_id, marker)
+        if hit:
+            out[dialog_id] = lm
+        else:
+            misses.append(dialog_id)
+
+    if misses:
+        res = batch({
+            f"d{i}": ("im.dialog.messages.get", openlines_messages_params(d))
+            for i, d in enumerate(misses)
+        })
+        for i, d in enumerate(misses):
+            r = res.get(f"d{i}") or {}
+            if "error" in r:
+                continue
+            lm = _last_message(r.get("result"))
+            _remember(d, lm, markers[d])
+            out[d] = lm
+    return out
+
+
+def invalidate(dialog_id: str, message_id: t.Any = None) -> None:
+    """Новое сообщение в диалоге: кэш сбрасывается, если это не то сообщение, что уже в кэше."""
+    if message_id is not None:
+        entry = _dialogs.get(dialog_id)
+        lm = entry["lm"] if entry else None
+        if lm and str(lm[0].get("id") or lm[0].get("ID") or "") == str(message_id):
+            return
+    _dialogs.pop(dialog_id)
+
+
+# ---------------------------
+#  Справочник сотрудников (user.get одним проходом, с TTL)
+# ---------------------------
+_directory_lock = threading.Lock()
+_directory: t.Dict[str, dict] | None = None
+_directory_loaded_at = 0.0
+
+
+def user_directory() -> t.Dict[str, dict] | None:
+    """{id: пользователь} по сотрудникам портала; None — справочник загрузить не удалось."""
+    global _directory, _directory_loaded_at
+    with _directory_lock:
+        if _directory is None or time.time() - _directory_loaded_at >= USER_DIRECTORY_TTL:
+            try:
+                users = list_users({"USER_TYPE": "employee"})
+                _directory = {str(u.get("ID")): u for u in users if u.get("ID")}
+            except RuntimeError as e:
+                print(f"[DIALOGS] user.get failed: {e}")
+                if _directory is None:
+                    _directory_loaded_at = time.time()  # не долбим портал на каждом сообщении
+                    return None
+            _directory_loaded_at = time.time()
+        return _directory
+
+
+def is_manager(author_id: t.Any, users: t.Any = None) -> bool:
+    """
+    Автор сообщения — сотрудник портала (а не клиент из коннектора/гость)?
+    Сначала флаги пользователя из ответа im.*, затем справочник сотрудников.
+    """
+    author = str(author_id or "")
+    if author in ("", "0"):
+        return False
+    u = _normalize_users(users).get(author)
+    if isinstance(u, dict):
+        if u.get("connector") or u.get("extranet") or u.get("network"):
+            return False
+        if u.get("bot"):
+            return True
+    directory = user_directory()
+    if directory is not None:
+        return author in directory
+    return isinstance(u, dict)
+
+
+def stats() -> dict:
+    with _directory_lock:
+        employees = len(_directory) if _directory is not None else None
+    return {"dialogs": _dialogs.stats(), "employees": employees}
+
+
+__all__ = [
+    "get_last_message",
+    "get_last_messages",
+    "invalidate",
+    "user_directory",
+    "is_manager",
+    "stats",
+]
@@ -0,0 +1,175 @@
+# enrichment.py — название сущности, ответственный и ссылка на карточку для тревог дайджеста
+from __future__ import annotations
+
+import os
+import re
+import threading
+import typing as t
+
+import metrics
+from bitrix import CRM_TYPE_NAMES, batch, error_kind
+from cache import TTLCache
+
+# Названия и ответственные по сущностям тревог: одним batch на все сущности
+# (ID-in запросы по 50 штук на команду), результат держится в памяти
+ENRICH_ALERTS = os.getenv("ENRICH_ALERTS", "1") == "1"
+ENRICH_CACHE_TTL = float(os.getenv("ENRICH_CACHE_TTL", "3600"))
+ENRICH_CACHE_SIZE = int(os.getenv("ENRICH_CACHE_SIZE", "20000"))
+
+_PAGE = 50  # строк на страницу у *.list — столько ID помещается в одну команду
+
+ENRICH_LOOKUPS = metrics.counter("enrich_lookups_total", "Сущности тревог: из кэша или запросом", ["result"])
+
+_cache = TTLCache(ENRICH_CACHE_SIZE, ENRICH_CACHE_TTL)
+_lock = threading.Lock()
+# crm.item.list есть не на всех порталах (коробки старых версий) — тогда crm.{lead,deal,...}.list
+_legacy = False
+
+Key = t.Tuple[str, str]
+
+
+def portal_url() -> str:
+    """https://host портала из B24_WEBHOOK (https://host/rest/1/token/)."""
+    webhook = (os.getenv("B24_WEBHOOK") or "").strip()
+    m = re.match(r"^(https?://[^/]+)", webhook)
+    return m.group(1) if m else ""
+
+
+def entity_url(owner_type_id: str, owner_id: str) -> str:
+    name = CRM_TYPE_NAMES.get(str(owner_type_id))
+    base = portal_url()
+    if not base:
+        return ""
+    if name:
+        return f"{base}/crm/{name.lower()}/details/{owner_id}/"
+    return f"{base}/crm/type/{owner_type_id}/details/{owner_id}/"
+
+
+def _command(etype: str, ids: t.List[str], legacy: bool) -> tuple[str, dict]:
+    name = CRM_TYPE_NAMES.get(etype)
+    if legacy and name:
+        return f"crm.{name.lower()}.list", {
+            "filter": {"ID": ids},
+            "select": ["ID", "TITLE", "NAME", "LAST_NAME", "ASSIGNED_BY_ID"],
+            "start": -1,
+        }
+    return "crm.item.list", {
+        "entityTypeId": int(etype),
+        "filter": {"@id": ids},
+        "select": ["id", "title", "name", "lastName", "assignedById"],
+        "start": -1,
+    }
+
+
+def _rows(result: t.Any) -> t.List[dict]:
+    """crm.item.list -> {"items": [...]}, crm.*.list -> [...]."""
+    if isinstance(result, dict):
+        result = result.get("items")
+    return [r for r in (result or []) if isinstance(r, dict)]
+
+
+def _info(row: t.Mapping[str, t.Any]) -> tuple[str, dict]:
+    def f(*names: str) -> str:
+        for n in names:
+            if row.get(n):
+                return str(row[n]).strip()
+        return ""
+
+    title = f("title", "TITLE")
+    if not title:  # у контактов названия нет — имя и фамилия
+        title = " ".join(x for x in (f("name", "NAME"), f("lastName", "LAST_NAME")) if x)
+    return f("id", "ID"), {"title": title, "responsible_id": f("assignedById", "ASSIGNED_BY_ID")}
+
+
+def _lookup(keys: t.Iterable[Key]) -> t.Dict[Key, dict]:
+    """
+    Сущности, которых нет в кэше: ID-in запросы по типам, все команды — одним batch.
+    Сущность, которой нет в ответе (удалена), получает пустые поля; группы с ошибкой пропускаются.
+    """
+    global _legacy
+    by_type: t.Dict[str, t.List[str]] = {}
+    for etype, eid in keys:
+        by_type.setdefault(etype, []).append(eid)
+
+    groups = {
+        f"e{etype}_{i}": (etype, ids[i:i + _PAGE])
+        for etype, ids in by_type.items()
+        for i in range(0, len(ids), _PAGE)
+    }
+    found: t.Dict[Key, dict] = {}
+    pending = dict(groups)
+    while pending:
+        legacy = _legacy
+        results = batch({k: _command(etype, ids, legacy) for k, (etype, ids) in pending.items()})
+        retry = {}
+        for k, (etype, ids) in pending.items():
+            r = results.get(k) or {}
+            if r.get("error"):
+                if (not legacy and error_kind(str(r["error"])) == "permanent"
+                        and etype in CRM_TYPE_NAMES):
+                    retry[k] = (etype, ids)
+                else:
+                    print(f"[ENRICH] {etype}: {r['error']} {r.get('error_description') or ''}")
+                continue
+            for eid in ids:
+                found.setdefault((etype, eid), {"title": "", "responsible_id": ""})
+            for row in _rows(r.get("result")):
+                eid, info = _info(row)
+                if eid:
+                    found[(etype, eid)] = info
+        if retry and not legacy:
+            _legacy = True
+            print("[ENRICH] crm.item.list недоступен — запросы через crm.*.list")
+        pending = retry
+    return found
+
+
+def _user_name(users: t.Mapping[str, dict] | None, user_id: str) -> str:
+    u = (users or {}).get(user_id)
+    if not u:
+        return ""
+    return " ".join(str(u.get(k) or "").strip() for k in ("NAME", "LAST_NAME") if u.get(k)).strip()
+
+
+def enrich(alerts: t.List[dict]) -> t.List[dict]:
+    """
+    Дополняет тревоги полями title, responsible_id, responsible_name и url (на месте).
+    Сущности из кэша не запрашиваются; остальные — несколько ID-in запросов в одном batch.
+    Ошибка Битрикса не мешает дайджесту: тревоги уходят без названий.
+    """
+    if not alerts or not ENRICH_ALERTS:
+        return alerts
+    keys = {(str(a["owner_type_id"]), str(a["owner_id"])) for a in alerts}
+    with _lock:
+        known = {k: _cache.get(k) for k in keys}
+        missing = [k for k, v in known.items() if v is None]
+        ENRICH_LOOKUPS.inc(len(keys) - len(missing), result="cache")
+        if missing:
+            ENRICH_LOOKUPS.inc(len(missing), result="fetch")
+            try:
+                found = _lookup(missing)
+            except RuntimeError as e:
+                print(f"[ENRICH] lookup failed: {e}")
+                found = {}
+            # удалённую сущность тоже запоминаем, чтобы не спрашивать о ней каждый скан
+            for k, info in found.items():
+                known[k] = info
+                _cache.set(k, info)
+
+    from dialogs import user_directory
+    users = user_directory() if any(v and v["responsible_id"] for v in known.values()) else None
+    for a in alerts:
+        key = (str(a["owner_type_id"]), str(a["owner_id"]))
+        info = known.get(key) or {}
+        a["title"] = info.get("title") or ""
+        a["responsible_id"] = info.get("responsible_id") or ""
+        a["responsible_name"] = _user_name(users, a["responsible_id"])
+        a["url"] = entity_url(*key)
+    return alerts
+
+
+def stats() -> dict:
+    return {"cache": _cache.stats(), "legacy_list": _legacy}
+
+
+__all__ = ["ENRICH_ALERTS", "enrich", "entity_url", "portal_url", "stats"]
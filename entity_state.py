@@ -0,0 +1,243 @@
+# entity_state.py — состояние «ждёт ответа с ...» по сущностям CRM (обновляется событиями Битрикса)
+from __future__ import annotations
+
+import time
+import typing as t
+from datetime import datetime, timezone
+
+from storage import ensure_schema, get_state, set_state, transaction
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS entity_state (
+    owner_type_id TEXT NOT NULL,
+    owner_id      TEXT NOT NULL,
+    awaiting_since_ts REAL,          -- первое неотвеченное входящее (NULL — ответ есть)
+    last_in_ts    REAL,              -- последнее входящее
+    last_in_raw   TEXT,
+    activity_id   TEXT,
+    provider_id   TEXT,
+    phone         TEXT,
+    subject       TEXT,
+    dialog_id     TEXT,
+    last_reply_ts REAL,              -- последний ответ менеджера (сообщение или звонок)
+    overdue_ts    REAL,              -- когда подтвердили просрочку SLA (sla_timers.py)
+    updated_ts    REAL NOT NULL,
+    PRIMARY KEY (owner_type_id, owner_id)
+);
+CREATE INDEX IF NOT EXISTS entity_state_awaiting ON entity_state(awaiting_since_ts);
+CREATE INDEX IF NOT EXISTS entity_state_dialog ON entity_state(dialog_id);
+"""
+
+_SEEDED_KEY = "entity_state.seeded"
+
+
+def _ensure() -> None:
+    ensure_schema("entity_state", _DDL)
+
+
+def mark_incoming(
+    owner_type_id: str,
+    owner_id: str,
+    ts: float,
+    *,
+    created_raw: str = "",
+    activity_id: str = "",
+    provider_id: str = "",
+    phone: str | None = None,
+    subject: str = "",
+    dialog_id: str = "",
+) -> bool:
+    """
+    Входящее от клиента в момент ts. Идемпотентно и не зависит от порядка событий:
+    входящее не раньше уже известного ответа ничего не меняет.
+    Возвращает True, если сущность теперь ждёт ответа.
+    """
+    _ensure()
+    key = (str(owner_type_id), str(owner_id))
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT * FROM entity_state WHERE owner_type_id = ? AND owner_id = ?", key
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO entity_state(owner_type_id, owner_id, awaiting_since_ts, last_in_ts, "
+                "last_in_raw, activity_id, provider_id, phone, subject, dialog_id, updated_ts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, ts, ts, created_raw, activity_id, provider_id, phone, subject, dialog_id, time.time()),
+            )
+            return True
+
+        if row["last_reply_ts"] is not None and row["last_reply_ts"] >= ts:
+            return False  # ответ уже был после этого входящего (событие пришло с опозданием)
+
+        awaiting_since = row["awaiting_since_ts"]
+        awaiting_since = ts if awaiting_since is None else min(awaiting_since, ts)
+        if row["last_in_ts"] is not None and row["last_in_ts"] > ts:
+            # более старое входящее — детали последнего не трогаем
+            conn.execute(
+                "UPDATE entity_state SET awaiting_since_ts = ?, updated_ts = ?, "
+                "overdue_ts = CASE WHEN awaiting_since_ts = ? THEN overdue_ts END "
+                "WHERE owner_type_id = ? AND owner_id = ?",
+                (awaiting_since, time.time(), awaiting_since, *key),
+            )
+            return True
+        # Сообщение ОЛ без активности не несёт деталей — оставляем известные
+        conn.execute(
+            "UPDATE entity_state SET awaiting_since_ts = ?, last_in_ts = ?, "
+            "last_in_raw = NULLIF(?, ''), "
+            "activity_id = COALESCE(NULLIF(?, ''), activity_id), "
+            "provider_id = COALESCE(NULLIF(?, ''), provider_id), "
+            "phone = COALESCE(?, phone), "
+            "subject = COALESCE(NULLIF(?, ''), subject), "
+            "dialog_id = COALESCE(NULLIF(?, ''), dialog_id), updated_ts = ?, "
+            # новый отсчёт SLA — прежняя отметка о просрочке не действует
+            "overdue_ts = CASE WHEN awaiting_since_ts = ? THEN overdue_ts END "
+            "WHERE owner_type_id = ? AND owner_id = ?",
+            (awaiting_since, ts, created_raw, activity_id, provider_id, phone, subject,
+             dialog_id, time.time(), awaiting_since, *key),
+        )
+        return True
+
+
+def mark_replied(owner_type_id: str, owner_id: str, ts: float) -> bool:
+    """
+    Ответ менеджера в момент ts (сообщение, последнее сообщение диалога или звонок).
+    Снимает ожидание, если ответ не раньше последнего входящего. Возвращает True, если снял.
+    """
+    _ensure()
+    key = (str(owner_type_id), str(owner_id))
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT last_in_ts, last_reply_ts, awaiting_since_ts FROM entity_state "
+            "WHERE owner_type_id = ? AND owner_id = ?", key
+        ).fetchone()
+        if row is None:
+            conn.execute(
+                "INSERT INTO entity_state(owner_type_id, owner_id, last_reply_ts, updated_ts) "
+                "VALUES (?, ?, ?, ?)",
+                (*key, ts, time.time()),
+            )
+            return False
+
+        last_reply = max(ts, row["last_reply_ts"] or ts)
+        awaiting = row["awaiting_since_ts"]
+        cleared = False
+        if awaiting is not None and row["last_in_ts"] is not None:
+            if ts >= row["last_in_ts"]:
+                awaiting, cleared = None, True
+            elif ts >= awaiting:
+                # ответили на часть сообщений — ждём ответа на последнее
+                awaiting = row["last_in_ts"]
+        conn.execute(
+            "UPDATE entity_state SET awaiting_since_ts = ?, last_reply_ts = ?, updated_ts = ?, "
+            "overdue_ts = CASE WHEN awaiting_since_ts = ? THEN overdue_ts END "
+            "WHERE owner_type_id = ? AND owner_id = ?",
+            (awaiting, last_reply, time.time(), awaiting, *key),
+        )
+        return cleared
+
+
+def entity_for_dialog(dialog_id: str) -> tuple[str, str] | None:
+    _ensure()
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT owner_type_id, owner_id FROM entity_state WHERE dialog_id = ? "
+            "ORDER BY updated_ts DESC LIMIT 1",
+            (dialog_id,),
+        ).fetchone()
+    return (row["owner_type_id"], row["owner_id"]) if row else None
+
+
+def get(owner_type_id: str, owner_id: str) -> dict | None:
+    _ensure()
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT * FROM entity_state WHERE owner_type_id = ? AND owner_id = ?",
+            (str(owner_type_id), str(owner_id)),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def mark_overdue(owner_type_id: str, owner_id: str, ts: float) -> None:
+    """Просрочка SLA подтверждена (нужна, чтобы не сообщать о ней повторно)."""
+    _ensure()
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE entity_state SET overdue_ts = ? WHERE owner_type_id = ? AND owner_id = ? "
+            "AND awaiting_since_ts IS NOT NULL",
+            (ts, str(owner_type_id), str(owner_id)),
+        )
+
+
+def pending_deadlines() -> t.List[tuple[str, str, float]]:
+    """(тип, ID, ждёт с) по сущностям, просрочка которых ещё не подтверждена."""
+    _ensure()
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT owner_type_id, owner_id, awaiting_since_ts FROM entity_state "
+            "WHERE awaiting_since_ts IS NOT NULL AND overdue_ts IS NULL"
+        ).fetchall()
+    return [(r["owner_type_id"], r["owner_id"], r["awaiting_since_ts"]) for r in rows]
+
+
+def awaiting(min_age_sec: float = 0, now: float | None = None) -> t.List[dict]:
+    """
+    Сущности, у которых последнее входящее без ответа старше min_age_sec —
+    в формате тревог detect_alerts, новые первыми.
+    """
+    _ensure()
+    now = time.time() if now is None else now
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT * FROM entity_state WHERE awaiting_since_ts IS NOT NULL AND last_in_ts <= ? "
+            "ORDER BY last_in_ts DESC",
+            (now - min_age_sec,),
+        ).fetchall()
+    return [as_alert(r) for r in rows]
+
+
+def as_alert(r: t.Mapping[str, t.Any]) -> dict:
+    """Строка entity_state -> тревога в формате detect_alerts."""
+    return {
+        "owner_type_id": r["owner_type_id"],
+        "owner_id": r["owner_id"],
+        "last_in_created": r["last_in_raw"]
+        or datetime.fromtimestamp(r["last_in_ts"], timezone.utc).isoformat(),
+        "provider_id": r["provider_id"],
+        "phone": r["phone"],
+        "activity_id": r["activity_id"],
+        "subject": r["subject"] or "",
+        "awaiting_since": datetime.fromtimestamp(r["awaiting_since_ts"], timezone.utc).isoformat(),
+    }
+
+
+def is_seeded() -> bool:
+    return get_state(_SEEDED_KEY) is not None
+
+
+def mark_seeded() -> None:
+    set_state(_SEEDED_KEY, str(time.time()))
+
+
+def stats() -> dict:
+    _ensure()
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT COUNT(*) AS n, SUM(awaiting_since_ts IS NOT NULL) AS waiting FROM entity_state"
+        ).fetchone()
+    return {"entities": row["n"], "awaiting": row["waiting"] or 0, "seeded": is_seeded()}
+
+
+__all__ = [
+    "mark_incoming",
+    "mark_replied",
+    "get",
+    "mark_overdue",
+    "pending_deadlines",
+    "entity_for_dialog",
+    "awaiting",
+    "as_alert",
+    "is_seeded",
+    "mark_seeded",
+    "stats",
+]
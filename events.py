@@ -0,0 +1,284 @@
+# events.py — приём событий Битрикса (/bitrix/events): очередь, дедупликация, обновление entity_state
+from __future__ import annotations
+
+import json
+import os
+import queue
+import re
+import threading
+import time
+import typing as t
+from urllib.parse import parse_qsl
+
+import activity_store
+import dialogs
+import entity_state
+import sla_timers
+from bitrix import batch
+from storage import ensure_schema, transaction
+from logic import (
+    TRACK_ENTITY_TYPES,
+    as_upper,
+    call_activity_succeeded,
+    communications_first_phone,
+    extract_dialog_id,
+    is_message_activity,
+    parse_b24_iso,
+)
+
+# application_token из настроек исходящего вебхука/приложения; пусто — не проверяем
+B24_APP_TOKEN = os.getenv("B24_APP_TOKEN") or ""
+# Сколько событий забираем из очереди за раз (одним batch crm.activity.get)
+EVENTS_BATCH = int(os.getenv("EVENTS_BATCH", "50"))
+# Сколько дней помним обработанные события (для идемпотентности повторных доставок)
+EVENTS_DEDUP_DAYS = int(os.getenv("EVENTS_DEDUP_DAYS", "3"))
+
+ACTIVITY_EVENTS = {"ONCRMACTIVITYADD", "ONCRMACTIVITYUPDATE"}
+ACTIVITY_DELETE_EVENTS = {"ONCRMACTIVITYDELETE"}
+OPENLINES_EVENTS = {"ONOPENLINEMESSAGEADD", "ONIMOPENLINESMESSAGEADD"}
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS events_seen (
+    key         TEXT PRIMARY KEY,
+    received_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_seen_received ON events_seen(received_ts);
+"""
+
+_queue: "queue.Queue[dict]" = queue.Queue()
+_worker: threading.Thread | None = None
+_worker_lock = threading.Lock()
+_counters = {"received": 0, "duplicates": 0, "processed": 0, "failed": 0, "rejected": 0}
+_counters_lock = threading.Lock()
+
+
+def _count(name: str, n: int = 1) -> None:
+    with _counters_lock:
+        _counters[name] += n
+
+
+# ---------------------------
+#  Разбор тела запроса
+# ---------------------------
+def _unflatten(pairs: t.Iterable[tuple[str, str]]) -> dict:
+    """data[FIELDS][ID]=1 -> {"data": {"FIELDS": {"ID": "1"}}} (как parse_str в PHP)."""
+    out: dict = {}
+    for key, value in pairs:
+        parts = re.findall(r"[^\[\]]+", key)
+        if not parts:
+            continue
+        cur = out
+        for p in parts[:-1]:
+            nxt = cur.get(p)
+            if not isinstance(nxt, dict):
+                nxt = cur[p] = {}
+            cur = nxt
+        cur[parts[-1]] = value
+    return out
+
+
+def parse_payload(body: bytes, content_type: str) -> dict:
+    """Битрикс шлёт события формой (application/x-www-form-urlencoded); JSON тоже принимаем."""
+    if "json" in (content_type or "").lower():
+        data = json.loads(body or b"{}")
+        return data if isinstance(data, dict) else {}
+    return _unflatten(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
+
+
+def _event_key(payload: dict) -> str:
+    event = as_upper(payload.get("event"))
+    data = payload.get("data") or {}
+    fields = data.get("FIELDS") or {}
+    ident = fields.get("ID") or json.dumps(data, sort_keys=True, ensure_ascii=False)
+    return f"{event}:{ident}:{payload.get('ts') or ''}"
+
+
+# ---------------------------
+#  Приём: проверка и постановка в очередь (быстрый ответ Битриксу)
+# ---------------------------
+def accept(payload: dict) -> dict:
+    token = ((payload.get("auth") or {}).get("application_token")) or ""
+    if B24_APP_TOKEN and token != B24_APP_TOKEN:
+        _count("rejected")
+        return {"result": "rejected"}
+
+    event = as_upper(payload.get("event"))
+    if event not in ACTIVITY_EVENTS | ACTIVITY_DELETE_EVENTS | OPENLINES_EVENTS:
+        return {"result": "ignored", "event": event}
+
+    _count("received")
+    _queue.put(payload)
+    start()
+    return {"result": "ok", "queued": True}
+
+
+def start() -> None:
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="bitrix-events", daemon=True)
+            _worker.start()
+
+
+def stats() -> dict:
+    with _counters_lock:
+        return {**_counters, "queued": _queue.qsize()}
+
+
+# ---------------------------
+#  Обработка
+# ---------------------------
+def _unseen(keys: t.List[str]) -> t.Set[str]:
+    ensure_schema("events_seen", _DDL)
+    with transaction() as conn:
+        seen = {
+            r["key"] for r in conn.execute(
+                f"SELECT key FROM events_seen WHERE key IN ({','.join('?' * len(keys))})", keys
+            )
+        }
+    return set(keys) - seen
+
+
+def _remember(keys: t.Iterable[str]) -> None:
+    """Отмечаем события обработанными только после применения — повторная доставка не потеряется."""
+    now = time.time()
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO events_seen(key, received_ts) VALUES (?, ?)", [(k, now) for k in keys]
+        )
+        conn.execute(
+            "DELETE FROM events_seen WHERE received_ts < ?", (now - EVENTS_DEDUP_DAYS * 86400,)
+        )
+
+
+def _apply_activity(row: dict) -> None:
+    etype, eid = str(row.get("OWNER_TYPE_ID") or ""), str(row.get("OWNER_ID") or "")
+    if etype not in TRACK_ENTITY_TYPES or not eid:
+        return
+    ts = parse_b24_iso(str(row.get("CREATED"))).timestamp()
+    direction = str(row.get("DIRECTION") or "")
+    prov = as_upper(row.get("PROVIDER_ID"))
+
+    if prov in ("VOXIMPLANT_CALL", "CALL"):
+        if call_activity_succeeded(row):
+            entity_state.mark_replied(etype, eid, ts)
+            sla_timers.refresh(etype, eid)
+        return
+    if not is_message_activity(row):
+        return
+    if direction == "2":
+        entity_state.mark_incoming(
+            etype, eid, ts,
+            created_raw=str(row.get("CREATED") or ""),
+            activity_id=str(row.get("ID") or ""),
+            provider_id=str(row.get("PROVIDER_ID") or ""),
+            phone=communications_first_phone(row.get("COMMUNICATIONS")),
+            subject=str(row.get("SUBJECT") or ""),
+            dialog_id=str(extract_dialog_id(row) or ""),
+        )
+    elif direction == "1":
+        entity_state.mark_replied(etype, eid, ts)
+    else:
+        return
+    # дедлайн SLA: новое входящее его ставит, ответ снимает
+    sla_timers.refresh(etype, eid)
+
+
+def _apply_openlines_message(payload: dict) -> None:
+    """
+    Сообщение в открытой линии. Сущность ищем по DIALOG_ID, который запомнили
+    из входящих активностей; автор — оператор, если он не пользователь коннектора.
+    """
+    data = payload.get("data") or {}
+    msg = data.get("MESSAGE") or data.get("message") or {}
+    chat = data.get("CHAT") or data.get("chat") or {}
+    user = data.get("USER") or data.get("user") or {}
+    dialog_id = str(
+        data.get("DIALOG_ID") or chat.get("DIALOG_ID") or chat.get("dialog_id") or ""
+    )
+    if not dialog_id:
+        return
+    dialogs.invalidate(dialog_id, msg.get("ID") or msg.get("id"))
+    entity = entity_state.entity_for_dialog(dialog_id)
+    if entity is None:
+        return
+
+    ts = float(payload.get("ts") or time.time())
+    author_id = str(msg.get("AUTHOR_ID") or msg.get("author_id") or user.get("ID") or user.get("id") or "0")
+    from_client = (
+        author_id in ("", "0")
+        or str(user.get("CONNECTOR") or user.get("connector") or "").upper() in ("Y", "1", "TRUE")
+    )
+    if from_client:
+        entity_state.mark_incoming(*entity, ts, dialog_id=dialog_id)
+    else:
+        entity_state.mark_replied(*entity, ts)
+    sla_timers.refresh(*entity)
+
+
+def _process(events: t.List[dict]) -> None:
+    keys = [_event_key(e) for e in events]
+    fresh = _unseen(keys)
+    # повтор внутри одной пачки тоже дубликат
+    pending: t.Dict[str, dict] = {}
+    for e, k in zip(events, keys):
+        if k in fresh and k not in pending:
+            pending[k] = e
+    _count("duplicates", len(events) - len(pending))
+    events = list(pending.values())
+
+    # Поля активностей — одним batch на всю пачку событий
+    ids = sorted({
+        str(((e.get("data") or {}).get("FIELDS") or {}).get("ID") or "")
+        for e in events
+        if as_upper(e.get("event")) in ACTIVITY_EVENTS
+    } - {""})
+    res = batch({f"a{i}": ("crm.activity.get", {"id": i}) for i in ids}) if ids else {}
+
+    done = []
+    for k, e in pending.items():
+        event = as_upper(e.get("event"))
+        try:
+            if event in ACTIVITY_EVENTS:
+                i = str(((e.get("data") or {}).get("FIELDS") or {}).get("ID") or "")
+                got = res.get(f"a{i}") or {}
+                if "error" in got:
+                    raise RuntimeError(f"crm.activity.get {i}: {got['error']} {got.get('error_description') or ''}")
+                row = got.get("result")
+                if isinstance(row, dict):
+                    _apply_activity(row)
+            elif event in OPENLINES_EVENTS:
+                _apply_openlines_message(e)
+            elif event in ACTIVITY_DELETE_EVENTS:
+                # из зеркала активностей — сразу, не дожидаясь сверки; удалённое входящее в entity_state
+                # не снимаем — ответа на него всё равно не было
+                i = str(((e.get("data") or {}).get("FIELDS") or {}).get("ID") or "")
+                if i.isdigit():
+                    activity_store.forget([i])
+            _count("processed")
+            done.append(k)
+        except Exception as exc:  # одно кривое событие не останавливает очередь и не отмечается — повтор примем
+            _count("failed")
+            print(f"[EVENTS] {event}: {exc}")
+    _remember(done)
+
+
+def _run() -> None:
+    while True:
+        events = [_queue.get()]
+        while len(events) < EVENTS_BATCH:
+            try:
+                events.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _process(events)
+        except Exception as exc:  # например, Битрикс недоступен: пачка не отмечена, повтор доставки примем
+            _count("failed", len(events))
+            print(f"[EVENTS] batch failed: {exc}")
+        finally:
+            for _ in events:
+                _queue.task_done()
+
+
+__all__ = ["parse_payload", "accept", "start", "stats"]
@@ -0,0 +1,313 @@
+# history.py — история сканов и тревог в SQLite: просмотр и тренды без запросов к Bitrix
+from __future__ import annotations
+
+import os
+import time
+import typing as t
+from datetime import datetime
+
+from storage import ensure_schema, transaction
+
+# Сколько дней хранить сканы и тревоги
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "90"))
+HISTORY_PAGE_MAX = 500
+
+# История пишется процессом сервиса (ScanManager, sla_timers) — для всех порталов в одну базу
+_DDL = """
+CREATE TABLE IF NOT EXISTS history_scans (
+    scan_id      TEXT PRIMARY KEY,
+    portal       TEXT NOT NULL,
+    trigger      TEXT NOT NULL,      -- manual / schedule / sla
+    status       TEXT NOT NULL,      -- done / failed
+    started_ts   REAL NOT NULL,
+    finished_ts  REAL NOT NULL,
+    alerts_count INTEGER NOT NULL,
+    error        TEXT
+);
+CREATE INDEX IF NOT EXISTS history_scans_portal_ts ON history_scans(portal, finished_ts);
+
+CREATE TABLE IF NOT EXISTS history_alerts (
+    id               INTEGER PRIMARY KEY,
+    scan_id          TEXT NOT NULL,
+    portal           TEXT NOT NULL,
+    scan_ts          REAL NOT NULL,
+    owner_type_id    TEXT NOT NULL,
+    owner_id         TEXT NOT NULL,
+    activity_id      TEXT,
+    provider_id      TEXT,
+    last_in_created  TEXT,
+    phone            TEXT,
+    subject          TEXT,
+    title            TEXT,
+    responsible_id   TEXT,
+    responsible_name TEXT,
+    url              TEXT,
+    UNIQUE (scan_id, owner_type_id, owner_id)
+);
+CREATE INDEX IF NOT EXISTS history_alerts_ts ON history_alerts(portal, scan_ts);
+CREATE INDEX IF NOT EXISTS history_alerts_entity ON history_alerts(portal, owner_type_id, owner_id, scan_ts);
+CREATE INDEX IF NOT EXISTS history_alerts_provider ON history_alerts(portal, provider_id, scan_ts);
+CREATE INDEX IF NOT EXISTS history_alerts_responsible ON history_alerts(portal, responsible_id, scan_ts);
+
+-- итог проверки каждого кандидата скана, а не только тревоги: почему сущность не попала в дайджест
+CREATE TABLE IF NOT EXISTS history_verdicts (
+    scan_id       TEXT NOT NULL,
+    portal        TEXT NOT NULL,
+    scan_ts       REAL NOT NULL,
+    owner_type_id TEXT NOT NULL,
+    owner_id      TEXT NOT NULL,
+    provider_id   TEXT NOT NULL,      -- канал последнего входящего
+    in_ts         REAL NOT NULL,      -- время последнего входящего, к которому относится итог
+    activity_id   TEXT,
+    outcome       TEXT NOT NULL,      -- replied / operator_last / called / unanswered
+    evidence      TEXT,               -- ID ответа или звонка, если известен
+    cached        INTEGER NOT NULL,   -- итог взят из кэша прошлых сканов (verdicts.py)
+    PRIMARY KEY (scan_id, owner_type_id, owner_id, provider_id, in_ts)
+);
+CREATE INDEX IF NOT EXISTS history_verdicts_ts ON history_verdicts(portal, scan_ts);
+CREATE INDEX IF NOT EXISTS history_verdicts_entity ON history_verdicts(portal, owner_type_id, owner_id, scan_ts);
+"""
+
+_ALERT_FIELDS = (
+    "activity_id", "provider_id", "last_in_created", "phone", "subject",
+    "title", "responsible_id", "responsible_name", "url",
+)
+
+# Разрезы трендов: group_by -> колонка
+_DIMENSIONS = {"provider": "provider_id", "responsible": "responsible_id", "entity_type": "owner_type_id"}
+
+_last_prune = 0.0
+
+
+def _schema() -> None:
+    ensure_schema("history", _DDL)
+
+
+def record(
+    scan_id: str,
+    portal: str,
+    trigger: str,
+    started_ts: float,
+    finished_ts: float,
+    alerts: t.Sequence[t.Mapping[str, t.Any]] | None,
+    error: str | None = None,
+    verdicts: t.Sequence[t.Mapping[str, t.Any]] | None = None,
+) -> None:
+    """
+    Скан, его тревоги (alerts=None — скан упал) и итоги проверки кандидатов (logic.scan_verdicts).
+    Повторная запись того же скана заменяет прежнюю.
+    """
+    global _last_prune
+    _schema()
+    rows = [
+        (
+            scan_id, portal, finished_ts, str(a["owner_type_id"]), str(a["owner_id"]),
+            *(None if a.get(f) is None else str(a.get(f)) for f in _ALERT_FIELDS),
+        )
+        for a in alerts or ()
+    ]
+    verdict_rows = [
+        (
+            scan_id, portal, finished_ts, str(v["owner_type_id"]), str(v["owner_id"]),
+            str(v.get("provider_id") or ""), float(v["in_ts"]), v.get("activity_id"),
+            str(v["outcome"]), v.get("evidence"), int(bool(v.get("cached"))),
+        )
+        for v in verdicts or ()
+    ]
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO history_scans"
+            "(scan_id, portal, trigger, status, started_ts, finished_ts, alerts_count, error) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (scan_id, portal, trigger, "failed" if alerts is None else "done",
+             started_ts, finished_ts, len(rows), error),
+        )
+        conn.execute("DELETE FROM history_alerts WHERE scan_id = ?", (scan_id,))
+        conn.executemany(
+            f"INSERT OR IGNORE INTO history_alerts(scan_id, portal, scan_ts, owner_type_id, owner_id, "
+            f"{', '.join(_ALERT_FIELDS)}) VALUES ({', '.join('?' * (5 + len(_ALERT_FIELDS)))})",
+            rows,
+        )
+        conn.execute("DELETE FROM history_verdicts WHERE scan_id = ?", (scan_id,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO history_verdicts(scan_id, portal, scan_ts, owner_type_id, owner_id, "
+            "provider_id, in_ts, activity_id, outcome, evidence, cached) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            verdict_rows,
+        )
+        if finished_ts - _last_prune > 3600:
+            _last_prune = finished_ts
+            cutoff = finished_ts - HISTORY_DAYS * 86400
+            conn.execute("DELETE FROM history_alerts WHERE scan_ts < ?", (cutoff,))
+            conn.execute("DELETE FROM history_verdicts WHERE scan_ts < ?", (cutoff,))
+            conn.execute("DELETE FROM history_scans WHERE finished_ts < ?", (cutoff,))
+
+
+def latest_scan(portal: str = "") -> dict | None:
+    """Последний успешный скан портала (просрочки по таймерам SLA — не скан портала целиком)."""
+    _schema()
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT * FROM history_scans WHERE portal = ? AND status = 'done' AND trigger != 'sla' "
+            "ORDER BY finished_ts DESC LIMIT 1",
+            (portal,),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def alerts(
+    portal: str = "",
+    scan_id: str | None = None,
+    since: datetime | None = None,
+    until: datetime | None = None,
+    owner_type_id: str | None = None,
+    owner_id: str | None = None,
+    provider_id: str | None = None,
+    responsible_id: str | None = None,
+    limit: int = 100,
+    cursor: int | None = None,
+) -> dict:
+    """
+    Тревоги из истории, новые первыми; страница — limit строк, следующая — с cursor=next_cursor.
+    Без scan_id и периода — тревоги последнего успешного скана.
+    """
+    _schema()
+    where, args = ["portal = ?"], [portal]
+    scan = None
+    if scan_id is None and since is None and until is None:
+        scan = latest_scan(portal)
+        if scan is None:
+            return {"scan": None, "items": [], "next_cursor": None}
+        scan_id = scan["scan_id"]
+    if scan_id is not None:
+        where.append("scan_id = ?")
+        args.append(scan_id)
+    if since is not None:
+        where.append("scan_ts >= ?")
+        args.append(since.timestamp())
+    if until is not None:
+        where.append("scan_ts < ?")
+        args.append(until.timestamp())
+    for column, value in (("owner_type_id", owner_type_id), ("owner_id", owner_id),
+                          ("provider_id", provider_id), ("responsible_id", responsible_id)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            args.append(str(value))
+    if cursor is not None:
+        where.append("id < ?")
+        args.append(int(cursor))
+    limit = max(1, min(int(limit), HISTORY_PAGE_MAX))
+
+    with transaction() as conn:
+        rows = conn.execute(
+            f"SELECT * FROM history_alerts WHERE {' AND '.join(where)} ORDER BY id DESC LIMIT ?",
+            (*args, limit + 1),
+        ).fetchall()
+    items = [dict(r) for r in rows[:limit]]
+    return {
+        "scan": scan,
+        "items": items,
+        "next_cursor": items[-1]["id"] if len(rows) > limit else None,
+    }
+
+
+def verdicts(
+    portal: str = "",
+    scan_id: str | None = None,
+    owner_type_id: str | None = None,
+    owner_id: str | None = None,
+    outcome: str | None = None,
+    limit: int = 100,
+) -> dict:
+    """Итоги проверки кандидатов одного скана (без scan_id — последнего успешного), новые входящие первыми."""
+    _schema()
+    scan = None
+    if scan_id is None:
+        scan = latest_scan(portal)
+        if scan is None:
+            return {"scan": None, "items": []}
+        scan_id = scan["scan_id"]
+    where, args = ["portal = ?", "scan_id = ?"], [portal, scan_id]
+    for column, value in (("owner_type_id", owner_type_id), ("owner_id", owner_id), ("outcome", outcome)):
+        if value is not None:
+            where.append(f"{column} = ?")
+            args.append(str(value))
+    limit = max(1, min(int(limit), HISTORY_PAGE_MAX))
+    with transaction() as conn:
+        rows = conn.execute(
+            f"SELECT * FROM history_verdicts WHERE {' AND '.join(where)} ORDER BY in_ts DESC LIMIT ?",
+            (*args, limit),
+        ).fetchall()
+    return {"scan": scan, "items": [{**dict(r), "cached": bool(r["cached"])} for r in rows]}
+
+
+def trends(portal: str = "", days: int = 30, group_by: str | None = None) -> dict:
+    """
+    По дням (UTC): сканы, тревоги в последнем скане дня (без проверок по таймерам SLA) и сколько разных сущностей были
+    без ответа хотя бы в одном скане; group_by (provider / responsible / entity_type) — в разрезе.
+    """
+    _schema()
+    if group_by is not None and group_by not in _DIMENSIONS:
+        raise ValueError(f"group_by: одно из {', '.join(_DIMENSIONS)}")
+    since = time.time() - max(int(days), 1) * 86400
+    dim = _DIMENSIONS.get(group_by or "")
+    key = f"COALESCE({dim}, '')" if dim else "''"
+    key_a = f"COALESCE(a.{dim}, '')" if dim else "''"
+
+    with transaction() as conn:
+        scans = conn.execute(
+            "SELECT date(finished_ts, 'unixepoch') AS day, COUNT(*) AS scans, "
+            "SUM(status = 'failed') AS failed "
+            "FROM history_scans WHERE portal = ? AND finished_ts >= ? GROUP BY day",
+            (portal, since),
+        ).fetchall()
+        entities = conn.execute(
+            f"SELECT date(scan_ts, 'unixepoch') AS day, {key} AS k, "
+            f"COUNT(DISTINCT owner_type_id || ':' || owner_id) AS n "
+            f"FROM history_alerts WHERE portal = ? AND scan_ts >= ? GROUP BY day, k",
+            (portal, since),
+        ).fetchall()
+        # последний полный скан дня (SQLite: при MAX() остальные колонки — из той же строки)
+        last = conn.execute(
+            f"SELECT s.day AS day, {key_a} AS k, COUNT(*) AS n FROM ("
+            f"  SELECT scan_id, date(finished_ts, 'unixepoch') AS day, MAX(finished_ts) FROM history_scans "
+            f"  WHERE portal = ? AND status = 'done' AND trigger != 'sla' AND finished_ts >= ? GROUP BY day"
+            f") s JOIN history_alerts a ON a.scan_id = s.scan_id GROUP BY s.day, k",
+            (portal, since),
+        ).fetchall()
+
+    out: t.Dict[str, dict] = {
+        r["day"]: {"day": r["day"], "scans": r["scans"], "failed": r["failed"] or 0, "groups": {}}
+        for r in scans
+    }
+
+    def group(day: str, k: str) -> dict:
+        d = out.setdefault(day, {"day": day, "scans": 0, "failed": 0, "groups": {}})
+        return d["groups"].setdefault(k, {"entities": 0, "last_scan_alerts": 0})
+
+    for r in entities:
+        group(r["day"], r["k"])["entities"] = r["n"]
+    for r in last:
+        group(r["day"], r["k"])["last_scan_alerts"] = r["n"]
+
+    items = []
+    for day in sorted(out):
+        d = out[day]
+        groups = d.pop("groups")
+        if dim:
+            d["groups"] = sorted(({"key": k or "-", **v} for k, v in groups.items()), key=lambda g: -g["entities"])
+        else:
+            d.update(groups.get("", {"entities": 0, "last_scan_alerts": 0}))
+        items.append(d)
+    return {"days": days, "group_by": group_by, "items": items}
+
+
+def stats() -> dict:
+    _schema()
+    with transaction() as conn:
+        scans = conn.execute("SELECT COUNT(*) FROM history_scans").fetchone()[0]
+        rows = conn.execute("SELECT COUNT(*) FROM history_alerts").fetchone()[0]
+        checked = conn.execute("SELECT COUNT(*) FROM history_verdicts").fetchone()[0]
+    return {"scans": scans, "alerts": rows, "verdicts": checked, "retention_days": HISTORY_DAYS}
+
+
+__all__ = ["HISTORY_DAYS", "record", "latest_scan", "alerts", "verdicts", "trends", "stats"]
@@ -0,0 +1,86 @@
+# http_client.py — общие HTTP-сессии с пулом keep-alive соединений (Bitrix, Telegram)
+from __future__ import annotations
+
+import os
+import threading
+import typing as t
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# === Настройки пула ===
+_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))          # соединений на хост
+_KEEPALIVE = os.getenv("HTTP_KEEPALIVE", "1") == "1"         # 0 — закрывать соединение после ответа
+_COMPRESSION = os.getenv("HTTP_COMPRESSION", "1") == "1"     # gzip/deflate в ответах
+
+
+class HttpClient:
+    """
+    Один пул соединений на клиента (Bitrix, Telegram), общий для всех потоков.
+    Пул urllib3 потокобезопасен; сам requests.Session (cookies, заголовки) — нет,
+    поэтому у каждого потока своя лёгкая сессия поверх общего адаптера.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._adapter = HTTPAdapter(
+            pool_connections=_POOL_SIZE,
+            pool_maxsize=_POOL_SIZE,
+            max_retries=0,  # повторы делают вызывающие (_post и т.п.)
+        )
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._requests = 0
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = requests.Session()
+            s.mount("https://", self._adapter)
+            s.mount("http://", self._adapter)
+            s.headers["Accept-Encoding"] = "gzip, deflate" if _COMPRESSION else "identity"
+            s.headers["Connection"] = "keep-alive" if _KEEPALIVE else "close"
+            self._local.session = s
+        return s
+
+    def post(self, url: str, **kwargs: t.Any) -> requests.Response:
+        with self._lock:
+            self._requests += 1
+        return self._session().post(url, **kwargs)
+
+    def stats(self) -> dict:
+        """Сколько запросов ушло и сколько TCP/TLS-соединений для этого пришлось открыть."""
+        opened = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += getattr(pool, "num_connections", 0)
+        with self._lock:
+            total = self._requests
+        return {
+            "requests": total,
+            "connections_opened": opened,
+            "connections_reused": max(total - opened, 0),
+        }
+
+
+_clients_lock = threading.Lock()
+_clients: t.Dict[str, HttpClient] = {}
+
+
+def get_client(name: str) -> HttpClient:
+    with _clients_lock:
+        c = _clients.get(name)
+        if c is None:
+            c = _clients[name] = HttpClient(name)
+        return c
+
+
+def stats() -> dict:
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {c.name: c.stats() for c in clients}
+
+
+__all__ = ["HttpClient", "get_client", "stats"]
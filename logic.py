@@ -1,17 +1,110 @@
 # logic.py
+import asyncio
+from bisect import bisect_left
 from datetime import datetime, timedelta, timezone
+from functools import partial
+import heapq
 import os
 import re
+import threading
+import time
+from typing import Optional
 
-from bitrix import list_activities, list_calls_since, get_last_openlines_messages
+import activity_store
+import dialogs
+import enrichment
+import entity_state
+import metrics
+import verdicts
+from bitrix import (
+    BitrixError,
+    batch,
+    call_entity_type_id,
+    call_log_methods,
+    error_kind,
+    filter_calls_by_entity,
+    list_activities_sliced,
+    list_call_log,
+    list_calls_since,
+    report_call_method,
+    time_slices,
+    CRM_TYPE_NAMES,
+)
 
 # === Настройки ===
 WINDOW_DAYS = int(os.getenv("WINDOW_DAYS", "14"))
 RESPONSE_SLA_MIN = int(os.getenv("RESPONSE_SLA_MIN", "45"))
-MAX_ROWS_INCOMING = int(os.getenv("MAX_ROWS_INCOMING", "1500"))
+MAX_ROWS_INCOMING = int(os.getenv("MAX_ROWS_INCOMING", "0"))  # 0 — без лимита (окно целиком)
 MAX_ROWS_REPLY    = int(os.getenv("MAX_ROWS_REPLY", "300"))
 MAX_ROWS_CALL_ACT = int(os.getenv("MAX_ROWS_CALL_ACT", "200"))
 
+# Проверки по сущностям пачками через batch (0 — по одному запросу на проверку)
+BATCH_CHECKS = os.getenv("BATCH_CHECKS", "1") == "1"
+
+# Проверка ответа менеджера:
+#   index — одна выгрузка исходящих за окно WINDOW_DAYS и поиск по ней в памяти;
+#   query — запросы к Bitrix по каждой сущности (batch или поштучно, см. BATCH_CHECKS)
+REPLY_CHECK_MODE = (os.getenv("REPLY_CHECK_MODE") or "index").strip().lower()
+MAX_ROWS_REPLY_INDEX = int(os.getenv("MAX_ROWS_REPLY_INDEX", "20000"))
+
+# Проверка звонка: index — журнал звонков за окно выгружается один раз за скан;
+# query — запросы по каждой сущности
+CALL_CHECK_MODE = (os.getenv("CALL_CHECK_MODE") or "index").strip().lower()
+MAX_ROWS_CALL_INDEX = int(os.getenv("MAX_ROWS_CALL_INDEX", "20000"))
+# Журнал звонков за окно держится в памяти: после первой выгрузки дозапрашиваются только
+# звонки с прошлого раза (с перекрытием на длинные звонки) и не чаще CALL_LOG_MIN_INTERVAL
+CALL_LOG_MIN_INTERVAL = float(os.getenv("CALL_LOG_MIN_INTERVAL", "30"))
+CALL_LOG_OVERLAP_SEC = float(os.getenv("CALL_LOG_OVERLAP_SEC", "3600"))
+# Индексы выгружают всё окно — окупаются, только когда проверять много сущностей;
+# остальное (например, после кэша итогов verdicts.py) проверяется batch-запросами по сущностям
+INDEX_MIN_CANDIDATES = int(os.getenv("INDEX_MIN_CANDIDATES", "50"))
+
+# Локальное SQLite-зеркало активностей (activity_store.py): каждый скан забирает из Bitrix
+# только строки, созданные или изменённые с прошлого раза, а читает из зеркала
+ACTIVITY_STORE = os.getenv("ACTIVITY_STORE", "0") == "1"
+
+# Источник тревог: poll — опрос Bitrix по сущностям при каждом скане;
+# events — состояние «ждёт ответа», которое ведёт /bitrix/events (events.py)
+DETECT_MODE = (os.getenv("DETECT_MODE") or "poll").strip().lower()
+
+# Входящие: фильтры PROVIDERS_MSG / PROVIDERS_TYPE / ENTITY_TYPES уходят в Битрикс, по запросу
+# на канал (0 — все входящие одним фильтром, каналы отбираются у нас)
+INCOMING_PUSHDOWN = os.getenv("INCOMING_PUSHDOWN", "1") == "1"
+# Окно WINDOW_DAYS режется на срезы по N часов (0 — на INCOMING_CONCURRENCY равных срезов);
+# пары (канал, срез) листаются одновременно, не больше INCOMING_CONCURRENCY. Мелкие срезы
+# добавляют неполных страниц — лишних запросов к порталу
+INCOMING_SLICE_HOURS = float(os.getenv("INCOMING_SLICE_HOURS", "0"))
+INCOMING_CONCURRENCY = int(os.getenv("INCOMING_CONCURRENCY", "4"))
+
+# Асинхронный скан: сколько групп сущностей проверяется одновременно и размер группы
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", "4"))
+SCAN_CHUNK_SIZE = int(os.getenv("SCAN_CHUNK_SIZE", "50"))
+
+# === Метрики скана (/metrics) ===
+SCAN_SECONDS = metrics.histogram("scan_seconds", "Время скана detect_alerts целиком", ["mode"])
+SCAN_STAGE_SECONDS = metrics.histogram(
+    "scan_stage_seconds",
+    "Время стадий скана: fetch_incomings, reply_index, call_index, reply_check, dialog_check, call_check, enrich",
+    ["stage"],
+)
+SCAN_CANDIDATES = metrics.gauge("scan_candidates", "Сущностей с истёкшим SLA в последнем скане")
+SCAN_ALERTS = metrics.gauge("scan_alerts", "Тревог в последнем скане")
+INDEX_FAILURES = metrics.counter(
+    "scan_index_failures_total", "Выгрузки индексов, не удавшиеся после повторов (скан проверял по сущностям)", ["index"])
+SCAN_INCOMING_ROWS = metrics.gauge("scan_incoming_rows", "Строк входящих, выгруженных последним сканом")
+SCAN_INCOMING_TRUNCATED = metrics.gauge(
+    "scan_incoming_truncated", "1 — последняя выгрузка входящих упёрлась в MAX_ROWS_INCOMING и покрыла не всё окно")
+SCAN_INDEX_ROWS = metrics.gauge("scan_index_rows", "Строк в последней выгрузке индекса ответов / звонков", ["index"])
+SCAN_INDEX_TRUNCATED = metrics.gauge(
+    "scan_index_truncated", "1 — последняя выгрузка индекса упёрлась в MAX_ROWS_*_INDEX и покрыла не всё окно", ["index"])
+
+def _timed(stage: str, fn):
+    """fn, время каждого вызова которой пишется в scan_stage_seconds{stage=...}."""
+    def run(*args, **kwargs):
+        with SCAN_STAGE_SECONDS.time(stage=stage):
+            return fn(*args, **kwargs)
+    return run
+
 # Каналы-провайдеры, которые считаем "перепиской"
 PROVIDERS_MSG = {
     (p or "").strip().upper()
@@ -30,12 +123,12 @@ PROVIDERS_TYPE = {
 OPENLINES_SESSION_IDS = {"IMOPENLINES_SESSION"}
 OPENLINES_SESSION_TYPES = {"15"}  # тип канала Wazzup в ОЛ в твоих данных
 
-def _as_upper(v) -> str:
+def as_upper(v) -> str:
     return str(v if v is not None else "").strip().upper()
 
-def _is_message_activity(row: dict) -> bool:
-    prov  = _as_upper(row.get("PROVIDER_ID"))
-    ptype = _as_upper(row.get("PROVIDER_TYPE_ID"))
+def is_message_activity(row: dict) -> bool:
+    prov  = as_upper(row.get("PROVIDER_ID"))
+    ptype = as_upper(row.get("PROVIDER_TYPE_ID"))
     ok_by_id = prov in PROVIDERS_MSG if prov else False
     ok_by_type = (len(PROVIDERS_TYPE) > 0 and ptype in PROVIDERS_TYPE) if ptype else False
     return ok_by_id or ok_by_type
@@ -48,7 +141,7 @@ TRACK_ENTITY_TYPES = {
 def _iso(dt: datetime) -> str:
     return dt.astimezone(timezone.utc).isoformat()
 
-def _parse_b24_iso(s: str) -> datetime:
+def parse_b24_iso(s: str) -> datetime:
     if not s:
         return datetime.now(timezone.utc)
     s = str(s)
@@ -56,7 +149,7 @@ def _parse_b24_iso(s: str) -> datetime:
         s = s.replace("Z", "+00:00")
     return datetime.fromisoformat(s)
 
-def _extract_dialog_id(row: dict) -> Optional[str]:
+def extract_dialog_id(row: dict) -> Optional[str]:
     """
     Пытаемся достать DIALOG_ID для OpenLines/Wazzup несколькими способами.
     Принимаем строку вида 'imol|wz_whatsapp_...|15|<uuid>|<lineId>'.
@@ -65,7 +158,7 @@ def _extract_dialog_id(row: dict) -> Optional[str]:
     comms = row.get("COMMUNICATIONS")
     if isinstance(comms, list):
         for c in comms:
-            if _as_upper(c.get("TYPE")) == "IM":
+            if as_upper(c.get("TYPE")) == "IM":
                 val = str(c.get("VALUE") or "")
                 if val.startswith("imol|"):
                     return val
@@ -97,29 +190,162 @@ def _extract_dialog_id(row: dict) -> Optional[str]:
 
     return None
 
+# === Зеркало активностей ===
+def _stored_activities(since: datetime, **filters) -> list[dict]:
+    """Досинхронизирует зеркало (не чаще ACTIVITY_SYNC_MIN_INTERVAL) и читает из него, новые первыми."""
+    activity_store.sync(since, TRACK_ENTITY_TYPES)
+    return activity_store.query(since=since, owner_type_ids=TRACK_ENTITY_TYPES, **filters)
+
 # === Поиск последних входящих сообщений ===
-def fetch_recent_incoming_messages():
-    since = datetime.now(timezone.utc) - timedelta(days=WINDOW_DAYS)
-    flt = {
-        ">=CREATED": _iso(since),
+# Без DESCRIPTION: у писем это тело письма; нужно только для поиска DIALOG_ID (_resolve_dialog_ids)
+# LAST_UPDATED — для отпечатка активности (_dialog_marker): новое сообщение в той же сессии ОЛ
+# меняет его и сбрасывает кэш диалога и итог проверки
+_INCOMING_SELECT = [
+    "ID","CREATED","LAST_UPDATED","PROVIDER_ID","PROVIDER_TYPE_ID","SUBJECT",
+    "OWNER_TYPE_ID","OWNER_ID","COMMUNICATIONS","AUTHOR_ID",
+    "SETTINGS","PROVIDER_PARAMS"
+]
+
+def _incoming_filters() -> list[dict]:
+    """
+    Отдельный фильтр на каждый канал (PROVIDER_ID) и подтип (PROVIDER_TYPE_ID), типы сущностей —
+    сразу в Битрикс. Подтипы без уже выбранных каналов: одна строка не выгружается дважды.
+    """
+    base = {
         "DIRECTION": 2,  # incoming от клиента
+        "OWNER_TYPE_ID": sorted(int(x) for x in TRACK_ENTITY_TYPES if x.isdigit()),
     }
-    # Важно: добавили SETTINGS и PROVIDER_PARAMS
-    select = [
-        "ID","CREATED","PROVIDER_ID","PROVIDER_TYPE_ID","SUBJECT",
-        "OWNER_TYPE_ID","OWNER_ID","COMMUNICATIONS","AUTHOR_ID",
-        "DESCRIPTION","SETTINGS","PROVIDER_PARAMS"
-    ]
-    rows = list_activities(
-        flt,
-        order={"CREATED": "DESC"},
-        select=select,
-        max_rows=MAX_ROWS_INCOMING
+    return (
+        [{**base, "PROVIDER_ID": p} for p in sorted(PROVIDERS_MSG)]
+        + [
+            {**base, "PROVIDER_TYPE_ID": p, **({"!PROVIDER_ID": sorted(PROVIDERS_MSG)} if PROVIDERS_MSG else {})}
+            for p in sorted(PROVIDERS_TYPE)
+        ]
+    )
+
+def _created_desc(rows: list[dict]) -> list[dict]:
+    # ID почти всегда растёт вместе с CREATED, но «последнее входящее» берём строго по CREATED
+    return sorted(rows, key=lambda r: parse_b24_iso(str(r.get("CREATED"))), reverse=True)
+
+def _merge_incoming(streams: list[list[dict]], max_rows: int = 0) -> tuple[list[dict], bool]:
+    """
+    Потоки по каналам (каждый — новые первыми) -> один по CREATED, без дублей.
+    max_rows > 0 — не длиннее; второй элемент — упёрлись ли в лимит.
+    """
+    rows: list[dict] = []
+    seen: set[str] = set()
+    merged = heapq.merge(*streams, key=lambda r: parse_b24_iso(str(r.get("CREATED"))), reverse=True)
+    for r in merged:
+        rid = str(r.get("ID"))
+        if rid in seen:
+            continue  # на случай, если портал не применил !PROVIDER_ID
+        seen.add(rid)
+        if str(r.get("OWNER_TYPE_ID")) in TRACK_ENTITY_TYPES and is_message_activity(r):
+            rows.append(r)
+            if max_rows and len(rows) >= max_rows:
+                return rows, True
+    return rows, False
+
+_incoming_coverage: dict = {}
+
+def incoming_coverage() -> dict:
+    """Покрытие окна последней выгрузкой входящих (/health): срезы, строки, было ли усечение."""
+    return dict(_incoming_coverage)
+
+def _report_coverage(coverage: dict) -> None:
+    global _incoming_coverage
+    _incoming_coverage = coverage
+    SCAN_INCOMING_ROWS.set(coverage["rows"])
+    SCAN_INCOMING_TRUNCATED.set(1 if coverage["truncated"] else 0)
+    if coverage["truncated"]:
+        print(f"[SCAN] входящие усечены MAX_ROWS_INCOMING={MAX_ROWS_INCOMING}: "
+              f"окно покрыто только с {coverage['covered_since']}")
+
+def _slice_step(since: datetime, until: datetime) -> timedelta:
+    return (
+        timedelta(hours=INCOMING_SLICE_HOURS) if INCOMING_SLICE_HOURS > 0
+        else (until - since) / max(INCOMING_CONCURRENCY, 1)
     )
-    return [
-        r for r in rows
-        if str(r.get("OWNER_TYPE_ID")) in TRACK_ENTITY_TYPES and _is_message_activity(r)
-    ]
+
+def fetch_recent_incoming_messages():
+    """
+    Входящие сообщения за WINDOW_DAYS, новые первыми (по CREATED).
+    Окно режется на срезы (INCOMING_SLICE_HOURS), срезы по каждому каналу листаются
+    параллельно; покрытие окна — incoming_coverage().
+    """
+    until = datetime.now(timezone.utc)
+    since = until - timedelta(days=WINDOW_DAYS)
+    if ACTIVITY_STORE:
+        # В зеркале всё окно целиком, лимит строк для API тут не нужен
+        rows = [
+            r for r in _stored_activities(since, direction=2)
+            if str(r.get("OWNER_TYPE_ID")) in TRACK_ENTITY_TYPES and is_message_activity(r)
+        ]
+        _report_coverage({"source": "store", "since": _iso(since), "until": _iso(until), "rows": len(rows),
+                          "truncated": False, "covered_since": _iso(since)})
+        return rows
+
+    if INCOMING_PUSHDOWN:
+        # Каналы фильтрует Битрикс: звонки и прочие активности не занимают место среди входящих
+        filters = _incoming_filters()
+        if not filters:
+            return []
+    else:
+        filters = [{"DIRECTION": 2}]
+    cap = MAX_ROWS_INCOMING if MAX_ROWS_INCOMING > 0 else None
+    streams, coverage = list_activities_sliced(
+        filters, _INCOMING_SELECT, since, until,
+        step=_slice_step(since, until), concurrency=INCOMING_CONCURRENCY, max_rows=cap,
+    )
+    # срезы идут новыми первыми и не пересекаются: поток фильтра = срезы подряд
+    rows, capped = _merge_incoming(
+        [[r for part in slices for r in _created_desc(part)] for slices in streams], MAX_ROWS_INCOMING,
+    )
+    if capped:
+        oldest = _iso(parse_b24_iso(str(rows[-1].get("CREATED"))))
+        coverage["truncated"] = True
+        coverage["covered_since"] = max(coverage["covered_since"], oldest, key=parse_b24_iso)
+    coverage["messages"] = len(rows)
+    _report_coverage(coverage)
+    return rows
+
+def _needs_description(row: dict) -> bool:
+    """DIALOG_ID в остальных полях не нашёлся, а канал — не почта (там DESCRIPTION — тело письма)."""
+    if "DESCRIPTION" in row or extract_dialog_id(row):
+        return False
+    return as_upper(row.get("PROVIDER_ID")) != "CRM_EMAIL" and as_upper(row.get("PROVIDER_TYPE_ID")) != "EMAIL"
+
+def _load_descriptions(rows: list[dict]) -> None:
+    """Догружает DESCRIPTION (на месте) по строкам, где по нему ищется DIALOG_ID: ID-in по 50, одним batch."""
+    need = [r for r in rows if _needs_description(r)]
+    if not need:
+        return
+    ids = [str(r["ID"]) for r in need]
+    cmds = {
+        f"d{i}": ("crm.activity.list", {"filter": {"ID": ids[i:i + 50]}, "select": ["ID", "DESCRIPTION"], "start": -1})
+        for i in range(0, len(ids), 50)
+    }
+    found: dict[str, str] = {}
+    for key, res in batch(cmds).items():
+        if res.get("error"):
+            print(f"[SCAN] DESCRIPTION {key}: {res['error']}")
+            continue
+        for row in res.get("result") or []:
+            found[str(row.get("ID"))] = str(row.get("DESCRIPTION") or "")
+    for r in need:
+        r["DESCRIPTION"] = found.get(str(r["ID"]), "")
+
+def _resolve_dialog_ids(cands: list[dict]) -> None:
+    """
+    DIALOG_ID по DESCRIPTION — только у кандидатов, дошедших до проверки диалога (остальные
+    уже отсеяны кэшем итогов, ответами и звонками). Вызывается внутри стадии, вне event loop.
+    """
+    need = [c for c in cands if not c["dialog_id"]]
+    if not need:
+        return
+    _load_descriptions([c["last"] for c in need])
+    for c in need:
+        c["dialog_id"] = _dialog_id_for(c["last"])
 
 # === Был ли исходящий ответ после входящего (включая ту же минуту/момент) ===
 def has_outgoing_reply_after(entity_type_id, entity_id, t_from_iso: str) -> bool:
@@ -138,22 +364,140 @@ def has_outgoing_reply_after(entity_type_id, entity_id, t_from_iso: str) -> bool
         max_rows=MAX_ROWS_REPLY
     )
     for r in rows:
-        if _is_message_activity(r):
+        if is_message_activity(r):
             return True
     return False
 
+# === Индекс исходящих ответов за окно (REPLY_CHECK_MODE=index) ===
+def _first_at_or_after(events: list[tuple[datetime, str]] | None, t_from: datetime) -> tuple[datetime, str] | None:
+    if not events:
+        return None
+    i = bisect_left(events, (t_from, ""))
+    return events[i] if i < len(events) else None
+
+class ReplyIndex:
+    """
+    (OWNER_TYPE_ID, OWNER_ID) -> отсортированный список (CREATED, ID) исходящих сообщений.
+    covered_since — с какого момента выгрузка полная (при упоре в лимит строк это
+    не начало окна, а время самой старой полученной строки).
+    """
+
+    def __init__(self, rows: list[dict], covered_since: datetime):
+        by_entity: dict[tuple[str, str], list[tuple[datetime, str]]] = {}
+        for r in rows:
+            if not is_message_activity(r):
+                continue
+            key = (str(r.get("OWNER_TYPE_ID")), str(r.get("OWNER_ID")))
+            by_entity.setdefault(key, []).append((parse_b24_iso(r.get("CREATED")), str(r.get("ID"))))
+        for replies in by_entity.values():
+            replies.sort()
+        self._by_entity = by_entity
+        self.covered_since = covered_since
+
+    def first_reply_after(self, entity_type_id, entity_id, t_from: datetime) -> tuple[datetime, str] | None:
+        """Первый ответ в момент t_from или позже (как >=CREATED в has_outgoing_reply_after)."""
+        return _first_at_or_after(self._by_entity.get((str(entity_type_id), str(entity_id))), t_from)
+
+    def covers(self, t_from: datetime) -> bool:
+        """Отсутствие ответа в индексе после t_from достоверно?"""
+        return t_from >= self.covered_since
+
+_index_coverage: dict = {}
+
+def index_coverage() -> dict:
+    """Покрытие окна последними выгрузками индексов ответов и звонков (/health), как у входящих."""
+    return {index: dict(coverage) for index, coverage in _index_coverage.items()}
+
+def _report_index_coverage(index: str, coverage: dict) -> None:
+    _index_coverage[index] = coverage
+    SCAN_INDEX_ROWS.set(coverage["rows"], index=index)
+    SCAN_INDEX_TRUNCATED.set(1 if coverage["truncated"] else 0, index=index)
+    if coverage["truncated"]:
+        print(f"[SCAN] {index} усечён: окно покрыто только с {coverage['covered_since']}")
+
+def _fetch_index_rows(index: str, flt: dict, select: list[str], since: datetime, max_rows: int):
+    """
+    Выгрузка окна для индекса — как у входящих: срезы (INCOMING_SLICE_HOURS) параллельно, в каждом
+    keyset по ID без подсчёта total. Не больше max_rows самых новых строк (0 — без лимита).
+    Возвращает (строки, новые первыми; с какого момента выгрузка полная).
+    """
+    until = datetime.now(timezone.utc)
+    step = _slice_step(since, until)
+    cap = max_rows if max_rows > 0 else None
+    streams, coverage = list_activities_sliced(
+        [flt], select, since, until, step=step, concurrency=INCOMING_CONCURRENCY, max_rows=cap,
+    )
+    # Срез, упёршийся в лимит, отдал строки с наибольшими ID, а не с последними CREATED:
+    # отсутствие ответа в нём не доказано до самой его верхней границы
+    covered_since = max(
+        [b for (_, b), part in zip(time_slices(since, until, step), streams[0]) if cap and len(part) >= cap],
+        default=since,
+    )
+    # срезы идут новыми первыми и не пересекаются
+    rows = [r for part in streams[0] for r in _created_desc(part)]
+    if cap is not None and len(rows) > cap:
+        rows = rows[:cap]
+        # Секунда запаса — строки с тем же CREATED могли попасть не все
+        covered_since = max(covered_since, parse_b24_iso(str(rows[-1].get("CREATED"))) + timedelta(seconds=1))
+    coverage["truncated"] = covered_since > since
+    coverage["covered_since"] = _iso(covered_since)
+    coverage["indexed"] = len(rows)
+    _report_index_coverage(index, coverage)
+    return rows, covered_since
+
+def _stored_index_rows(index: str, since: datetime, **filters) -> list[dict]:
+    rows = _stored_activities(since, **filters)
+    _report_index_coverage(index, {"source": "store", "since": _iso(since), "rows": len(rows),
+                                   "truncated": False, "covered_since": _iso(since)})
+    return rows
+
+def build_reply_index(since: datetime) -> ReplyIndex:
+    if ACTIVITY_STORE:
+        return ReplyIndex(_stored_index_rows("reply_index", since, direction=1), since)
+
+    rows, covered_since = _fetch_index_rows(
+        "reply_index",
+        {"DIRECTION": 1, "OWNER_TYPE_ID": sorted(int(x) for x in TRACK_ENTITY_TYPES)},
+        ["ID","CREATED","PROVIDER_ID","PROVIDER_TYPE_ID","OWNER_TYPE_ID","OWNER_ID","AUTHOR_ID"],
+        since, MAX_ROWS_REPLY_INDEX,
+    )
+    return ReplyIndex(rows, covered_since)
+
 # === Был ли звонок после входящего ===
-def has_success_call_after(entity_type_id, entity_id, t_from_iso: str, phone: str | None) -> bool:
+def _call_succeeded(call: dict) -> bool:
+    """Звонок из журнала состоялся? CALL_FAILED=Y или код завершения не 200 — нет."""
+    if str(call.get("CALL_FAILED", "N")).upper() == "Y":
+        return False
+    code = str(call.get("CALL_FAILED_CODE") or "").strip()
+    return code in ("", "200")
+
+def call_activity_succeeded(row: dict) -> bool:
+    return row.get("COMPLETED") == "Y" or str(row.get("DIRECTION", "0")) in ("1", "2")
+
+def _call_matches(call: dict, phones) -> bool:
+    """
+    Звонок из журнала после filter_calls_by_entity: привязанный к сущности засчитывается,
+    без привязки к CRM — только если номер совпал с одним из телефонов сущности.
+    """
+    if call.get("SRC") == "crm.activity.list" or call_entity_type_id(call):
+        return True
+    return normalize_phone(call.get("PHONE_NUMBER")) in phones
+
+def has_success_call_after(entity_type_id, entity_id, t_from_iso: str, phones=()) -> bool:
+    """phones — нормализованные телефоны сущности (см. communications_phones)."""
     calls = list_calls_since(
         t_from_iso,
         entity_type_id=int(entity_type_id),
         entity_id=int(entity_id),
-        phone=phone
     )
+    phones = set(phones)
     for c in calls:
-        if str(c.get("CALL_FAILED", "N")).upper() != "Y":
+        if _call_succeeded(c) and _call_matches(c, phones):
             return True
+    return has_call_activity_after(entity_type_id, entity_id, t_from_iso)
 
+def has_call_activity_after(entity_type_id, entity_id, t_from_iso: str) -> bool:
+    """Состоявшийся звонок среди активностей сущности (звонки без записи в журнале телефонии)."""
     from bitrix import list_activities as _la
     rows = _la(
         {
@@ -167,138 +511,795 @@ def has_success_call_after(entity_type_id, entity_id, t_from_iso: str, phone: st
         max_rows=MAX_ROWS_CALL_ACT
     )
     for r in rows:
-        if r.get("COMPLETED") == "Y" or str(r.get("DIRECTION", "0")) in ("1", "2"):
+        if call_activity_succeeded(r):
             return True
     return False
 
 def communications_first_phone(comms):
-    if isinstance(comms, list) and comms:
-        v = comms[0].get("VALUE")
-        if v:
-            return str(v)
+    """Первый телефон из COMMUNICATIONS как есть (для дайджеста); e-mail и IM пропускаются."""
+    for comm in comms if isinstance(comms, list) else ():
+        if isinstance(comm, dict) and str(comm.get("TYPE") or "PHONE").upper() == "PHONE" and comm.get("VALUE"):
+            return str(comm["VALUE"])
     return None
 
-def _last_sender_is_operator_for_openlines(last_activity: dict) -> bool | None:
+def communications_phones(comms) -> list[str]:
+    """Все телефоны из COMMUNICATIONS в нормализованном виде (без e-mail и прочих каналов)."""
+    phones: list[str] = []
+    for comm in comms if isinstance(comms, list) else ():
+        if not isinstance(comm, dict) or str(comm.get("TYPE") or "PHONE").upper() != "PHONE":
+            continue
+        phone = normalize_phone(comm.get("VALUE"))
+        if phone and phone not in phones:
+            phones.append(phone)
+    return phones
+
+def normalize_phone(value) -> str:
     """
-    Возвращает:
-      True  — если последнее сообщение в диалоге написал оператор (менеджер),
-      False — если последнее сообщение написал клиент,
-      None  — если не удалось определить.
+    Телефон -> только цифры в виде 7XXXXXXXXXX для российских номеров:
+    '+7 (900) 123-45-67', '8 900 1234567' и '9001234567' дают одно и то же.
     """
-    prov = _as_upper(last_activity.get("PROVIDER_ID"))
-    ptype = _as_upper(last_activity.get("PROVIDER_TYPE_ID"))
+    digits = re.sub(r"\D", "", str(value or ""))
+    if len(digits) == 11 and digits[0] == "8":
+        digits = "7" + digits[1:]
+    elif len(digits) == 10:
+        digits = "7" + digits
+    return digits
 
-    if (prov not in OPENLINES_SESSION_IDS) and (ptype not in OPENLINES_SESSION_TYPES):
-        return None  # не сессия ОЛ, не обрабатываем тут
+# === Индекс звонков за окно (CALL_CHECK_MODE=index) ===
+class CallIndex:
+    """
+    Успешные звонки за окно: по сущности CRM и по нормализованному номеру.
+    Источники — журнал телефонии (voximplant/telephony.statistic.get) и активности-звонки.
+    covered_since — с какого момента обе выгрузки полные.
+    """
 
-    dialog_id = _extract_dialog_id_from_comms(last_activity.get("COMMUNICATIONS"))
-    if not dialog_id:
-        return None
+    def __init__(self, calls: list[dict], call_rows: list[dict], covered_since: datetime):
+        by_entity: dict[tuple[str, str], list[tuple[datetime, str]]] = {}
+        by_phone: dict[str, list[tuple[datetime, str]]] = {}
 
-    msgs = get_last_openlines_messages(dialog_id, limit=1)
-    if not msgs:
-        return None
+        for c in calls:
+            if not _call_succeeded(c):
+                continue
+            ev = (parse_b24_iso(c.get("CALL_START_DATE")), str(c.get("CALL_ID") or c.get("ID") or ""))
+            et = call_entity_type_id(c)
+            ei = str(c.get("CRM_ENTITY_ID", c.get("ENTITY_ID", "")) or "")
+            if et and ei:
+                by_entity.setdefault((et, ei), []).append(ev)
+            phone = normalize_phone(c.get("PHONE_NUMBER"))
+            if phone:
+                by_phone.setdefault(phone, []).append(ev)
+
+        for r in call_rows:
+            if not call_activity_succeeded(r):
+                continue
+            key = (str(r.get("OWNER_TYPE_ID")), str(r.get("OWNER_ID")))
+            by_entity.setdefault(key, []).append((parse_b24_iso(r.get("CREATED")), str(r.get("ID"))))
+
+        for events in (*by_entity.values(), *by_phone.values()):
+            events.sort()
+        self._by_entity = by_entity
+        self._by_phone = by_phone
+        self.covered_since = covered_since
 
-    msg = msgs[0]
+    def first_call_after(self, entity_type_id, entity_id, phones, t_from: datetime) -> tuple[datetime, str] | None:
+        """Первый звонок сущности или на любой из её телефонов (нормализованных) в t_from или позже."""
+        hits = [_first_at_or_after(self._by_entity.get((str(entity_type_id), str(entity_id))), t_from)]
+        hits.extend(_first_at_or_after(self._by_phone.get(p), t_from) for p in phones)
+        hits = [h for h in hits if h]
+        return min(hits) if hits else None
 
+    def covers(self, t_from: datetime) -> bool:
+        return t_from >= self.covered_since
+
+def _call_key(call: dict) -> str:
+    return str(call.get("CALL_ID") or call.get("ID") or f"{call.get('CALL_START_DATE')}|{call.get('PHONE_NUMBER')}")
+
+class CallLog:
+    """
+    Журнал телефонии за окно в памяти процесса. Первый вызов выгружает окно целиком,
+    следующие — только звонки с прошлой выгрузки минус CALL_LOG_OVERLAP_SEC (звонок попадает
+    в журнал после завершения, а датируется началом). Индекс по сущности и по
+    нормализованному номеру (CallIndex) перестраивается только после новой выгрузки.
+    """
+
+    def __init__(self):
+        self._calls: dict[str, dict] = {}
+        self._since: datetime | None = None
+        self._covered_since: datetime | None = None
+        self._fetched_at: datetime | None = None
+        self._checked_at = 0.0
+        self._index: CallIndex | None = None
+        self._lock = threading.Lock()
+
+    def _fetch(self, since: datetime) -> tuple[list[dict], datetime] | None:
+        calls, method = list_call_log(_iso(since), max_rows=MAX_ROWS_CALL_INDEX, order="DESC")
+        if not method:
+            return None  # журнал телефонии на портале недоступен
+        covered = since
+        if len(calls) >= MAX_ROWS_CALL_INDEX and calls:
+            covered = parse_b24_iso(calls[-1].get("CALL_START_DATE")) + timedelta(seconds=1)
+        return calls, covered
+
+    def _refresh(self, since: datetime) -> None:
+        now = datetime.now(timezone.utc)
+        delta = self._fetched_at is not None and self._since is not None and since >= self._since
+        got = self._fetch(self._fetched_at - timedelta(seconds=CALL_LOG_OVERLAP_SEC) if delta else since)
+        if got is None:
+            self._calls, self._since, self._covered_since, self._fetched_at, self._index = {}, None, None, None, None
+            return
+        calls, covered = got
+        if delta and covered > self._fetched_at - timedelta(seconds=CALL_LOG_OVERLAP_SEC):
+            got = self._fetch(since)  # за время между выгрузками звонков больше лимита — заново целиком
+            if got is None:
+                return
+            calls, covered = got
+            delta = False
+        if not delta:
+            self._calls, self._since, self._covered_since = {}, since, covered
+        for c in calls:
+            self._calls[_call_key(c)] = c
+        self._calls = {
+            k: c for k, c in self._calls.items()
+            if parse_b24_iso(c.get("CALL_START_DATE")) >= since
+        }
+        self._since = since
+        self._covered_since = max(self._covered_since, since)
+        self._fetched_at = now
+        self._index = None
+
+    def _ensure(self, since: datetime) -> bool:
+        if self._fetched_at is None or time.monotonic() - self._checked_at >= CALL_LOG_MIN_INTERVAL:
+            self._checked_at = time.monotonic()
+            self._refresh(since)
+        return self._covered_since is not None
+
+    def calls(self, since: datetime) -> tuple[list[dict], datetime] | None:
+        """(звонки с since, с какого момента они полные) или None — журнал недоступен."""
+        with self._lock:
+            if not self._ensure(since):
+                return None
+            return list(self._calls.values()), self._covered_since
+
+    def index(self, since: datetime) -> CallIndex | None:
+        """CallIndex только по журналу телефонии (без активностей-звонков)."""
+        with self._lock:
+            if not self._ensure(since):
+                return None
+            if self._index is None:
+                self._index = CallIndex(list(self._calls.values()), [], self._covered_since)
+            return self._index
+
+_CALL_LOG = CallLog()
+
+def build_call_index(since: datetime) -> CallIndex:
+    got = _CALL_LOG.calls(since)
+    calls, covered_since = got if got is not None else ([], since)
+
+    if ACTIVITY_STORE:
+        rows = _stored_index_rows("call_index", since, provider_ids=["VOXIMPLANT_CALL", "CALL"])
+        return CallIndex(calls, rows, covered_since)
+
+    call_rows, rows_covered = _fetch_index_rows(
+        "call_index",
+        {"PROVIDER_ID": ["VOXIMPLANT_CALL", "CALL"], "OWNER_TYPE_ID": sorted(int(x) for x in TRACK_ENTITY_TYPES)},
+        ["ID","CREATED","PROVIDER_ID","DIRECTION","COMPLETED","OWNER_TYPE_ID","OWNER_ID"],
+        since, MAX_ROWS_CALL_INDEX,
+    )
+    return CallIndex(calls, call_rows, max(covered_since, rows_covered))
+
+def _message_from_operator(msg: dict, users: dict) -> bool | None:
+    """
+    Возвращает:
+      True  — сообщение написал оператор (менеджер),
+      False — сообщение написал клиент,
+      None  — если не удалось определить.
+    """
     # Нормализация: у разных порталов поля разные. Пытаемся определить принадлежность.
     # Критерии (используем первые подходящие):
-    # - 'AUTHOR_ID' > 0 и принадлежит сотруднику портала -> оператор
     # - 'AUTHOR_TYPE' in ('operator','bot') -> оператор
-    # - 'FROM_USER_ID' == 0 или 'AUTHOR_ID' == 0 -> клиент
     # - 'USER_SOURCE'/'SOURCE' == 'client' -> клиент
+    # - 'AUTHOR_ID' == 0 -> клиент
+    # - 'AUTHOR_ID' > 0: сотрудник портала (справочник user.get) -> оператор
     author_type = str(msg.get("AUTHOR_TYPE") or "").lower()
     source      = str(msg.get("SOURCE") or msg.get("USER_SOURCE") or "").lower()
-    author_id   = msg.get("AUTHOR_ID")
 
     if author_type in ("operator", "bot", "system"):
         return True
     if source in ("client", "external", "guest"):
         return False
-    if isinstance(author_id, int):
-        # Эвристика: в ОЛ у клиента часто AUTHOR_ID == 0
-        if author_id == 0:
-            return False
-        # Иначе считаем это внутренний пользователь (оператор)
-        return True
-
-    # Если ничего не распознали
-    return None
+    try:
+        author_id = int(msg.get("author_id") or msg.get("AUTHOR_ID") or 0)
+    except (TypeError, ValueError):
+        return None
+    if author_id == 0:
+        return False
+    return _is_user_manager(author_id, users)
 
-# === Главный детектор тревог ===
-def detect_alerts():
+def _last_sender_is_operator_for_openlines(last_activity: dict) -> bool | None:
     """
-    Возвращает список словарей:
-    {
-      'owner_type_id', 'owner_id', 'last_in_created',
-      'provider_id', 'phone', 'activity_id', 'subject'
+    Кто написал последнее сообщение в диалоге ОЛ этой активности (см. _message_from_operator).
+    None — не сессия ОЛ, нет DIALOG_ID или диалог пуст.
+    """
+    prov = as_upper(last_activity.get("PROVIDER_ID"))
+    ptype = as_upper(last_activity.get("PROVIDER_TYPE_ID"))
+
+    if (prov not in OPENLINES_SESSION_IDS) and (ptype not in OPENLINES_SESSION_TYPES):
+        return None  # не сессия ОЛ, не обрабатываем тут
+
+    dialog_id = extract_dialog_id(last_activity)
+    if not dialog_id:
+        return None
+
+    lm = _get_last_dialog_message(str(dialog_id), _dialog_marker(last_activity))
+    if not lm:
+        return None
+    return _message_from_operator(*lm)
+
+# === Последнее сообщение диалога ОЛ и кто его автор ===
+def _dialog_marker(last: dict) -> str:
+    """Отпечаток активности для кэша диалогов: сменился — в диалоге есть новое."""
+    return f"{last.get('ID')}:{last.get('LAST_UPDATED') or ''}"
+
+def _get_last_dialog_message(dialog_id: str, marker: str | None = None) -> tuple[dict, dict] | None:
+    return dialogs.get_last_message(dialog_id, marker)
+
+def _is_user_manager(author_id: int, users: dict) -> bool:
+    """Автор — сотрудник портала (а не клиент из коннектора/гость)?"""
+    return dialogs.is_manager(author_id, users)
+
+def _dialog_id_for(last: dict) -> str:
+    """DIALOG_ID для проверки последнего сообщения или '' — если ходить в im не нужно."""
+    prov = as_upper(last.get("PROVIDER_ID"))
+    dialog_id = extract_dialog_id(last)
+    # ЖЁСТКАЯ защита: не ходим в im.dialog.messages.get без валидного dialog_id
+    dialog_id_str = str(dialog_id).strip() if dialog_id else ""
+    if dialog_id_str and (prov == "IMOPENLINES_SESSION" or dialog_id_str.startswith("imol|")):
+        return dialog_id_str
+    return ""
+
+def _last_message_is_manager(lm: tuple[dict, dict] | None) -> bool:
+    return bool(lm) and _message_from_operator(*lm) is True
+
+# === Пакетные проверки (batch) ===
+# Каждая стадия получает список кандидатов и возвращает тех, по кому тревога ещё не снята.
+# Если первой страницы ответа не хватает для решения (есть next) или команда упала —
+# по этой сущности делаем прежнюю поштучную проверку.
+
+def _reply_filter(etype: str, eid: str, t_from_iso: str) -> dict:
+    return {
+        "OWNER_TYPE_ID": int(etype),
+        "OWNER_ID": int(eid),
+        ">=CREATED": t_from_iso,
+        "DIRECTION": 1,
+    }
+
+def _batch_drop_replied(cands: list[dict]) -> list[dict]:
+    cmds = {
+        f"r{i}": ("crm.activity.list", {
+            "filter": _reply_filter(c["etype"], c["eid"], _iso(c["t_in"])),
+            "order": {"CREATED": "ASC"},
+            "select": ["ID","CREATED","PROVIDER_ID","PROVIDER_TYPE_ID","AUTHOR_ID"],
+        })
+        for i, c in enumerate(cands)
     }
+    res = batch(cmds)
+    left = []
+    for i, c in enumerate(cands):
+        r = res.get(f"r{i}") or {}
+        rows = r.get("result") if "error" not in r else None
+        if isinstance(rows, list):
+            reply = next((x for x in rows if is_message_activity(x)), None)
+            if reply is not None:
+                c["evidence"] = str(reply.get("ID") or "")
+                continue
+            if r.get("next") is None:
+                left.append(c)
+                continue
+        if not has_outgoing_reply_after(c["etype"], c["eid"], _iso(c["t_in"])):
+            left.append(c)
+    return left
+
+def _batch_drop_operator_last(cands: list[dict]) -> list[dict]:
+    _resolve_dialog_ids(cands)
+    # Кэш диалогов + один batch на промахи
+    last_messages = dialogs.get_last_messages({
+        c["dialog_id"]: _dialog_marker(c["last"]) for c in cands if c["dialog_id"]
+    })
+
+    left = []
+    for c in cands:
+        # если последнее сообщение от МЕНЕДЖЕРА — тревогу не формируем
+        lm = last_messages.get(c["dialog_id"]) if c["dialog_id"] else None
+        if _last_message_is_manager(lm):
+            c["evidence"] = str(lm[0].get("id") or "")
+            continue
+        left.append(c)
+    return left
+
+def _stat_success(rows, etype: str, eid: str) -> dict | None:
+    """Первый состоявшийся звонок сущности из ответа журнала или None."""
+    return next((x for x in filter_calls_by_entity(rows or [], etype, eid) if _call_succeeded(x)), None)
+
+def _call_log_hit(c: dict, call_log: CallIndex | None) -> tuple[datetime, str] | None:
+    """Звонок по журналу в памяти: с привязкой к сущности или на любой её телефон."""
+    if call_log is None:
+        return None
+    return call_log.first_call_after(c["etype"], c["eid"], c["phones"], c["t_in"])
+
+def _window_call_log() -> CallIndex | None:
+    return _CALL_LOG.index(datetime.now(timezone.utc) - timedelta(days=WINDOW_DAYS))
+
+def _gap_call_log(cands: list[dict], call_log: CallIndex | None) -> tuple[CallIndex | None, set[int]]:
+    """
+    Журнал телефонии от самого раннего входящего старше покрытия CallLog до этого покрытия —
+    одной выгрузкой на всех: звонок без привязки к CRM находится только по номеру, запрос
+    журнала по сущности его не вернёт. Возвращает (индекс или None; id кандидатов, для которых
+    выгрузка упёрлась в лимит и отсутствие звонка по номеру не доказано).
+    """
+    old = [c for c in cands if c["phones"] and (call_log is None or not call_log.covers(c["t_in"]))]
+    if not old:
+        return None, set()
+    since = min(c["t_in"] for c in old)
+    until = _iso(call_log.covered_since) if call_log is not None else None
+    calls, method = list_call_log(_iso(since), until_iso=until, max_rows=MAX_ROWS_CALL_INDEX)
+    if not method:
+        return None, set()  # журнал недоступен — как в list_calls_since, опираемся на активности
+    capped = len(calls) >= MAX_ROWS_CALL_INDEX
+    return CallIndex(calls, [], since), {id(c) for c in old} if capped else set()
+
+def _batch_drop_called(cands: list[dict]) -> list[dict]:
+    # Журнал телефонии — один на всех (CallLog); по сущностям — только активности-звонки
+    # и журнал для входящих старше его покрытия
+    call_log = _window_call_log()
+    gap_log, gap_capped = _gap_call_log(cands, call_log)
+    stat_methods = call_log_methods()
+    cmds: dict[str, tuple[str, dict]] = {}
+    for i, c in enumerate(cands):
+        since = _iso(c["t_in"])
+        cmds[f"a{i}"] = ("crm.activity.list", {
+            "filter": {
+                "OWNER_TYPE_ID": int(c["etype"]),
+                "OWNER_ID": int(c["eid"]),
+                ">CREATED": since,
+                "PROVIDER_ID": ["VOXIMPLANT_CALL", "CALL"],
+            },
+            "order": {"CREATED": "ASC"},
+            "select": ["ID","CREATED","PROVIDER_ID","DIRECTION","COMPLETED"],
+        })
+        if stat_methods and (call_log is None or not call_log.covers(c["t_in"])):
+            cmds[f"s{i}"] = (stat_methods[0], {
+                "FILTER": {
+                    ">=CALL_START_DATE": since,
+                    "CRM_ENTITY_TYPE": CRM_TYPE_NAMES.get(c["etype"], c["etype"]),
+                    "CRM_ENTITY_ID": c["eid"],
+                },
+                "ORDER": {"CALL_START_DATE": "ASC"},
+                "START": 0,
+            })
+    res = batch(cmds)
+
+    # Метод журнала не ответил ни на одну команду — запоминаем и пробуем следующий
+    # (например, портал без voximplant.statistic.get -> telephony.statistic.get)
+    for method, fallback in zip(stat_methods, stat_methods[1:] + [None]):
+        failed = {k: p for k, (m, p) in cmds.items() if m == method and "error" in (res.get(k) or {})}
+        used = [k for k, (m, _) in cmds.items() if m == method]
+        if not used:
+            break
+        if len(failed) < len(used):
+            report_call_method(method, True)
+            break
+        first = res.get(used[0]) or {}
+        if error_kind(str(first.get("error") or "").upper()) == "permanent":
+            # перегрузку портала за отсутствие метода не считаем
+            report_call_method(method, False, str(first.get("error_description") or ""))
+        if fallback is None:
+            break
+        retry = {k: (fallback, p) for k, p in failed.items()}
+        cmds.update(retry)
+        res.update(batch(retry))
+
+    left = []
+    for i, c in enumerate(cands):
+        hit = _call_log_hit(c, call_log) or _call_log_hit(c, gap_log)
+        if hit is not None:
+            c["evidence"] = hit[1]
+            continue
+        undecided = id(c) in gap_capped
+        success = False
+        for key in (f"a{i}", f"s{i}"):
+            if key not in cmds:
+                continue
+            r = res.get(key) or {}
+            if "error" in r:
+                continue  # журнал звонков недоступен — как в list_calls_since, опираемся на активности
+            rows = r.get("result") or []
+            if key.startswith("a"):
+                hit = next((x for x in rows if call_activity_succeeded(x)), None)
+            else:
+                hit = _stat_success(rows, c["etype"], c["eid"])
+            if hit is not None:
+                c["evidence"] = str(hit.get("CALL_ID") or hit.get("ID") or "")
+                success = True
+                break
+            if r.get("next") is not None:
+                undecided = True
+        if success:
+            continue
+        if undecided and has_success_call_after(c["etype"], c["eid"], _iso(c["t_in"]), c["phones"]):
+            continue
+        left.append(c)
+    return left
+
+def _index_split(cands: list[dict], index: ReplyIndex | CallIndex, hit_of) -> tuple[list[dict], list[dict]]:
+    """
+    Один поиск в индексе на кандидата: найденные отбрасываются (evidence — id ответа/звонка),
+    остальные делятся на (без ответа внутри покрытия индекса, старше покрытия).
     """
-    incomings = fetch_recent_incoming_messages()
-    alerts = []
+    left, uncovered = [], []
+    for c in cands:
+        hit = hit_of(c)
+        if hit is not None:
+            c["evidence"] = hit[1]
+        elif index.covers(c["t_in"]):
+            left.append(c)
+        else:
+            uncovered.append(c)
+    return left, uncovered
+
+def _index_merge(cands: list[dict], left: list[dict], still: list[dict]) -> list[dict]:
+    """Итог в порядке исходных кандидатов."""
+    keep = {id(c) for c in left} | {id(c) for c in still}
+    return [c for c in cands if id(c) in keep]
+
+def _index_drop_replied(cands: list[dict], index: ReplyIndex) -> list[dict]:
+    left, uncovered = _index_split(
+        cands, index, lambda c: index.first_reply_after(c["etype"], c["eid"], c["t_in"]),
+    )
+    # Входящие старше покрытия индекса проверяем прежним способом
+    still = []
+    if uncovered:
+        still = _batch_drop_replied(uncovered) if BATCH_CHECKS else _drop_replied(uncovered)
+    return _index_merge(cands, left, still)
+
+def _index_drop_called(cands: list[dict], index: CallIndex) -> list[dict]:
+    left, uncovered = _index_split(
+        cands, index, lambda c: index.first_call_after(c["etype"], c["eid"], c["phones"], c["t_in"]),
+    )
+    still = []
+    if uncovered:
+        still = _batch_drop_called(uncovered) if BATCH_CHECKS else _drop_called(uncovered)
+    return _index_merge(cands, left, still)
+
+# === Поштучные проверки (BATCH_CHECKS=0) ===
+def _drop_replied(cands: list[dict]) -> list[dict]:
+    # 1) Был ли исходящий ответ после входящего (включая тот же момент)
+    return [c for c in cands if not has_outgoing_reply_after(c["etype"], c["eid"], _iso(c["t_in"]))]
+
+def _drop_operator_last(cands: list[dict]) -> list[dict]:
+    # 2) Для чатов OpenLines/Wazzup: проверяем именно ПОСЛЕДНЕЕ сообщение в диалоге,
+    #    а не время закрытия сессии (ключевая логика).
+    _resolve_dialog_ids(cands)
+    left = []
+    for c in cands:
+        if c["dialog_id"]:
+            try:
+                lm = _get_last_dialog_message(c["dialog_id"], _dialog_marker(c["last"]))
+            except Exception:
+                lm = None  # при любой ошибке не валимся, продолжаем обычные проверки
+            if _last_message_is_manager(lm):
+                continue
+        left.append(c)
+    return left
+
+def _drop_called(cands: list[dict]) -> list[dict]:
+    # 3) Был ли звонок после входящего (любой успешный)
+    call_log = _window_call_log()
+    left = []
+    for c in cands:
+        if _call_log_hit(c, call_log) is not None:
+            continue
+        if call_log is not None and call_log.covers(c["t_in"]):
+            called = has_call_activity_after(c["etype"], c["eid"], _iso(c["t_in"]))
+        else:
+            called = has_success_call_after(c["etype"], c["eid"], _iso(c["t_in"]), c["phones"])
+        if not called:
+            left.append(c)
+    return left
 
+# === Главный детектор тревог ===
+def _collect_candidates(incomings: list[dict], now_utc: datetime, sla_min: int | None = None) -> list[dict]:
+    """Последнее входящее по каждой сущности, у которого уже истёк SLA."""
+    sla_min = RESPONSE_SLA_MIN if sla_min is None else sla_min
     # Берём только ПОСЛЕДНЕЕ входящее по каждой сущности
     latest_by_entity: dict[tuple[str, str], dict] = {}
+    # Телефоны сущности — из всех её входящих за окно: звонок на любой из них — ответ
+    phones_by_entity: dict[tuple[str, str], list[str]] = {}
     for r in incomings:
         key = (str(r["OWNER_TYPE_ID"]), str(r["OWNER_ID"]))
         if key not in latest_by_entity:
             latest_by_entity[key] = r  # уже отсортировано DESC
+        phones = phones_by_entity.setdefault(key, [])
+        phones.extend(p for p in communications_phones(r.get("COMMUNICATIONS")) if p not in phones)
 
-    now_utc = datetime.now(timezone.utc)
-
+    due: list[tuple[str, str, dict, datetime]] = []
     for (etype, eid), last in latest_by_entity.items():
         # Парсим дату входящего
-        created_raw = str(last.get("CREATED"))
-        t_in = _parse_b24_iso(created_raw)
+        t_in = parse_b24_iso(str(last.get("CREATED")))
 
         # Ждём SLA
-        if (now_utc - t_in).total_seconds() < RESPONSE_SLA_MIN * 60:
+        if (now_utc - t_in).total_seconds() < sla_min * 60:
             continue
+        due.append((etype, eid, last, t_in))
 
-        # 1) Был ли исходящий ответ после входящего (включая тот же момент)
-        if has_outgoing_reply_after(etype, eid, _iso(t_in)):
-            continue
+    cands: list[dict] = []
+    for etype, eid, last, t_in in due:
+        cands.append({
+            "etype": etype,
+            "eid": eid,
+            "last": last,
+            "t_in": t_in,
+            "dialog_id": _dialog_id_for(last),
+            "phone": communications_first_phone(last.get("COMMUNICATIONS")),
+            "phones": phones_by_entity[(etype, eid)],
+        })
+    return cands
 
-        # 2) Для чатов OpenLines/Wazzup: проверяем именно ПОСЛЕДНЕЕ сообщение в диалоге,
-        #    а не время закрытия сессии (ключевая логика).
-        prov = _as_upper(last.get("PROVIDER_ID"))
-        dialog_id = _extract_dialog_id(last)
+def _build_index(stage: str, build, window_since: datetime):
+    """
+    Индекс ответов/звонков или None, если выгрузка не удалась и после повторов: тогда
+    стадия проверяет сущности batch-запросами (или поштучно), а скан не падает целиком.
+    """
+    try:
+        return _timed(stage, build)(window_since)
+    except BitrixError as e:
+        INDEX_FAILURES.inc(index=stage)
+        print(f"[SCAN] {stage} failed, checking entities one by one: {e}")
+        return None
 
-        # ЖЁСТКАЯ защита: не ходим в im.dialog.messages.get без валидного dialog_id
-        if dialog_id:
-            dialog_id_str = str(dialog_id).strip()
+def _plan_stages(reply_index: ReplyIndex | None, call_index: CallIndex | None) -> list:
+    # Диалоги ОЛ — последними: это запросы в im (и догрузка DESCRIPTION) по каждому диалогу,
+    # а до них доходят только сущности без ответа в CRM и без звонка
+    if BATCH_CHECKS:
+        stages = [_batch_drop_replied, _batch_drop_called, _batch_drop_operator_last]
+    else:
+        stages = [_drop_replied, _drop_called, _drop_operator_last]
+    if reply_index is not None:
+        stages[0] = partial(_index_drop_replied, index=reply_index)
+    if call_index is not None:
+        stages[1] = partial(_index_drop_called, index=call_index)
+    return [
+        (stage, _timed(stage, fn))
+        for stage, fn in zip(("reply_check", "call_check", "dialog_check"), stages)
+    ]
+
+# Итог проверки по стадии, на которой сущность отсеялась (verdicts.py)
+_STAGE_OUTCOMES = {"reply_check": "replied", "dialog_check": "operator_last", "call_check": "called"}
+
+def _run_stages(cands: list[dict], stages: list) -> list[dict]:
+    """Стадии по очереди; отсеянным кандидатам проставляется c["verdict"], оставшиеся — без ответа."""
+    for stage, fn in stages:
+        if not cands:
+            break
+        left = fn(cands)
+        kept = {id(c) for c in left}
+        for c in cands:
+            if id(c) not in kept:
+                c.setdefault("verdict", _STAGE_OUTCOMES[stage])
+        cands = left
+    return cands
+
+# === Кэш итогов проверок ===
+SCAN_VERDICTS = metrics.counter(
+    "scan_verdict_cache_total", "Кандидаты скана: итог взят из кэша (hit) или проверен заново (miss)", ["result"]
+)
+
+def _skip_resolved(cands: list[dict]) -> list[dict]:
+    """Убирает сущности, на последнее входящее которых ответ уже найден прошлыми сканами."""
+    if not verdicts.VERDICT_CACHE or not cands:
+        return cands
+    known = verdicts.resolved({
+        (c["etype"], c["eid"]): (str(c["last"].get("ID") or ""), _dialog_marker(c["last"])) for c in cands
+    })
+    left = []
+    for c in cands:
+        row = known.get((c["etype"], c["eid"]))
+        if row is None:
+            left.append(c)
         else:
-            dialog_id_str = ""
+            c.update(verdict=row["outcome"], evidence=row["evidence"], cached=True)
+    SCAN_VERDICTS.inc(len(cands) - len(left), result="hit")
+    SCAN_VERDICTS.inc(len(left), result="miss")
+    return left
 
-        if dialog_id_str and (prov == "IMOPENLINES_SESSION" or dialog_id_str.startswith("imol|")):
-            try:
-                lm = _get_last_dialog_message(dialog_id_str)
-            except Exception:
-                lm = None  # при любой ошибке не валимся, продолжаем обычные проверки
+def _save_verdicts(checked: list[dict], unanswered: list[dict]) -> None:
+    if not verdicts.VERDICT_CACHE or not checked:
+        return
+    left = {id(c) for c in unanswered}
+    verdicts.save(
+        (
+            c["etype"], c["eid"], str(c["last"].get("ID") or ""), _dialog_marker(c["last"]),
+            "unanswered" if id(c) in left else c.get("verdict") or "unanswered",
+            c.get("evidence") if id(c) not in left else None,
+        )
+        for c in checked
+    )
+    verdicts.prune((datetime.now(timezone.utc) - timedelta(days=WINDOW_DAYS + 1)).timestamp())
 
-            if lm:
-                msg, users = lm
-                author_id = int(msg.get("author_id") or msg.get("AUTHOR_ID") or 0)
-                # если последнее сообщение от МЕНЕДЖЕРА — тревогу не формируем
-                if author_id and _is_user_manager(author_id, users):
-                    continue
-                # если последнее сообщение от клиента — оставляем кейс на дальнейшие проверки
-        # если dialog_id отсутствует или пустой — просто не делаем вызов к im.dialog.messages.get
-
-        # 3) Был ли звонок после входящего (любой успешный)
-        phone = communications_first_phone(last.get("COMMUNICATIONS"))
-        if has_success_call_after(etype, eid, _iso(t_in), phone):
-            continue
+# Итоги по всем кандидатам последнего скана — в историю (history.py) вместе с тревогами
+_scan_verdicts: list[dict] = []
 
-        # 4) иначе — тревога
-        alerts.append({
-            "owner_type_id": etype,
-            "owner_id": eid,
-            "last_in_created": created_raw,
-            "provider_id": last.get("PROVIDER_ID"),
-            "phone": phone,
-            "activity_id": last.get("ID"),
-            "subject": last.get("SUBJECT") or "",
-        })
+def scan_verdicts() -> list[dict]:
+    """Итог проверки каждого кандидата последнего скана: ответили / дозвонились / без ответа и чем подтверждено."""
+    return list(_scan_verdicts)
+
+def _report_verdicts(cands: list[dict], unanswered: list[dict]) -> None:
+    global _scan_verdicts
+    left = {id(c) for c in unanswered}
+    _scan_verdicts = [
+        {
+            "owner_type_id": c["etype"],
+            "owner_id": c["eid"],
+            "provider_id": c["last"].get("PROVIDER_ID") or "",
+            "in_ts": c["t_in"].timestamp(),
+            "activity_id": str(c["last"].get("ID") or ""),
+            "outcome": "unanswered" if id(c) in left else c.get("verdict") or "unanswered",
+            "evidence": None if id(c) in left else c.get("evidence"),
+            "cached": bool(c.get("cached")),
+        }
+        for c in cands
+    ]
+
+def _to_alert(c: dict) -> dict:
+    last = c["last"]
+    return {
+        "owner_type_id": c["etype"],
+        "owner_id": c["eid"],
+        "last_in_created": str(last.get("CREATED")),
+        "provider_id": last.get("PROVIDER_ID"),
+        "phone": c["phone"],
+        "activity_id": last.get("ID"),
+        "subject": last.get("SUBJECT") or "",
+    }
+
+def _poll_candidates(cands: list[dict], now_utc: datetime) -> list[dict]:
+    """Проверки ответа, диалога и звонка; возвращает кандидатов без ответа."""
+    window_since = now_utc - timedelta(days=WINDOW_DAYS)
+    use_index = len(cands) >= max(INDEX_MIN_CANDIDATES, 1)
+    reply_index = (
+        _build_index("reply_index", build_reply_index, window_since)
+        if REPLY_CHECK_MODE == "index" and use_index else None
+    )
+    call_index = (
+        _build_index("call_index", build_call_index, window_since)
+        if CALL_CHECK_MODE == "index" and use_index else None
+    )
+    left = _run_stages(cands, _plan_stages(reply_index, call_index))
+    _save_verdicts(cands, left)
+    return left
+
+# === Тревоги из состояния событий (DETECT_MODE=events) ===
+def _seed_entity_state() -> None:
+    """
+    Первый запуск в режиме событий: один обычный опрос без ожидания SLA —
+    всё, что сейчас без ответа, попадает в состояние; дальше его ведут события.
+    """
+    now_utc = datetime.now(timezone.utc)
+    cands = _collect_candidates(fetch_recent_incoming_messages(), now_utc, sla_min=0)
+    for c in _poll_candidates(cands, now_utc):
+        last = c["last"]
+        entity_state.mark_incoming(
+            c["etype"], c["eid"], c["t_in"].timestamp(),
+            created_raw=str(last.get("CREATED") or ""),
+            activity_id=str(last.get("ID") or ""),
+            provider_id=str(last.get("PROVIDER_ID") or ""),
+            phone=c["phone"],
+            subject=str(last.get("SUBJECT") or ""),
+            dialog_id=c["dialog_id"],
+        )
+        if (now_utc - c["t_in"]).total_seconds() >= RESPONSE_SLA_MIN * 60:
+            # только что проверено опросом — таймеру SLA перепроверять нечего
+            entity_state.mark_overdue(c["etype"], c["eid"], now_utc.timestamp())
+    entity_state.mark_seeded()
+
+def alerts_from_events() -> list[dict]:
+    """Дайджест — только сущности, у которых SLA уже истёк (их по одной ведут sla_timers)."""
+    if not entity_state.is_seeded():
+        _seed_entity_state()
+        import sla_timers
+        sla_timers.rebuild()  # дедлайны для всего, что попало в состояние при заполнении
+    return entity_state.awaiting(RESPONSE_SLA_MIN * 60)
+
+def _enrich(alerts: list[dict]) -> list[dict]:
+    """Название, ответственный и ссылка на карточку (enrichment.py) — вне времени скана."""
+    return _timed("enrich", enrichment.enrich)(alerts)
+
+def detect_alerts():
+    """
+    Возвращает список словарей:
+    {
+      'owner_type_id', 'owner_id', 'last_in_created',
+      'provider_id', 'phone', 'activity_id', 'subject',
+      'title', 'responsible_id', 'responsible_name', 'url'   # если ENRICH_ALERTS=1
+    }
+    """
+    if DETECT_MODE == "events":
+        _report_verdicts([], [])
+        return _enrich(alerts_from_events())
+
+    with SCAN_SECONDS.time(mode="sync"):
+        incomings = _timed("fetch_incomings", fetch_recent_incoming_messages)()
+        now_utc = datetime.now(timezone.utc)
+        cands = _collect_candidates(incomings, now_utc)
+        SCAN_CANDIDATES.set(len(cands))
+
+        # 4) оставшиеся после проверок — тревоги
+        left = _poll_candidates(_skip_resolved(cands), now_utc)
+        _report_verdicts(cands, left)
+        alerts = [_to_alert(c) for c in left]
+    SCAN_ALERTS.set(len(alerts))
+    return _enrich(alerts)
+
+# === Асинхронный скан ===
+async def _none():
+    return None
+
+async def detect_alerts_async():
+    """
+    То же, что detect_alerts, но не блокирует event loop:
+    - индексы ответов и звонков выгружаются одновременно (с VERDICT_CACHE=0 — вместе со входящими,
+      иначе после кэша итогов и только если перепроверять не меньше INDEX_MIN_CANDIDATES сущностей);
+    - кандидаты делятся на группы по SCAN_CHUNK_SIZE и проверяются параллельно,
+      не больше SCAN_CONCURRENCY групп сразу (внутри группы — те же batch-стадии).
+    Стадии — синхронный код в рабочих потоках: у requests нет asyncio-транспорта, а все запросы
+    и так проходят через общий лимитер bitrix.py.
+    """
+    if DETECT_MODE == "events":
+        _report_verdicts([], [])
+        return await asyncio.to_thread(lambda: _enrich(alerts_from_events()))
+
+    with SCAN_SECONDS.time(mode="async"):
+        alerts = await _detect_alerts_async()
+    SCAN_ALERTS.set(len(alerts))
+    return await asyncio.to_thread(_enrich, alerts)
+
+def _build_indexes(window_since: datetime, enabled: bool = True):
+    """Корутины выгрузки индексов ответов и звонков (или заглушки, если индекс не нужен)."""
+    return (
+        asyncio.to_thread(_build_index, "reply_index", build_reply_index, window_since)
+        if REPLY_CHECK_MODE == "index" and enabled else _none(),
+        asyncio.to_thread(_build_index, "call_index", build_call_index, window_since)
+        if CALL_CHECK_MODE == "index" and enabled else _none(),
+    )
+
+async def _detect_alerts_async():
+    now_utc = datetime.now(timezone.utc)
+    window_since = now_utc - timedelta(days=WINDOW_DAYS)
+    fetch = asyncio.to_thread(_timed("fetch_incomings", fetch_recent_incoming_messages))
+
+    if verdicts.VERDICT_CACHE:
+        # Сначала входящие и кэш итогов: индексы нужны, только если перепроверять много сущностей
+        incomings = await fetch
+        found = _collect_candidates(incomings, now_utc)
+        SCAN_CANDIDATES.set(len(found))
+        cands = await asyncio.to_thread(_skip_resolved, found)
+        reply_index, call_index = await asyncio.gather(
+            *_build_indexes(window_since, len(cands) >= max(INDEX_MIN_CANDIDATES, 1))
+        )
+    else:
+        incomings, reply_index, call_index = await asyncio.gather(fetch, *_build_indexes(window_since))
+        found = cands = _collect_candidates(incomings, now_utc)
+        SCAN_CANDIDATES.set(len(cands))
+    stages = _plan_stages(reply_index, call_index)
+
+    sem = asyncio.Semaphore(max(SCAN_CONCURRENCY, 1))
+
+    async def run(part: list[dict]) -> list[dict]:
+        async with sem:
+            return await asyncio.to_thread(_run_stages, part, stages)
 
-    return alerts
+    size = max(SCAN_CHUNK_SIZE, 1)
+    parts = await asyncio.gather(*(run(cands[i:i + size]) for i in range(0, len(cands), size)))
+    left = [c for part in parts for c in part]
+    await asyncio.to_thread(_save_verdicts, cands, left)
+    _report_verdicts(found, left)
+    return [_to_alert(c) for c in left]
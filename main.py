@@ -1,16 +1,31 @@
 # main.py — ежедневный запуск в 19:00, с сохранением всех debug-эндпоинтов
 
+import asyncio
 import os
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 
-from fastapi import FastAPI, Request, Query
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.responses import PlainTextResponse
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
-from logic import detect_alerts
-from telegram_bot import send_message, format_alerts
-from bitrix import list_activities
+from logic import detect_alerts_async, incoming_coverage, index_coverage, scan_verdicts
+import telegram_bot
+from telegram_bot import send_message, send_error, format_alerts
+from bitrix import iter_activities, call_log_status, operating_usage, probe_call_methods
+import analytics
+import dialogs
+import enrichment
+import events
+import history
+import http_client
+import metrics
+import portals
+import provider_stats
+import sla_timers
+import verdicts
+from scans import ScanManager
 
 # === Настройки планировщика ===
 TZ_NAME = os.getenv("TIMEZONE", "Europe/Moscow")
@@ -27,15 +42,51 @@ app = FastAPI(title="Bitrix Alerts")
 # === Планировщик: один раз в день ===
 scheduler = AsyncIOScheduler(timezone=TZ)
 
-def job_scan():
-    """Ежедневная задача: собрать тревоги и отправить отчёт в Telegram."""
+async def _scan_and_send():
+    """Скан + отчёт в Telegram (один на скан, сколько бы запросов к нему ни присоединилось)."""
     try:
-        alerts = detect_alerts()
+        alerts = await detect_alerts_async()
         text = format_alerts(alerts)  # твоя функция форматирования
-        # Отправляем ежедневный дайджест всегда (и когда пусто — придёт 'На сейчас тревог нет.')
+        # Отправляем дайджест всегда (и когда пусто — придёт 'На сейчас тревог нет.').
+        # Отправка — в фоновой очереди, скан её не ждёт
         send_message(text)
+        return alerts, scan_verdicts()
     except Exception as e:
-        send_message(f"❗️Ошибка скана: {e}")
+        send_error(f"❗️Ошибка скана: {e}")
+        raise
+
+# Несколько порталов (PORTALS_CONFIG): у каждого свой процесс-воркер и свой менеджер сканов.
+# Иначе — один портал из окружения, скан в этом процессе.
+PORTALS = portals.load()
+if PORTALS:
+    scanners = {p.name: ScanManager(p.scan_and_send, name=p.name) for p in PORTALS}
+else:
+    scanners = {"": ScanManager(_scan_and_send)}
+
+# События и таймеры SLA ведут состояние портала из B24_WEBHOOK самого сервиса. С PORTALS_CONFIG
+# без него обращаться не к кому: приём событий отключён явно, а не падает в фоновом потоке
+EVENTS_DISABLED = "PORTALS_CONFIG без B24_WEBHOOK сервиса" if PORTALS and not os.getenv("B24_WEBHOOK") else ""
+
+def _scanner(portal: str | None) -> ScanManager:
+    if portal is None:
+        return next(iter(scanners.values()))
+    if portal not in scanners:
+        raise HTTPException(404, f"unknown portal {portal!r}")
+    return scanners[portal]
+
+def _find_job(scan_id: str):
+    for m in scanners.values():
+        job = m.get(scan_id)
+        if job is not None:
+            return job
+    raise HTTPException(404, "scan not found")
+
+async def job_scan():
+    """
+    Ежедневная задача: собрать тревоги и отправить отчёт в Telegram (или дождаться уже идущего скана).
+    Порталы сканируются параллельно, каждый отправляет свой дайджест, как только готов.
+    """
+    await asyncio.gather(*(m.run("schedule") for m in scanners.values()))
 
 @app.on_event("startup")
 def _on_startup():
@@ -48,34 +99,172 @@ def _on_startup():
     scheduler.start()
     print(f"[SCHEDULER] План: каждый день в {SCHEDULE_HOUR:02d}:{SCHEDULE_MINUTE:02d} ({TZ_NAME})")
 
+    if PORTALS:
+        print(f"[PORTALS] {', '.join(p.name for p in PORTALS)}")
+    if os.getenv("B24_WEBHOOK"):
+        # Какие методы журнала звонков есть на портале — выясняем в фоне, не в первом скане
+        probe_call_methods()
+    if EVENTS_DISABLED:
+        print(f"[EVENTS] /bitrix/events и таймеры SLA отключены: {EVENTS_DISABLED}")
+    else:
+        events.start()
+        sla_timers.start()
+
 @app.on_event("shutdown")
 def _on_shutdown():
     scheduler.shutdown(wait=False)
+    for p in PORTALS:
+        p.shutdown()
+    telegram_bot.flush(timeout=5)
 
 # === Служебные эндпоинты ===
 
 @app.get("/health")
 def health():
     now = datetime.now(TZ).isoformat()
-    return {"ok": True, "time": now, "timezone": TZ_NAME}
+    return {
+        "ok": True,
+        "time": now,
+        "timezone": TZ_NAME,
+        "call_log": call_log_status(),
+        "incoming": incoming_coverage(),
+        "indexes": index_coverage(),
+        "bitrix_operating": operating_usage(),
+        "http": http_client.stats(),
+        "events": {"disabled": EVENTS_DISABLED} if EVENTS_DISABLED else events.stats(),
+        "sla_timers": {"disabled": EVENTS_DISABLED} if EVENTS_DISABLED else sla_timers.stats(),
+        "verdicts": verdicts.stats(),
+        "dialogs": dialogs.stats(),
+        "enrichment": enrichment.stats(),
+        "history": history.stats(),
+        "portals": [p.info() for p in PORTALS],
+        "telegram": telegram_bot.stats(),
+    }
+
+@app.get("/metrics")
+def prometheus_metrics():
+    """Счётчики и гистограммы вызовов Bitrix/Telegram и стадий скана (формат Prometheus)."""
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+async def _submit(m: ScanManager, wait: bool) -> dict:
+    job, started = m.submit("manual")
+    if wait:
+        await job.done.wait()
+        if job.status == "failed":
+            return {"id": job.id, "portal": job.portal or None, "error": job.error}
+        return {"id": job.id, "portal": job.portal or None, "alerts": job.alerts, "sent": True}
+    return {**job.info(), "started": started, "status_url": f"/scans/{job.id}"}
 
 @app.post("/run-scan")
-async def run_scan():
-    """Ручной запуск из Swagger/curl."""
+async def run_scan(
+    wait: bool = Query(False, description="дождаться результата (как раньше)"),
+    portal: str | None = Query(None, description="имя портала из PORTALS_CONFIG; пусто — все"),
+):
+    """
+    Ручной запуск из Swagger/curl. Скан идёт в фоне; если он уже идёт — присоединяемся к нему.
+    Статус и результат — /scans/{id}, /scans/{id}/result.
+    """
+    if portal is not None or len(scanners) == 1:
+        return await _submit(_scanner(portal), wait)
+    return {"scans": await asyncio.gather(*(_submit(m, wait) for m in scanners.values()))}
+
+@app.get("/scans")
+def scans_list():
+    current = [j.info() for j in (m.current() for m in scanners.values()) if j]
+    jobs = sorted((j for m in scanners.values() for j in m.jobs()), key=lambda j: j["started_at"], reverse=True)
+    if len(scanners) == 1:
+        return {"current": current[0] if current else None, "jobs": jobs}
+    return {"current": current, "jobs": jobs}
+
+@app.get("/scans/latest")
+def scans_latest(portal: str | None = Query(None, description="имя портала; пусто — первый")):
+    """Последний успешный скан — без нового похода в Bitrix."""
+    latest = _scanner(portal).latest()
+    if latest is None:
+        raise HTTPException(404, "no finished scans yet")
+    return latest
+
+@app.get("/scans/{scan_id}")
+def scan_status(scan_id: str):
+    return _find_job(scan_id).info()
+
+@app.get("/scans/{scan_id}/result")
+def scan_result(scan_id: str):
+    job = _find_job(scan_id)
+    if not job.finished:
+        raise HTTPException(409, "scan is still running")
+    return job.result()
+
+@app.get("/alerts")
+def alerts_history(
+    portal: str | None = Query(None, description="имя портала; пусто — первый"),
+    scan_id: str | None = Query(None, description="тревоги одного скана; без него и периода — последнего"),
+    since: datetime | None = Query(None),
+    until: datetime | None = Query(None),
+    owner_type_id: str | None = Query(None),
+    owner_id: str | None = Query(None),
+    provider_id: str | None = Query(None),
+    responsible_id: str | None = Query(None),
+    limit: int = Query(100, ge=1, le=history.HISTORY_PAGE_MAX),
+    cursor: int | None = Query(None, description="next_cursor предыдущей страницы"),
+):
+    """История тревог (history.py) — только из локальной базы, без запросов к Bitrix."""
+    return history.alerts(
+        _scanner(portal).name, scan_id, since, until,
+        owner_type_id, owner_id, provider_id, responsible_id, limit, cursor,
+    )
+
+@app.get("/alerts/verdicts")
+def alerts_verdicts(
+    portal: str | None = Query(None, description="имя портала; пусто — первый"),
+    scan_id: str | None = Query(None, description="пусто — последний успешный скан"),
+    owner_type_id: str | None = Query(None),
+    owner_id: str | None = Query(None),
+    outcome: str | None = Query(None, description="replied / operator_last / called / unanswered"),
+    limit: int = Query(100, ge=1, le=history.HISTORY_PAGE_MAX),
+):
+    """Итоги проверки всех кандидатов скана (history.py): чем подтверждён ответ или почему тревога."""
+    return history.verdicts(_scanner(portal).name, scan_id, owner_type_id, owner_id, outcome, limit)
+
+@app.get("/alerts/trends")
+def alerts_trends(
+    portal: str | None = Query(None, description="имя портала; пусто — первый"),
+    days: int = Query(30, ge=1, le=365),
+    group_by: str | None = Query(None, description="provider / responsible / entity_type"),
+):
+    """Тревоги по дням из истории: сканы, тревоги в последнем скане дня, разные сущности без ответа."""
     try:
-        alerts = detect_alerts()
-        txt = format_alerts(alerts)
-        send_message(txt)
-        return {"alerts": alerts, "sent": True}
-    except Exception as e:
-        send_message(f"❗️Ошибка скана: {e}")
-        return {"error": str(e)}
+        return history.trends(_scanner(portal).name, days, group_by)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+
+@app.get("/analytics/response-times")
+async def analytics_response_times(
+    days: int = Query(30, ge=1, le=analytics.ANALYTICS_MAX_DAYS),
+    sla_min: int | None = Query(None, ge=0, description="порог SLA в минутах; пусто — RESPONSE_SLA_MIN"),
+    refresh: bool = Query(False, description="пересчитать, не дожидаясь ANALYTICS_TTL"),
+    portal: str | None = Query(None, description="имя портала из PORTALS_CONFIG; пусто — первый"),
+):
+    """
+    Время первого ответа за N дней (analytics.py): перцентили и доля нарушений SLA
+    по менеджерам, каналам и типам сущностей. Первый расчёт за 90 дней — минуты.
+    """
+    if PORTALS:
+        target = next((p for p in PORTALS if p.name == portal), None) if portal else PORTALS[0]
+        if target is None:
+            raise HTTPException(404, f"unknown portal {portal!r}")
+        return await target.run(analytics.report, days, sla_min, refresh)
+    return await asyncio.to_thread(analytics.report, days, sla_min, refresh)
 
-# Приём событий Битрикса (можно расширить позже)
+# Приём событий Битрикса: OnCrmActivityAdd/Update и сообщения открытых линий.
+# Отвечаем сразу, обработка — в фоновой очереди (events.py)
 @app.post("/bitrix/events")
 async def bitrix_events(request: Request):
-    data = await request.json()
-    return {"result": "ok", "echo": data}
+    if EVENTS_DISABLED:
+        raise HTTPException(503, f"события отключены: {EVENTS_DISABLED}")
+    body = await request.body()
+    payload = events.parse_payload(body, request.headers.get("content-type", ""))
+    return events.accept(payload)
 
 # === Debug утилиты (сохранены как у тебя) ===
 
@@ -92,46 +281,35 @@ def debug_last_incomings(
     Вернём ID, CREATED, PROVIDER_ID, PROVIDER_TYPE_ID, OWNER_TYPE/ID.
     """
     since = _iso(datetime.now(timezone.utc) - timedelta(days=days))
-    rows = list_activities(
+    # Новые первыми (по ID); листаем ровно до limit строк
+    return list(iter_activities(
         {"DIRECTION": 2, ">=CREATED": since},
-        order={"CREATED": "DESC"},
-        select=[
+        [
             "ID","CREATED","PROVIDER_ID","PROVIDER_TYPE_ID","DIRECTION",
             "OWNER_TYPE_ID","OWNER_ID","COMMUNICATIONS","AUTHOR_ID","SUBJECT"
-        ]
-    )
-    return rows[:limit]
+        ],
+        descending=True,
+        max_rows=limit,
+    ))
 
 @app.get("/debug/providers-summary")
-def debug_providers_summary(
-    days: int = Query(30, ge=1, le=365),
-    limit: int = Query(2000, ge=100, le=10000),
-):
+def debug_providers_summary(days: int = Query(30, ge=1, le=365)):
     """
     Сводка по каналам за N дней: сколько входящих по каждому PROVIDER_ID/TYPE.
+    Считается по дневному агрегату (provider_stats.py): из Bitrix забираются только новые строки.
     """
-    from collections import Counter
-
-    since = _iso(datetime.now(timezone.utc) - timedelta(days=days))
-    rows = list_activities(
-        {"DIRECTION": 2, ">=CREATED": since},
-        order={"CREATED": "DESC"},
-        select=["PROVIDER_ID","PROVIDER_TYPE_ID"]
-    )
-    rows = rows[:limit]
-
-    by_provider = Counter((r.get("PROVIDER_ID") or "").upper() for r in rows)
-    by_type = Counter((r.get("PROVIDER_TYPE_ID") or "").upper() for r in rows)
-
+    stats = provider_stats.summary(days)
     return {
-        "total_sampled": len(rows),
+        "total_sampled": stats["total"],
+        "since_day": stats["since_day"],
+        "refreshed_age_sec": stats["refreshed_age_sec"],
         "by_PROVIDER_ID": [
             {"PROVIDER_ID": k or "(empty)", "count": v}
-            for k, v in by_provider.most_common()
+            for k, v in stats["by_PROVIDER_ID"]
         ],
         "by_PROVIDER_TYPE_ID": [
             {"PROVIDER_TYPE_ID": k or "(empty)", "count": v}
-            for k, v in by_type.most_common()
+            for k, v in stats["by_PROVIDER_TYPE_ID"]
         ]
     }
 
@@ -146,16 +324,16 @@ def debug_activities_by_entity(
     Все активности по конкретной сущности за N дней — удобно смотреть конкретный кейс.
     """
     since = _iso(datetime.now(timezone.utc) - timedelta(days=days))
-    rows = list_activities(
+    return list(iter_activities(
         {
             "OWNER_TYPE_ID": owner_type_id,
             "OWNER_ID": owner_id,
             ">=CREATED": since,
         },
-        order={"CREATED": "DESC"},
-        select=[
+        [
             "ID","CREATED","TYPE_ID","PROVIDER_ID","PROVIDER_TYPE_ID","DIRECTION",
             "SUBJECT","COMPLETED","AUTHOR_ID"
-        ]
-    )
-    return rows[:limit]
+        ],
+        descending=True,
+        max_rows=limit,
+    ))
@@ -0,0 +1,180 @@
+# metrics.py — счётчики и гистограммы в текстовом формате Prometheus (для /metrics)
+from __future__ import annotations
+
+import threading
+import time
+import typing as t
+from contextlib import contextmanager
+
+# Границы гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_Labels = t.Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_labels(names: t.Sequence[str], values: _Labels, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: t.Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: t.Mapping[str, t.Any]) -> _Labels:
+        return tuple(str(labels.get(n, "")) for n in self.label_names)
+
+    def _samples(self) -> t.List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        return "\n".join(lines + self._samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: t.Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: t.Dict[_Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: t.Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: t.Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> t.List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.label_names, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: t.Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: t.Sequence[str] = (),
+        buckets: t.Sequence[float] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._values: t.Dict[_Labels, list] = {}  # [счётчики по корзинам..., сумма, количество]
+
+    def observe(self, value: float, **labels: t.Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    @contextmanager
+    def time(self, **labels: t.Any) -> t.Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self) -> t.List[str]:
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._values.items())
+        out: t.List[str] = []
+        for key, row in items:
+            for bound, n in zip(self.buckets, row):
+                le = f'le="{_fmt_value(bound)}"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, le)} {n}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {_fmt_value(row[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {row[-1]}")
+        return out
+
+
+# ---------------------------
+#  Реестр
+# ---------------------------
+_registry_lock = threading.Lock()
+_registry: t.Dict[str, _Metric] = {}
+
+
+def _register(metric: _Metric) -> t.Any:
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing  # повторный импорт модуля не плодит дубликаты
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name: str, help: str, labels: t.Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: t.Sequence[str] = ()) -> Gauge:
+    return _register(Gauge(name, help, labels))
+
+
+def histogram(
+    name: str,
+    help: str,
+    labels: t.Sequence[str] = (),
+    buckets: t.Sequence[float] = LATENCY_BUCKETS,
+) -> Histogram:
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def render() -> str:
+    """Все метрики в текстовом формате экспозиции Prometheus 0.0.4."""
+    with _registry_lock:
+        metrics = [_registry[k] for k in sorted(_registry)]
+    return "\n".join(m.render() for m in metrics) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+__all__ = [
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "counter",
+    "gauge",
+    "histogram",
+    "render",
+    "CONTENT_TYPE",
+]
@@ -0,0 +1,135 @@
+# portals.py — несколько порталов Битрикс24: конфигурация из файла и скан каждого в своём процессе
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import re
+import typing as t
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing as mp
+
+# JSON-файл со списком порталов; пусто — один портал из переменных окружения (как раньше)
+PORTALS_CONFIG = os.getenv("PORTALS_CONFIG") or ""
+
+_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+class Portal:
+    """
+    Портал = имя + переопределения переменных окружения (B24_WEBHOOK, TELEGRAM_CHAT_ID,
+    WINDOW_DAYS, ...); остальное наследуется из окружения сервиса.
+    Сканы идут в отдельном процессе портала (пул из одного воркера): модули logic/bitrix
+    настраиваются при импорте, так что у каждого портала свои настройки, лимитер запросов,
+    пул соединений, кэши и SQLite-база. Медленный портал не задерживает дайджесты остальных.
+    """
+
+    def __init__(self, name: str, env: t.Mapping[str, str]):
+        self.name = name
+        self.env = {"STORE_PATH": f"{name}.sqlite3", **env}
+        self._executor: ProcessPoolExecutor | None = None
+        self._aux: ProcessPoolExecutor | None = None
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=mp.get_context("spawn"),  # чистый импорт модулей с окружением портала
+            initializer=_init_worker,
+            initargs=(self.env,),
+        )
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = self._new_pool()
+        return self._executor
+
+    async def scan_and_send(self) -> tuple[t.List[dict], t.List[dict]]:
+        """Скан портала и дайджест в его чат; возвращает (тревоги, итоги по кандидатам)."""
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._pool(), _scan_and_send)
+        except BrokenProcessPool:
+            # воркер упал (OOM и т.п.) — следующий скан поднимет новый процесс
+            self._executor = None
+            raise RuntimeError(f"portal {self.name}: worker process died")
+
+    async def run(self, fn: t.Callable[..., t.Any], *args: t.Any) -> t.Any:
+        """
+        Долгая задача с окружением портала (аналитика и т.п.) — в отдельном процессе,
+        чтобы не задерживать сканы. fn должна быть функцией уровня модуля (pickle).
+        """
+        if self._aux is None:
+            self._aux = self._new_pool()
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._aux, fn, *args)
+        except BrokenProcessPool:
+            self._aux = None
+            raise RuntimeError(f"portal {self.name}: worker process died")
+
+    def shutdown(self) -> None:
+        for pool in (self._executor, self._aux):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._aux = None
+
+    def info(self) -> dict:
+        webhook = self.env.get("B24_WEBHOOK") or ""
+        host = re.sub(r"^https?://", "", webhook).split("/", 1)[0]
+        return {"name": self.name, "host": host, "store_path": self.env["STORE_PATH"]}
+
+
+def _parse(data: t.Any) -> t.List[Portal]:
+    items = data.get("portals") if isinstance(data, dict) else data
+    if not isinstance(items, list):
+        raise RuntimeError("PORTALS_CONFIG: ожидается список порталов или {\"portals\": [...]}")
+    portals: t.List[Portal] = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise RuntimeError(f"PORTALS_CONFIG: портал должен быть объектом: {item!r}")
+        name = str(item.get("name") or "")
+        if not _NAME_RE.match(name):
+            raise RuntimeError(f"PORTALS_CONFIG: недопустимое имя портала {name!r}")
+        if any(p.name == name for p in portals):
+            raise RuntimeError(f"PORTALS_CONFIG: портал {name!r} указан дважды")
+        env = {str(k): str(v) for k, v in item.items() if k != "name" and v is not None}
+        if not env.get("B24_WEBHOOK"):
+            raise RuntimeError(f"PORTALS_CONFIG: у портала {name!r} нет B24_WEBHOOK")
+        if (env.get("DETECT_MODE") or os.getenv("DETECT_MODE") or "poll").strip().lower() == "events":
+            # события принимает процесс сервиса, в базу портала они не попадут — сканы бы устаревали
+            raise RuntimeError(f"PORTALS_CONFIG: у портала {name!r} DETECT_MODE=events не поддерживается")
+        portals.append(Portal(name, env))
+    return portals
+
+
+def load(path: str = PORTALS_CONFIG) -> t.List[Portal]:
+    """Порталы из файла конфигурации; [] — файл не задан (режим одного портала)."""
+    if not path:
+        return []
+    with open(path, encoding="utf-8") as f:
+        return _parse(json.load(f))
+
+
+# ---------------------------
+#  Код воркера (выполняется в процессе портала)
+# ---------------------------
+def _init_worker(env: t.Mapping[str, str]) -> None:
+    os.environ.update(env)
+
+
+def _scan_and_send() -> tuple[t.List[dict], t.List[dict]]:
+    from logic import detect_alerts_async, scan_verdicts
+    from telegram_bot import format_alerts, send_error, send_message
+
+    # Очередь Telegram живёт в процессе портала и досылает дайджест уже после возврата
+    try:
+        alerts = asyncio.run(detect_alerts_async())
+    except Exception as e:
+        send_error(f"❗️Ошибка скана: {e}")
+        raise RuntimeError(str(e))  # исключение должно пережить pickle на пути в основной процесс
+    send_message(format_alerts(alerts))
+    return alerts, scan_verdicts()
+
+
+__all__ = ["Portal", "load", "PORTALS_CONFIG"]
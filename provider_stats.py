@@ -0,0 +1,135 @@
+# provider_stats.py — входящие по каналам (PROVIDER_ID / PROVIDER_TYPE_ID) по дням: инкрементальный агрегат в SQLite
+from __future__ import annotations
+
+import os
+import threading
+import time
+import typing as t
+from datetime import date, datetime, timedelta, timezone
+
+from bitrix import iter_activities
+from storage import ensure_schema, get_state, set_state, transaction
+
+# Чаще раза в N секунд за новыми строками в Bitrix не ходим (кнопка в Swagger, автообновление)
+PROVIDER_SUMMARY_TTL = float(os.getenv("PROVIDER_SUMMARY_TTL", "300"))
+MAX_DAYS = 365
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS provider_daily (
+    day              TEXT NOT NULL,     -- дата CREATED (UTC), YYYY-MM-DD
+    provider_id      TEXT NOT NULL,
+    provider_type_id TEXT NOT NULL,
+    n                INTEGER NOT NULL,
+    PRIMARY KEY (day, provider_id, provider_type_id)
+);
+"""
+
+_MAX_ID_KEY = "provider_daily.max_id"        # строки с ID до этого уже посчитаны
+_COVERED_KEY = "provider_daily.covered_day"  # с какого дня агрегат полный
+
+_lock = threading.Lock()
+_refreshed_at = 0.0
+
+
+def _day(created: t.Any) -> str:
+    s = str(created or "")
+    if s.endswith("Z"):
+        s = s[:-1] + "+00:00"
+    return datetime.fromisoformat(s).astimezone(timezone.utc).date().isoformat()
+
+
+def _count(flt: dict) -> tuple[t.Dict[tuple[str, str, str], int], int]:
+    """Проход по входящим keyset-ом по ID: ({(день, канал, тип): n}, максимальный ID)."""
+    buckets: t.Dict[tuple[str, str, str], int] = {}
+    max_id = 0
+    for r in iter_activities({**flt, "DIRECTION": 2}, ["ID", "CREATED", "PROVIDER_ID", "PROVIDER_TYPE_ID"]):
+        key = (
+            _day(r.get("CREATED")),
+            str(r.get("PROVIDER_ID") or "").upper(),
+            str(r.get("PROVIDER_TYPE_ID") or "").upper(),
+        )
+        buckets[key] = buckets.get(key, 0) + 1
+        max_id = max(max_id, int(r["ID"]))
+    return buckets, max_id
+
+
+def _add(buckets: t.Dict[tuple[str, str, str], int]) -> None:
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT INTO provider_daily(day, provider_id, provider_type_id, n) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(day, provider_id, provider_type_id) DO UPDATE SET n = n + excluded.n",
+            [(*k, n) for k, n in buckets.items()],
+        )
+
+
+def refresh(since_day: date, *, force: bool = False) -> None:
+    """
+    Досчитывает агрегат:
+      - новые строки — только ID больше уже посчитанного максимума;
+      - если нужен более ранний период — один раз добираем дни до covered_day
+        (ID не больше максимума, чтобы не посчитать строку дважды).
+    Изменение канала у старой активности агрегат не видит — для сводки это допустимо.
+    """
+    global _refreshed_at
+    ensure_schema("provider_daily", _DDL)
+    with _lock:
+        covered = get_state(_COVERED_KEY)
+        max_id = int(get_state(_MAX_ID_KEY) or 0)
+        need_backfill = covered is None or since_day.isoformat() < covered
+        if not force and not need_backfill and time.time() - _refreshed_at < PROVIDER_SUMMARY_TTL:
+            return
+
+        since_iso = datetime.combine(since_day, datetime.min.time(), timezone.utc).isoformat()
+        if covered is None:
+            buckets, seen = _count({">=CREATED": since_iso})
+            _add(buckets)
+            max_id = max(max_id, seen)
+        else:
+            if need_backfill:
+                buckets, _ = _count({
+                    ">=CREATED": since_iso,
+                    "<CREATED": datetime.combine(date.fromisoformat(covered), datetime.min.time(), timezone.utc).isoformat(),
+                    "<=ID": max_id,
+                })
+                _add(buckets)
+            buckets, seen = _count({">ID": max_id})
+            _add(buckets)
+            max_id = max(max_id, seen)
+
+        oldest = (datetime.now(timezone.utc).date() - timedelta(days=MAX_DAYS)).isoformat()
+        with transaction() as conn:
+            conn.execute("DELETE FROM provider_daily WHERE day < ?", (oldest,))
+        if need_backfill:
+            set_state(_COVERED_KEY, since_day.isoformat())
+        set_state(_MAX_ID_KEY, str(max_id))
+        _refreshed_at = time.time()
+
+
+def summary(days: int) -> dict:
+    """Сводка входящих по каналам за последние days дней (по дням CREATED, UTC)."""
+    days = max(1, min(int(days), MAX_DAYS))
+    since_day = datetime.now(timezone.utc).date() - timedelta(days=days)
+    refresh(since_day)
+
+    by_provider: t.Dict[str, int] = {}
+    by_type: t.Dict[str, int] = {}
+    with transaction() as conn:
+        rows = conn.execute(
+            "SELECT provider_id, provider_type_id, SUM(n) AS n FROM provider_daily "
+            "WHERE day >= ? GROUP BY provider_id, provider_type_id",
+            (since_day.isoformat(),),
+        ).fetchall()
+    for r in rows:
+        by_provider[r["provider_id"]] = by_provider.get(r["provider_id"], 0) + r["n"]
+        by_type[r["provider_type_id"]] = by_type.get(r["provider_type_id"], 0) + r["n"]
+
+    return {
+        "since_day": since_day.isoformat(),
+        "total": sum(by_provider.values()),
+        "by_PROVIDER_ID": sorted(by_provider.items(), key=lambda kv: -kv[1]),
+        "by_PROVIDER_TYPE_ID": sorted(by_type.items(), key=lambda kv: -kv[1]),
+        "refreshed_age_sec": round(time.time() - _refreshed_at, 1),
+    }
+
+
+__all__ = ["refresh", "summary", "PROVIDER_SUMMARY_TTL"]
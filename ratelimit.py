@@ -0,0 +1,100 @@
+# ratelimit.py — token bucket под лимит запросов Bitrix (общий для всех потоков)
+from __future__ import annotations
+
+import threading
+import time
+import typing as t
+from collections import deque
+
+
+class TokenBucket:
+    """
+    Классический token bucket: rate токенов в секунду, не больше burst в запасе.
+    Битрикс считает запросы так же (leaky bucket: ~2 запроса/с, запас 50),
+    поэтому, держась чуть ниже его параметров, мы не получаем QUERY_LIMIT_EXCEEDED.
+    rate <= 0 — ограничение выключено.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Забирает токен, если есть; иначе возвращает, сколько секунд ждать."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        while True:
+            wait = self._take()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+class OperatingBudget:
+    """
+    Квота Битрикса на время выполнения: у каждого метода не больше limit секунд
+    time.operating за скользящие window секунд, дальше метод блокируется на портале.
+    Считаем ту же сумму у себя и, когда она подходит к soft * limit, придерживаем вызовы
+    метода, пока старые записи не выйдут из окна. limit <= 0 — учёт выключен.
+    """
+
+    def __init__(self, limit: float, window: float, soft: float = 0.8):
+        self.limit = float(limit)
+        self.window = max(float(window), 1.0)
+        self.soft = min(max(float(soft), 0.0), 1.0)
+        self._spent: t.Dict[str, t.Deque[tuple[float, float]]] = {}
+        self._sums: t.Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _expire(self, method: str, now: float) -> None:
+        spent = self._spent.get(method)
+        while spent and spent[0][0] <= now - self.window:
+            self._sums[method] -= spent.popleft()[1]
+
+    def record(self, method: str, seconds: float) -> float:
+        """Учитывает time.operating вызова; возвращает сумму метода за окно."""
+        now = time.monotonic()
+        with self._lock:
+            self._spent.setdefault(method, deque()).append((now, float(seconds)))
+            self._sums[method] = self._sums.get(method, 0.0) + float(seconds)
+            self._expire(method, now)
+            return self._sums[method]
+
+    def wait_time(self, method: str) -> float:
+        """Сколько секунд подождать перед вызовом метода (0 — квоты хватает)."""
+        if self.limit <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            self._expire(method, now)
+            excess = self._sums.get(method, 0.0) - self.soft * self.limit
+            if excess <= 0:
+                return 0.0
+            for ts, seconds in self._spent[method]:
+                excess -= seconds
+                if excess <= 0:
+                    return max(ts + self.window - now, 0.0)
+        return 0.0
+
+    def usage(self) -> t.Dict[str, float]:
+        now = time.monotonic()
+        with self._lock:
+            for method in list(self._spent):
+                self._expire(method, now)
+            return {m: round(v, 3) for m, v in self._sums.items() if v > 0}
+
+
+__all__ = ["TokenBucket", "OperatingBudget"]
@@ -0,0 +1,155 @@
+# scans.py — сканы как фоновые задачи: один скан за раз, повторные запросы присоединяются к нему
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+import typing as t
+import uuid
+from datetime import datetime, timezone
+
+import history
+from storage import get_state, set_state
+
+# Сколько последних задач помним для /scans/{id}
+SCAN_HISTORY = int(os.getenv("SCAN_HISTORY", "20"))
+
+_LATEST_KEY = "scans.latest"
+
+
+def _iso(ts: float | None) -> str | None:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat() if ts else None
+
+
+class ScanJob:
+    def __init__(self, trigger: str, portal: str = ""):
+        self.id = uuid.uuid4().hex[:12]
+        self.portal = portal            # имя портала (portals.py); "" — единственный портал
+        self.trigger = trigger          # manual / schedule / ...
+        self.status = "running"         # running -> done | failed
+        self.joined = 0                 # сколько запросов присоединилось к уже идущему скану
+        self.started_at = time.time()
+        self.finished_at: float | None = None
+        self.alerts: t.List[dict] | None = None
+        self.verdicts: t.List[dict] = []  # итоги по всем кандидатам — только в историю (history.py)
+        self.error: str | None = None
+        self.done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "portal": self.portal or None,
+            "status": self.status,
+            "trigger": self.trigger,
+            "joined": self.joined,
+            "started_at": _iso(self.started_at),
+            "finished_at": _iso(self.finished_at),
+            "duration_sec": round((self.finished_at or time.time()) - self.started_at, 3),
+            "alerts_count": len(self.alerts) if self.alerts is not None else None,
+            "error": self.error,
+        }
+
+    def result(self) -> dict:
+        return {**self.info(), "alerts": self.alerts}
+
+
+class ScanManager:
+    """
+    Single-flight: пока скан идёт, новые запросы (ручной /run-scan, расписание) не запускают
+    второй — они получают ту же задачу. Так Bitrix не сканируется дважды одновременно,
+    а дайджест в Telegram уходит один раз.
+    runner — корутина, которая сканирует и отправляет дайджест; возвращает (тревоги, итоги по кандидатам).
+    name — портал (у каждого портала свой менеджер). Работает в одном event loop, блокировки не нужны.
+    """
+
+    def __init__(
+        self,
+        runner: t.Callable[[], t.Awaitable[tuple[t.List[dict], t.List[dict]]]],
+        name: str = "",
+        history: int = SCAN_HISTORY,
+    ):
+        self._runner = runner
+        self.name = name
+        self._latest_key = f"{_LATEST_KEY}.{name}" if name else _LATEST_KEY
+        self._history = max(history, 1)
+        self._jobs: t.Dict[str, ScanJob] = {}
+        self._current: ScanJob | None = None
+        self._latest: dict | None = None
+
+    def submit(self, trigger: str = "manual") -> tuple[ScanJob, bool]:
+        """Возвращает (задача, создана ли новая)."""
+        job = self._current
+        if job is not None and not job.finished:
+            job.joined += 1
+            return job, False
+        job = self._current = ScanJob(trigger, self.name)
+        self._jobs[job.id] = job
+        while len(self._jobs) > self._history:
+            self._jobs.pop(next(iter(self._jobs)))
+        asyncio.get_running_loop().create_task(self._execute(job))
+        return job, True
+
+    async def run(self, trigger: str = "manual") -> ScanJob:
+        """submit + дождаться окончания скана."""
+        job, _ = self.submit(trigger)
+        await job.done.wait()
+        return job
+
+    async def _execute(self, job: ScanJob) -> None:
+        try:
+            try:
+                job.alerts, job.verdicts = await self._runner()
+                job.status = "done"
+            except Exception as e:
+                job.error = str(e)
+                job.status = "failed"
+            job.finished_at = time.time()
+            # история и последний результат записаны до того, как ожидающие получат задачу
+            await self._save(job)
+        finally:
+            job.finished_at = job.finished_at or time.time()
+            job.done.set()
+
+    async def _save(self, job: ScanJob) -> None:
+        # SQLite — в рабочем потоке: запись истории большого скана не должна держать event loop
+        try:
+            await asyncio.to_thread(
+                history.record,
+                job.id, self.name, job.trigger, job.started_at, job.finished_at, job.alerts, job.error, job.verdicts,
+            )
+        except Exception as e:
+            print(f"[SCANS] history not saved: {e}")
+        if job.status == "done":
+            self._latest = job.result()
+            try:
+                await asyncio.to_thread(
+                    set_state, self._latest_key, json.dumps(self._latest, ensure_ascii=False, default=str)
+                )
+            except Exception as e:  # результат есть в памяти, база — только для рестартов
+                print(f"[SCANS] latest not saved: {e}")
+
+    def get(self, job_id: str) -> ScanJob | None:
+        return self._jobs.get(job_id)
+
+    def jobs(self) -> t.List[dict]:
+        return [j.info() for j in reversed(list(self._jobs.values()))]
+
+    def current(self) -> ScanJob | None:
+        job = self._current
+        return job if job is not None and not job.finished else None
+
+    def latest(self) -> dict | None:
+        """Результат последнего успешного скана (переживает рестарт) — без нового похода в Bitrix."""
+        if self._latest is None:
+            raw = get_state(self._latest_key)
+            if raw:
+                self._latest = json.loads(raw)
+        return self._latest
+
+
+__all__ = ["ScanJob", "ScanManager", "SCAN_HISTORY"]
@@ -0,0 +1,240 @@
+# sla_timers.py — дедлайны SLA по сущностям: проверяется только сущность, у которой истёк срок ответа
+from __future__ import annotations
+
+import os
+import threading
+import time
+import typing as t
+import uuid
+from datetime import datetime, timezone
+
+import entity_state
+import metrics
+
+# Таймеры работают в режиме событий (DETECT_MODE=events): состояние «ждёт ответа» ведут события
+SLA_TIMERS = os.getenv("SLA_TIMERS", "1") == "1"
+SLA_TICK_SEC = float(os.getenv("SLA_TICK_SEC", "30"))        # точность срабатывания
+SLA_VERIFY = os.getenv("SLA_VERIFY", "1") == "1"             # перед тревогой перепроверить сущность в Bitrix
+SLA_NOTIFY = os.getenv("SLA_NOTIFY", "1") == "1"             # о просрочке — сразу в Telegram, не ждать дайджеста
+SLA_RETRY_SEC = float(os.getenv("SLA_RETRY_SEC", "300"))     # Bitrix не ответил — повторить проверку через N секунд
+
+SLA_FIRED = metrics.counter("sla_timers_fired_total", "Сработавшие дедлайны SLA")
+SLA_RESULTS = metrics.counter("sla_checks_total", "Итоги проверок по дедлайну", ["result"])
+SLA_PENDING = metrics.gauge("sla_timers_pending", "Запланированных дедлайнов")
+
+Key = t.Tuple[str, str]
+
+
+class TimerWheel:
+    """
+    Хешированное колесо таймеров: дедлайн попадает в ячейку int(deadline / tick).
+    schedule/cancel — O(1), advance проходит только ячейки между прошлым и текущим тиком,
+    поэтому работа пропорциональна числу дедлайнов, а не числу сущностей.
+    """
+
+    def __init__(self, tick: float):
+        self.tick = max(float(tick), 0.1)
+        self._slots: t.Dict[int, t.Set[Key]] = {}
+        self._where: t.Dict[Key, tuple[int, float]] = {}
+        self._cursor = int(time.time() // self.tick)
+        self._lock = threading.Lock()
+
+    def _remove(self, key: Key) -> None:
+        where = self._where.pop(key, None)
+        if where is None:
+            return
+        slot = self._slots.get(where[0])
+        if slot is not None:
+            slot.discard(key)
+            if not slot:
+                del self._slots[where[0]]
+
+    def schedule(self, key: Key, deadline: float) -> None:
+        with self._lock:
+            self._remove(key)
+            slot = max(int(deadline // self.tick), self._cursor)  # просроченные — в ближайший тик
+            self._slots.setdefault(slot, set()).add(key)
+            self._where[key] = (slot, deadline)
+
+    def cancel(self, key: Key) -> None:
+        with self._lock:
+            self._remove(key)
+
+    def deadline(self, key: Key) -> float | None:
+        with self._lock:
+            where = self._where.get(key)
+        return where[1] if where else None
+
+    def advance(self, now: float) -> t.List[Key]:
+        """Снимает и возвращает дедлайны, наступившие к now."""
+        due: t.List[Key] = []
+        with self._lock:
+            end = int(now // self.tick)
+            while self._cursor <= end:
+                slot = self._slots.get(self._cursor)
+                if slot:
+                    for key in list(slot):
+                        if self._where[key][1] <= now:
+                            due.append(key)
+                            self._remove(key)
+                if self._cursor == end:
+                    break
+                self._cursor += 1
+        return due
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._where)
+
+
+_wheel = TimerWheel(SLA_TICK_SEC)
+_thread: threading.Thread | None = None
+_thread_lock = threading.Lock()
+
+
+def _sla_sec() -> float:
+    from logic import RESPONSE_SLA_MIN
+    return RESPONSE_SLA_MIN * 60
+
+
+def refresh(owner_type_id: str, owner_id: str) -> None:
+    """
+    Приводит таймер сущности в соответствие с entity_state: ждёт ответа — дедлайн
+    «ждёт с» + SLA; ответили (или просрочка уже подтверждена) — таймер снят.
+    """
+    key = (str(owner_type_id), str(owner_id))
+    row = entity_state.get(*key)
+    if row and row["awaiting_since_ts"] is not None and row["overdue_ts"] is None:
+        _wheel.schedule(key, row["awaiting_since_ts"] + _sla_sec())
+    else:
+        _wheel.cancel(key)
+    SLA_PENDING.set(len(_wheel))
+
+
+def rebuild() -> int:
+    """Таймеры заново из entity_state (после рестарта или первичного заполнения состояния)."""
+    sla = _sla_sec()
+    pending = entity_state.pending_deadlines()
+    for etype, eid, since in pending:
+        _wheel.schedule((etype, eid), since + sla)
+    SLA_PENDING.set(len(_wheel))
+    return len(pending)
+
+
+def _candidate(row: dict) -> dict:
+    from logic import normalize_phone
+    t_in = datetime.fromtimestamp(row["last_in_ts"], timezone.utc)
+    return {
+        "etype": row["owner_type_id"],
+        "eid": row["owner_id"],
+        "last": {
+            "ID": row["activity_id"],
+            "CREATED": row["last_in_raw"] or t_in.isoformat(),
+            "PROVIDER_ID": row["provider_id"],
+        },
+        "t_in": t_in,
+        "dialog_id": row["dialog_id"] or "",
+        "phone": row["phone"],
+        "phones": [normalize_phone(row["phone"])] if row["phone"] else [],
+    }
+
+
+def evaluate(keys: t.Iterable[Key]) -> t.List[dict]:
+    """
+    Проверка сущностей с наступившим дедлайном — теми же стадиями, что и скан, но только для них
+    (одним batch на всех). Ответ нашёлся — ожидание снимается; нет — просрочка фиксируется.
+    Возвращает новые тревоги.
+    """
+    from logic import _plan_stages, _run_stages
+
+    now = time.time()
+    sla = _sla_sec()
+    rows = []
+    for key in keys:
+        row = entity_state.get(*key)
+        if not row or row["awaiting_since_ts"] is None or row["overdue_ts"] is not None:
+            continue
+        if row["awaiting_since_ts"] + sla > now:
+            refresh(*key)  # дедлайн сдвинулся (ответили на часть сообщений)
+            continue
+        rows.append(row)
+    if not rows:
+        return []
+
+    cands = [_candidate(r) for r in rows]
+    left = _run_stages(cands, _plan_stages(None, None)) if SLA_VERIFY else cands
+    unanswered = {(c["etype"], c["eid"]) for c in left}
+
+    alerts = []
+    for row in rows:
+        key = (row["owner_type_id"], row["owner_id"])
+        if key in unanswered:
+            entity_state.mark_overdue(*key, now)
+            alerts.append(entity_state.as_alert(row))
+            SLA_RESULTS.inc(result="overdue")
+        else:
+            # ответ есть в Bitrix, а событие о нём не дошло
+            entity_state.mark_replied(*key, now)
+            SLA_RESULTS.inc(result="replied")
+        refresh(*key)
+    if alerts:
+        from enrichment import enrich
+        enrich(alerts)
+    return alerts
+
+
+def _notify(alerts: t.List[dict]) -> None:
+    from telegram_bot import format_alerts, send_message
+    send_message(format_alerts(alerts))
+
+
+def _record(alerts: t.List[dict]) -> None:
+    """Просрочки по таймерам — в историю тревог (history.py), отдельным «сканом» trigger=sla."""
+    import history
+    now = time.time()
+    try:
+        history.record(f"sla-{uuid.uuid4().hex[:12]}", "", "sla", now, now, alerts)
+    except Exception as e:
+        print(f"[SLA] history not saved: {e}")
+
+
+def _run() -> None:
+    rebuild()
+    while True:
+        time.sleep(_wheel.tick)
+        due = _wheel.advance(time.time())
+        if not due:
+            continue
+        SLA_FIRED.inc(len(due))
+        try:
+            alerts = evaluate(due)
+        except Exception as e:  # Bitrix недоступен — проверим эти сущности позже
+            print(f"[SLA] check failed: {e}")
+            for key in due:
+                _wheel.schedule(key, time.time() + SLA_RETRY_SEC)
+            continue
+        if alerts:
+            _record(alerts)
+        if alerts and SLA_NOTIFY:
+            _notify(alerts)
+
+
+def start() -> None:
+    """Фоновый поток таймеров (только DETECT_MODE=events и SLA_TIMERS=1)."""
+    global _thread
+    from logic import DETECT_MODE
+    if DETECT_MODE != "events" or not SLA_TIMERS:
+        return
+    with _thread_lock:
+        if _thread is None or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="sla-timers", daemon=True)
+            _thread.start()
+
+
+def stats() -> dict:
+    with _thread_lock:
+        running = _thread is not None and _thread.is_alive()
+    return {"running": running, "pending": len(_wheel), "tick_sec": _wheel.tick}
+
+
+__all__ = ["TimerWheel", "refresh", "rebuild", "evaluate", "start", "stats"]
@@ -0,0 +1,80 @@
+# storage.py — локальная SQLite-база сервиса (зеркало активностей, состояние, история)
+from __future__ import annotations
+
+import os
+import sqlite3
+import threading
+import typing as t
+from contextlib import contextmanager
+
+STORE_PATH = os.getenv("STORE_PATH", "bitrix_alerts.sqlite3")
+
+_lock = threading.RLock()
+_conn: sqlite3.Connection | None = None
+_schemas: t.Set[str] = set()
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        folder = os.path.dirname(os.path.abspath(STORE_PATH))
+        os.makedirs(folder, exist_ok=True)
+        conn = sqlite3.connect(STORE_PATH, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _conn = conn
+    return _conn
+
+
+@contextmanager
+def transaction() -> t.Iterator[sqlite3.Connection]:
+    """
+    Одно соединение на процесс, доступ сериализован блокировкой:
+    запросы короткие, а потоков (скан, события, API) немного.
+    """
+    with _lock:
+        conn = _connect()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def ensure_schema(name: str, ddl: str) -> None:
+    """Создаёт таблицы модуля один раз за процесс (ddl — CREATE ... IF NOT EXISTS)."""
+    with _lock:
+        if name in _schemas:
+            return
+        with transaction() as conn:
+            conn.executescript(ddl)
+        _schemas.add(name)
+
+
+def get_state(key: str) -> str | None:
+    ensure_schema("state", _STATE_DDL)
+    with transaction() as conn:
+        row = conn.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def set_state(key: str, value: str) -> None:
+    ensure_schema("state", _STATE_DDL)
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO state(key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
+
+
+_STATE_DDL = """
+CREATE TABLE IF NOT EXISTS state (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+__all__ = ["STORE_PATH", "transaction", "ensure_schema", "get_state", "set_state"]
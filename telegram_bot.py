@@ -1,23 +1,219 @@
-import os, requests
+import os
+import queue
+import threading
+import time
+from html import escape
+
+import metrics
+from http_client import get_client
+from ratelimit import TokenBucket
 
 TG_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TG_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
 
-def send_message(text: str):
-    if not (TG_TOKEN and TG_CHAT_ID):
+# Лимит Telegram — 4096 символов на сообщение; запас под номер части «(2/5)»
+TG_CHUNK_LIMIT = int(os.getenv("TG_CHUNK_LIMIT", "4000"))
+# Не чаще одного сообщения в секунду в один чат (в группы — до 20 в минуту)
+TG_CHAT_RATE_PER_SEC = float(os.getenv("TG_CHAT_RATE_PER_SEC", "1"))
+TG_CHAT_BURST = float(os.getenv("TG_CHAT_BURST", "3"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "5"))
+# Одинаковые сообщения об ошибках — не чаще раза в N секунд, повторы считаются
+TG_ERROR_COALESCE_SEC = float(os.getenv("TG_ERROR_COALESCE_SEC", "3600"))
+
+_HTTP = get_client("telegram")
+
+TG_REQUESTS = metrics.counter("telegram_requests_total", "Вызовы sendMessage по HTTP-статусу", ["status"])
+TG_REQUEST_SECONDS = metrics.histogram("telegram_request_seconds", "Время вызова sendMessage")
+TG_QUEUE = metrics.gauge("telegram_queue_size", "Сообщений в очереди на отправку")
+TG_DROPPED = metrics.counter("telegram_dropped_total", "Сообщения, которые не удалось отправить", ["reason"])
+
+_queue = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+_buckets = {}  # chat_id -> TokenBucket
+_errors = {}   # текст ошибки -> {"sent_at", "repeats"}
+_errors_lock = threading.Lock()
+_counters = {"queued": 0, "sent": 0, "retries": 0, "dropped": 0, "coalesced": 0}
+_counters_lock = threading.Lock()
+
+def _count(name, n=1):
+    with _counters_lock:
+        _counters[name] += n
+
+# ---------------------------
+#  Разбиение на части
+# ---------------------------
+def split_message(text, limit=TG_CHUNK_LIMIT):
+    """
+    Режет текст на части не длиннее limit по границам строк (HTML-теги в дайджесте не
+    переходят через строку, поэтому разметка не ломается); слишком длинная строка режется как есть.
+    """
+    chunks, cur = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if cur:
+                chunks.append(cur)
+                cur = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{cur}\n{line}" if cur else line
+        if len(candidate) > limit:
+            chunks.append(cur)
+            cur = line
+        else:
+            cur = candidate
+    if cur or not chunks:
+        chunks.append(cur)
+    if len(chunks) > 1:
+        chunks = [f"{c}\n<i>({i}/{len(chunks)})</i>" for i, c in enumerate(chunks, 1)]
+    return chunks
+
+# ---------------------------
+#  Очередь отправки
+# ---------------------------
+def send_message(text: str, chat_id=None):
+    """
+    Ставит сообщение в очередь и сразу возвращает управление: длинный текст уходит
+    несколькими частями, с лимитом на чат и повторами (retry_after) в фоновом потоке.
+    """
+    chat_id = chat_id or TG_CHAT_ID
+    if not (TG_TOKEN and chat_id):
         return
+    for chunk in split_message(text):
+        _queue.put({"chat_id": chat_id, "text": chunk, "html": True, "attempt": 0})
+        _count("queued")
+    TG_QUEUE.set(_queue.qsize())
+    _start()
+
+def send_error(text: str, chat_id=None):
+    """
+    Сообщение об ошибке. Пока та же ошибка повторяется (скан за сканом), в чат уходит
+    одно сообщение за TG_ERROR_COALESCE_SEC; следующее сообщит, сколько раз она повторилась.
+    """
+    now = time.time()
+    with _errors_lock:
+        st = _errors.get(text)
+        if st and now - st["sent_at"] < TG_ERROR_COALESCE_SEC:
+            st["repeats"] += 1
+            _count("coalesced")
+            return
+        repeats = st["repeats"] if st else 0
+        _errors[text] = {"sent_at": now, "repeats": 0}
+    if repeats:
+        text = f"{text}\n(повторялось ещё {repeats} раз)"
+    send_message(text, chat_id)
+
+def _start():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_run, name="telegram-sender", daemon=True)
+            _worker.start()
+
+def flush(timeout: float = 10.0) -> bool:
+    """Ждёт, пока очередь опустеет (при остановке сервиса). True — всё отправлено."""
+    deadline = time.time() + timeout
+    while _queue.unfinished_tasks and time.time() < deadline:
+        time.sleep(0.05)
+    return not _queue.unfinished_tasks
+
+def stats():
+    with _counters_lock:
+        return {**_counters, "pending": _queue.qsize()}
+
+def _bucket(chat_id):
+    b = _buckets.get(chat_id)
+    if b is None:
+        b = _buckets[chat_id] = TokenBucket(TG_CHAT_RATE_PER_SEC, TG_CHAT_BURST)
+    return b
+
+def _post(msg):
+    """Один вызов sendMessage -> (ok, пауза перед повтором или None — не повторять)."""
+    payload = {"chat_id": msg["chat_id"], "text": msg["text"]}
+    if msg["html"]:
+        payload["parse_mode"] = "HTML"
     url = f"https://api.telegram.org/bot{TG_TOKEN}/sendMessage"
-    requests.post(url, json={"chat_id": TG_CHAT_ID, "text": text, "parse_mode": "HTML"}, timeout=20)
+    start = time.perf_counter()
+    try:
+        r = _HTTP.post(url, json=payload, timeout=20)
+    except Exception as e:
+        TG_REQUESTS.inc(status=type(e).__name__)
+        return False, min(2 ** msg["attempt"], 60)
+    finally:
+        TG_REQUEST_SECONDS.observe(time.perf_counter() - start)
+    TG_REQUESTS.inc(status=str(r.status_code))
+    if r.status_code == 200:
+        return True, None
+
+    try:
+        data = r.json()
+    except ValueError:
+        data = {}
+    if r.status_code == 429:
+        retry_after = (data.get("parameters") or {}).get("retry_after") or 1
+        return False, float(retry_after)
+    if r.status_code >= 500:
+        return False, min(2 ** msg["attempt"], 60)
+    if r.status_code == 400 and msg["html"] and "parse entities" in str(data.get("description") or ""):
+        # разметка не прошла — отправляем тем же текстом без HTML
+        msg["html"] = False
+        return False, 0.0
+    print(f"[TELEGRAM] {r.status_code}: {data.get('description') or r.text[:200]}")
+    TG_DROPPED.inc(reason=str(r.status_code))
+    return False, None
+
+def _run():
+    while True:
+        msg = _queue.get()
+        try:
+            while True:
+                _bucket(msg["chat_id"]).acquire()
+                ok, delay = _post(msg)
+                if ok:
+                    _count("sent")
+                    break
+                if delay is None:
+                    _count("dropped")
+                    break
+                if msg["attempt"] >= TG_MAX_RETRIES:
+                    TG_DROPPED.inc(reason="retries")
+                    _count("dropped")
+                    print(f"[TELEGRAM] giving up after {msg['attempt']} retries")
+                    break
+                # повторяем то же сообщение, не пропуская его вперёд: части дайджеста идут по порядку
+                msg["attempt"] += 1
+                _count("retries")
+                time.sleep(delay)
+        except Exception as e:  # одно сообщение не останавливает очередь
+            _count("dropped")
+            print(f"[TELEGRAM] send failed: {e}")
+        finally:
+            _queue.task_done()
+            TG_QUEUE.set(_queue.qsize())
+
+_TYPE_LABELS = {"1": "Лид", "2": "Сделка", "3": "Контакт", "4": "Компания"}
 
 def format_alerts(alerts):
+    """
+    Дайджест: одна тревога — одна строка (split_message режет по строкам).
+    Название, ответственный и ссылка — если тревоги прошли enrichment.enrich.
+    """
     if not alerts:
         return "✅ На сейчас тревог нет."
     lines = ["<b>⚠️ Клиенты без ответа в чате и без звонка</b>"]
-    for a in alerts[:50]:
-        link = f"https://bitrix24.ru/crm/entity/TYPE/{a['owner_type_id']}/ID/{a['owner_id']}"  # при желании подставь свой портал
-        line = (f"• Entity {a['owner_type_id']} #{a['owner_id']} — входящее {a['provider_id']} в {a['last_in_created']}"
-                f"{' — ' + a['phone'] if a['phone'] else ''}")
+    for a in alerts:
+        etype = str(a["owner_type_id"])
+        label = escape(f"{_TYPE_LABELS.get(etype, 'Entity ' + etype)} #{a['owner_id']}")
+        if a.get("url"):
+            label = f'<a href="{escape(a["url"])}">{label}</a>'
+        line = f"• {label}"
+        if a.get("title"):
+            line += f" «{escape(a['title'])}»"
+        if a.get("responsible_name"):
+            line += f" — {escape(a['responsible_name'])}"
+        line += f" — входящее {escape(str(a['provider_id'] or ''))} в {escape(str(a['last_in_created']))}"
+        if a["phone"]:
+            line += f" — {escape(a['phone'])}"
         lines.append(line)
-    if len(alerts) > 50:
-        lines.append(f"... и ещё {len(alerts)-50}")
+    lines.append(f"Всего: {len(alerts)}")
     return "\n".join(lines)
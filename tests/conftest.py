@@ -0,0 +1,14 @@
+# conftest.py — модули сервиса читают настройки при импорте: окружение задаётся до них
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_TMP = tempfile.mkdtemp(prefix="bitrix-alerts-tests-")
+os.environ.setdefault("STORE_PATH", os.path.join(_TMP, "tests.sqlite3"))
+os.environ.setdefault("B24_WEBHOOK", "https://portal.example/rest/1/token/")
+os.environ.setdefault("B24_RATE_PER_SEC", "0")
+os.environ.pop("TELEGRAM_TOKEN", None)
+os.environ.pop("PORTALS_CONFIG", None)
@@ -0,0 +1,138 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import activity_store
+from storage import get_state, set_state, transaction
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def _row(rid, created, updated=None, owner_type="2", subject=""):
+    return {"ID": str(rid), "CREATED": created.isoformat(), "LAST_UPDATED": (updated or created).isoformat(),
+            "OWNER_TYPE_ID": owner_type, "OWNER_ID": str(rid), "DIRECTION": "2",
+            "PROVIDER_ID": "IMOPENLINES_SESSION", "SUBJECT": subject}
+
+
+@pytest.fixture
+def portal(monkeypatch):
+    """Пустое зеркало; Bitrix — список строк, запросы (фильтры) — в список."""
+    activity_store.ensure_schema("activities", activity_store._DDL)
+    get_state("")  # таблица state
+    with transaction() as conn:
+        conn.execute("DELETE FROM activities")
+        conn.execute("DELETE FROM state WHERE key LIKE 'activities.%'")
+    rows, queries = [], []
+
+    def fetch(flt, select=None):
+        queries.append(flt)
+
+        def ok(r):
+            created = datetime.fromisoformat(r["CREATED"])
+            updated = datetime.fromisoformat(r["LAST_UPDATED"])
+            return (
+                int(r["OWNER_TYPE_ID"]) in flt["OWNER_TYPE_ID"]
+                and (">=CREATED" not in flt or created >= datetime.fromisoformat(flt[">=CREATED"]))
+                and ("<CREATED" not in flt or created < datetime.fromisoformat(flt["<CREATED"]))
+                and (">=LAST_UPDATED" not in flt or updated >= datetime.fromisoformat(flt[">=LAST_UPDATED"]))
+            )
+        return [dict(r) for r in rows if ok(r)]
+
+    monkeypatch.setattr(activity_store, "_fetch", fetch)
+    return rows, queries
+
+
+def _ids(since):
+    return sorted(r["ID"] for r in activity_store.query(since=since))
+
+
+def test_first_sync_loads_window_by_created(portal):
+    rows, queries = portal
+    since = NOW - timedelta(days=2)
+    rows += [_row(1, NOW - timedelta(days=1)), _row(2, NOW - timedelta(hours=1)),
+             _row(3, NOW - timedelta(hours=1), owner_type="7")]
+
+    assert activity_store.sync(since, ["1", "2"], force=True) == 2
+    assert queries == [{">=CREATED": since.isoformat(), "OWNER_TYPE_ID": [1, 2]}]
+    assert _ids(since) == ["1", "2"]
+
+
+def test_delta_reads_from_high_water_mark_with_overlap(portal, monkeypatch):
+    rows, queries = portal
+    monkeypatch.setattr(activity_store, "SYNC_OVERLAP_SEC", 120)
+    since = NOW - timedelta(days=2)
+    hwm = NOW - timedelta(minutes=10)
+    rows += [_row(1, NOW - timedelta(days=1), updated=hwm)]
+    activity_store.sync(since, ["2"], force=True)
+
+    # изменённая строка и строка, попавшая в Bitrix с опозданием внутри перекрытия
+    rows[0] = _row(1, NOW - timedelta(days=1), updated=NOW - timedelta(minutes=1), subject="changed")
+    rows.append(_row(2, NOW - timedelta(minutes=30), updated=hwm - timedelta(seconds=60)))
+    rows.append(_row(3, NOW - timedelta(minutes=30), updated=hwm - timedelta(seconds=600)))  # до перекрытия
+    del queries[:]
+
+    assert activity_store.sync(since, ["2"], force=True) == 2
+    assert queries == [{">=LAST_UPDATED": (hwm - timedelta(seconds=120)).isoformat(), "OWNER_TYPE_ID": [2]}]
+    assert _ids(since) == ["1", "2"]
+    assert {r["ID"]: r["SUBJECT"] for r in activity_store.query(since=since)}["1"] == "changed"
+
+
+def test_wider_window_backfills_missing_range(portal):
+    rows, queries = portal
+    rows += [_row(1, NOW - timedelta(days=5)), _row(2, NOW - timedelta(days=1))]
+    covered = NOW - timedelta(days=2)
+    activity_store.sync(covered, ["2"], force=True)
+    assert _ids(NOW - timedelta(days=7)) == ["2"]
+    del queries[:]
+
+    since = NOW - timedelta(days=7)
+    activity_store.sync(since, ["2"], force=True)
+    assert queries[0] == {">=CREATED": since.isoformat(), "<CREATED": covered.isoformat(), "OWNER_TYPE_ID": [2]}
+    assert ">=LAST_UPDATED" in queries[1]
+    assert _ids(since) == ["1", "2"]
+
+
+def test_window_trim_drops_old_rows(portal):
+    rows, _ = portal
+    rows += [_row(1, NOW - timedelta(days=5)), _row(2, NOW - timedelta(days=1))]
+    activity_store.sync(NOW - timedelta(days=7), ["2"], force=True)
+    assert _ids(NOW - timedelta(days=7)) == ["1", "2"]
+
+    activity_store.sync(NOW - timedelta(days=2), ["2"], force=True)
+    assert _ids(NOW - timedelta(days=7)) == ["2"]
+    assert activity_store.stats()["rows"] == 1
+
+
+def test_sync_is_throttled_between_scans(portal, monkeypatch):
+    rows, queries = portal
+    monkeypatch.setattr(activity_store, "SYNC_MIN_INTERVAL", 3600.0)
+    activity_store.sync(NOW - timedelta(days=1), ["2"], force=True)
+    assert activity_store.sync(NOW - timedelta(days=1), ["2"]) == 0
+    assert len(queries) == 1
+
+
+def test_reconcile_drops_rows_deleted_in_bitrix(portal, monkeypatch):
+    rows, queries = portal
+    monkeypatch.setattr(activity_store, "RECONCILE_INTERVAL", 3600.0)
+    since = NOW - timedelta(days=2)
+    rows += [_row(1, NOW - timedelta(days=1)), _row(2, NOW - timedelta(hours=5)), _row(3, NOW - timedelta(hours=1))]
+    activity_store.sync(since, ["2"], force=True)
+    del rows[1]  # удалена в Bitrix: LAST_UPDATED не меняется, дельта её не вернёт
+
+    activity_store.sync(since, ["2"], force=True)  # сверка была при полной выгрузке — ещё рано
+    assert _ids(since) == ["1", "2", "3"]
+
+    set_state(activity_store._RECONCILED_KEY, str(NOW.timestamp() - 7200))
+    del queries[:]
+    activity_store.sync(since, ["2"], force=True)
+    assert queries[-1] == {">=CREATED": since.isoformat(), "OWNER_TYPE_ID": [2]}
+    assert _ids(since) == ["1", "3"]
+    assert float(get_state(activity_store._RECONCILED_KEY)) > NOW.timestamp() - 60
+
+
+def test_forget_removes_rows(portal):
+    rows, _ = portal
+    rows += [_row(1, NOW - timedelta(hours=2)), _row(2, NOW - timedelta(hours=1))]
+    activity_store.sync(NOW - timedelta(days=1), ["2"], force=True)
+    assert activity_store.forget(["2", "99"]) == 1
+    assert _ids(NOW - timedelta(days=1)) == ["1"]
@@ -0,0 +1,55 @@
+from datetime import datetime, timezone
+
+from analytics import _percentile, build_report
+
+T = 1_700_000_000.0
+UNTIL = datetime.fromtimestamp(T + 20_000, timezone.utc)
+
+
+def _in(ts, etype, eid, phones=(), responsible="9", provider="IMOPENLINES_SESSION"):
+    return (T + ts, etype, eid, provider, "", responsible, tuple(phones))
+
+
+def test_percentile_nearest_rank():
+    values = [float(v) for v in range(1, 11)]
+    assert _percentile(values, 50) == 5.0
+    assert _percentile(values, 90) == 9.0
+    assert _percentile(values, 99) == 10.0
+    assert _percentile([42.0], 95) == 42.0
+    assert _percentile([], 50) is None
+
+
+def test_build_report_pairs_episodes():
+    data = {
+        "in": [
+            _in(0, "2", "1"), _in(60, "2", "1"),   # один эпизод: ответ на первое
+            _in(1000, "2", "1"),                  # звонок в ту же секунду — ответ
+            _in(5000, "2", "1"),                  # без ответа, SLA истёк
+            _in(0, "1", "2", phones=["79001234567"]),
+            _in(20_000 - 60, "1", "3"),           # без ответа, SLA ещё не истёк
+        ],
+        "out": [(T + 600, "2", "1", "5", "o1")],
+        "call": [(T + 1000, "2", "1", "5", "c1")],
+        # звонок без привязки к CRM — по телефону сущности
+        "log": [(T + 120, "", "", "7", "v1", "79001234567")],
+    }
+    rep = build_report(data, UNTIL, sla_min=30)
+
+    assert rep["episodes"] == 5
+    overall = rep["overall"]
+    assert (overall["answered"], overall["unanswered"], overall["pending"]) == (3, 1, 1)
+    assert overall["breached"] == 1 and overall["breach_rate"] == 0.25
+    assert overall["mean_min"] == 4.0  # (600 + 0 + 120) / 3 с
+    assert (overall["p50_min"], overall["p90_min"]) == (2.0, 10.0)
+
+    by_author = {r["key"]: r for r in rep["by_author"]}
+    assert by_author["5"]["answered"] == 2
+    assert by_author["7"]["answered"] == 1 and by_author["7"]["p50_min"] == 2.0
+    assert by_author["9"]["unanswered"] == 1 and by_author["9"]["pending"] == 1
+    assert {r["key"]: r["episodes"] for r in rep["by_entity_type"]} == {"2": 3, "1": 2}
+
+
+def test_late_reply_counts_as_breach():
+    data = {"in": [_in(0, "2", "1")], "out": [(T + 3600, "2", "1", "5", "o1")]}
+    overall = build_report(data, UNTIL, sla_min=30)["overall"]
+    assert overall["answered"] == 1 and overall["breached"] == 1 and overall["p50_min"] == 60.0
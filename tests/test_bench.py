@@ -0,0 +1,57 @@
+import json
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+import bitrix
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+from fake_portal import Api, Portal, PortalConfig, parse_php_query  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def api():
+    return Api(Portal(PortalConfig(entities=20, seed=3)))
+
+
+def test_parse_php_query_reads_batch_commands():
+    cmd = bitrix._batch_cmd("crm.activity.list", {
+        "filter": {">=CREATED": "2024-05-01T00:00:00+03:00", "OWNER_TYPE_ID": [1, 2]},
+        "select": ["ID"], "start": -1,
+    })
+    method, _, query = cmd.partition("?")
+    assert method == "crm.activity.list"
+    assert parse_php_query(query) == {
+        "filter": {">=CREATED": "2024-05-01T00:00:00+03:00", "OWNER_TYPE_ID": {"0": "1", "1": "2"}},
+        "select": {"0": "ID"}, "start": "-1",
+    }
+
+
+def test_batch_answers_like_separate_calls(api):
+    some = api.portal.activities[0]
+    flt = {"OWNER_TYPE_ID": some["OWNER_TYPE_ID"], "OWNER_ID": some["OWNER_ID"]}
+    direct = api.call("crm.activity.list", {"filter": flt, "order": {"ID": "ASC"}})
+    cmds = {
+        "a": bitrix._batch_cmd("crm.activity.list", {"filter": flt, "order": {"ID": "ASC"}}),
+        "b": "no.such.method",
+    }
+    res = api.call("batch", {"halt": "0", "cmd": cmds})["result"]
+    assert res["result"]["a"] == direct["result"] and direct["result"]
+    assert all(r["OWNER_ID"] == some["OWNER_ID"] for r in direct["result"])
+    assert res["result_error"]["b"]["error"] == "ERROR_METHOD_NOT_FOUND"
+
+
+def test_benchmark_scan_finds_every_unanswered_entity():
+    out = subprocess.run(
+        [sys.executable, os.path.join(ROOT, "bench", "run.py"), "--entities", "40", "--json"],
+        capture_output=True, text=True, timeout=300, check=True,
+        env={k: v for k, v in os.environ.items() if k not in ("B24_WEBHOOK", "STORE_PATH")},
+    ).stdout
+    report = json.loads(re.search(r"^\{$.*", out, re.M | re.S).group(0))
+    assert report["portal"]["expected_unanswered"] > 0
+    assert report["scans"][0]["alerts"] == report["portal"]["expected_unanswered"]
@@ -0,0 +1,274 @@
+import time
+
+import pytest
+
+import bitrix
+from bitrix import BitrixError
+
+
+@pytest.fixture
+def flaky(monkeypatch):
+    """_post_once, отвечающий ошибками из списка, потом успехом."""
+    monkeypatch.setattr(bitrix, "_RETRY_SLEEP", 0.0)
+    monkeypatch.setattr(bitrix, "_RETRY", 2)
+    monkeypatch.setattr(bitrix, "_RETRY_THROTTLED", 2)
+    monkeypatch.setattr(bitrix, "_throttled_until", 0.0)
+    calls = []
+
+    def install(errors):
+        errors = list(errors)
+
+        def post_once(method, payload):
+            calls.append(method)
+            if errors:
+                raise errors.pop(0)
+            return {"result": "ok"}
+
+        monkeypatch.setattr(bitrix, "_post_once", post_once)
+        return calls
+
+    return install
+
+
+def _throttle():
+    return BitrixError("QUERY_LIMIT_EXCEEDED", "QUERY_LIMIT_EXCEEDED", 503, "throttle")
+
+
+def _transient():
+    return BitrixError("INTERNAL_SERVER_ERROR", "INTERNAL_SERVER_ERROR", 500, "transient")
+
+
+def test_retry_counters_are_per_kind(flaky):
+    calls = flaky([_throttle(), _throttle(), _transient(), _transient()])
+    assert bitrix._post("crm.activity.list", {}) == {"result": "ok"}
+    assert len(calls) == 5
+
+
+def test_retry_limit_per_kind_still_applies(flaky):
+    calls = flaky([_throttle(), _transient(), _transient(), _transient()])
+    with pytest.raises(BitrixError) as e:
+        bitrix._post("crm.activity.list", {})
+    assert e.value.kind == "transient"
+    assert len(calls) == 4
+
+
+def test_batch_cmd_flattens_like_php():
+    from urllib.parse import parse_qsl
+
+    cmd = bitrix._batch_cmd("crm.activity.list", {
+        "filter": {">=CREATED": "2024-05-01T00:00:00+00:00", "PROVIDER_ID": ["A", "B"], "COMPLETED": False},
+        "select": ["ID", "SUBJECT"],
+        "start": -1,
+        "order": None,
+    })
+    method, _, query = cmd.partition("?")
+    assert method == "crm.activity.list"
+    assert parse_qsl(query, keep_blank_values=True) == [
+        ("filter[>=CREATED]", "2024-05-01T00:00:00+00:00"),
+        ("filter[PROVIDER_ID][0]", "A"),
+        ("filter[PROVIDER_ID][1]", "B"),
+        ("filter[COMPLETED]", "N"),
+        ("select[0]", "ID"),
+        ("select[1]", "SUBJECT"),
+        ("start", "-1"),
+        ("order", ""),
+    ]
+    assert bitrix._batch_cmd("user.current", None) == "user.current"
+
+
+def test_batch_splits_by_50_and_merges_results(monkeypatch):
+    sent = []
+
+    def post(method, payload):
+        assert method == "batch"
+        sent.append(payload)
+        keys = list(payload["cmd"])
+        return {"result": {
+            "result": {k: [{"ID": k}] for k in keys if k != "c7"},
+            "result_error": {"c7": {"error": "ACCESS_DENIED", "error_description": "no"}} if "c7" in keys else [],
+            "result_next": {k: 50 for k in keys[:1]},
+            "result_total": {},
+            "result_time": {},
+        }}
+
+    monkeypatch.setattr(bitrix, "_post", post)
+    commands = {f"c{i}": ("crm.activity.list", {"filter": {"OWNER_ID": i}}) for i in range(120)}
+    out = bitrix.batch(commands)
+
+    assert [len(p["cmd"]) for p in sent] == [50, 50, 20]
+    assert all(p["halt"] == 0 for p in sent)
+    assert set(out) == set(commands)
+    assert out["c0"] == {"result": [{"ID": "c0"}], "next": 50, "total": None}
+    assert out["c119"]["result"] == [{"ID": "c119"}]
+    assert out["c7"] == {"error": "ACCESS_DENIED", "error_description": "no"}
+
+
+def test_batch_marks_commands_skipped_by_halt(monkeypatch):
+    monkeypatch.setattr(bitrix, "_post", lambda method, payload: {"result": {
+        "result": {"a": 1},
+        "result_error": {"b": "ERROR_CORE"},
+    }})
+    out = bitrix.batch({k: ("user.get", {}) for k in "abc"}, halt=True)
+    assert out["a"]["result"] == 1
+    assert out["b"] == {"error": "ERROR_CORE", "error_description": ""}
+    assert out["c"]["error"] == "BATCH_SKIPPED"
+
+
+@pytest.fixture
+def call_methods(monkeypatch):
+    """Журнал звонков: voximplant на портале недоступен, telephony отвечает; перепроверки — в список."""
+    monkeypatch.setattr(bitrix, "_call_methods", {})
+    calls, rechecks = [], []
+
+    def post(method, payload):
+        calls.append(method)
+        if method == "voximplant.statistic.get":
+            raise RuntimeError("ACCESS_DENIED")
+        return {"result": [{"CALL_ID": "1"}]}
+
+    monkeypatch.setattr(bitrix, "_post", post)
+    monkeypatch.setattr(bitrix, "_schedule_recheck", rechecks.append)
+    return calls, rechecks
+
+
+def test_failed_call_method_is_remembered(call_methods):
+    calls, rechecks = call_methods
+    rows, method = bitrix.list_call_log("2024-05-01T00:00:00+00:00")
+    assert method == "telephony.statistic.get" and rows == [{"CALL_ID": "1"}]
+    assert calls == ["voximplant.statistic.get", "telephony.statistic.get"]
+
+    # повторный скан не платит за упавший метод
+    bitrix.list_call_log("2024-05-01T00:00:00+00:00")
+    assert calls[2:] == ["telephony.statistic.get"]
+    assert rechecks == []
+    assert bitrix.call_log_status()["source"] == "telephony.statistic.get"
+
+
+def test_failed_call_method_is_rechecked_after_ttl(call_methods, monkeypatch):
+    _, rechecks = call_methods
+    bitrix.report_call_method("voximplant.statistic.get", False, "ACCESS_DENIED")
+    assert bitrix.call_log_methods() == ["telephony.statistic.get"]
+    assert rechecks == []
+
+    monkeypatch.setattr(bitrix, "_CALL_METHOD_TTL", 60.0)
+    bitrix._call_methods["voximplant.statistic.get"]["checked_at"] = time.time() - 61
+    # перепроверка — в фоне, скан пока идёт через рабочий метод
+    assert bitrix.call_log_methods() == ["telephony.statistic.get"]
+    assert rechecks == ["voximplant.statistic.get"]
+
+    bitrix.report_call_method("voximplant.statistic.get", True)
+    assert bitrix.call_log_methods() == ["voximplant.statistic.get", "telephony.statistic.get"]
+
+
+@pytest.fixture
+def activity_pages(monkeypatch):
+    """crm.activity.list по 120 строкам: страницы по 50, фильтр >ID/<ID и порядок по ID."""
+    rows = [{"ID": str(i), "SUBJECT": f"s{i}"} for i in range(1, 121)]
+    payloads = []
+
+    def post(method, payload):
+        assert method == "crm.activity.list"
+        payloads.append(payload)
+        flt = payload["filter"]
+        desc = payload["order"] == {"ID": "DESC"}
+        found = [r for r in rows if int(r["ID"]) > flt.get(">ID", 0) and int(r["ID"]) < flt.get("<ID", 10 ** 9)]
+        found.sort(key=lambda r: int(r["ID"]), reverse=desc)
+        return {"result": found[:bitrix._PAGE_SIZE], "next": 50, "total": len(found)}
+
+    monkeypatch.setattr(bitrix, "_post", post)
+    return payloads
+
+
+def test_iter_activities_pages_by_id_without_total(activity_pages):
+    got = list(bitrix.iter_activities({"OWNER_TYPE_ID": 2}, ["SUBJECT"]))
+    assert [r["ID"] for r in got] == [str(i) for i in range(1, 121)]
+    assert [p["filter"].get(">ID") for p in activity_pages] == [None, 50, 100]
+    assert all(p["start"] == -1 and p["order"] == {"ID": "ASC"} for p in activity_pages)
+    assert all(p["filter"]["OWNER_TYPE_ID"] == 2 and p["select"] == ["SUBJECT", "ID"] for p in activity_pages)
+
+
+def test_iter_activities_descending_stops_at_max_rows(activity_pages):
+    got = list(bitrix.iter_activities(None, None, descending=True, max_rows=60))
+    assert [r["ID"] for r in got] == [str(i) for i in range(120, 60, -1)]
+    assert [p["filter"].get("<ID") for p in activity_pages] == [None, 71]
+    assert activity_pages[0]["select"] == []
+
+
+def test_time_slices_newest_first_and_contiguous():
+    from datetime import datetime, timedelta, timezone
+
+    since = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    until = since + timedelta(hours=10)
+    slices = bitrix.time_slices(since, until, timedelta(hours=4))
+    assert slices == [
+        (since + timedelta(hours=6), until),
+        (since + timedelta(hours=2), since + timedelta(hours=6)),
+        (since, since + timedelta(hours=2)),
+    ]
+    assert bitrix.time_slices(since, until, None) == [(since, until)]
+    assert bitrix.time_slices(since, until, timedelta(0)) == [(since, until)]
+    assert bitrix.time_slices(until, since, timedelta(hours=1)) == []
+
+
+@pytest.fixture
+def activities(monkeypatch):
+    """iter_activities по списку строк: фильтр по PROVIDER_ID и CREATED, ID DESC, max_rows."""
+    from datetime import datetime
+
+    rows, queries = [], []
+
+    def iter_activities(flt, select, *, descending=False, max_rows=None):
+        queries.append(flt)
+        lo, hi = datetime.fromisoformat(flt[">=CREATED"]), datetime.fromisoformat(flt["<CREATED"])
+        found = [
+            r for r in rows
+            if r["PROVIDER_ID"] == flt.get("PROVIDER_ID", r["PROVIDER_ID"])
+            and lo <= datetime.fromisoformat(r["CREATED"]) < hi
+        ]
+        found.sort(key=lambda r: int(r["ID"]), reverse=descending)
+        return iter(found[:max_rows] if max_rows else found)
+
+    monkeypatch.setattr(bitrix, "iter_activities", iter_activities)
+    return rows, queries
+
+
+def test_list_activities_sliced_covers_window(activities):
+    from datetime import datetime, timedelta, timezone
+
+    rows, queries = activities
+    since = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    until = since + timedelta(hours=4)
+    for h in range(4):
+        for p in ("A", "B"):
+            rows.append({"ID": str(len(rows) + 1), "PROVIDER_ID": p,
+                         "CREATED": (since + timedelta(hours=h, minutes=30)).isoformat()})
+
+    streams, coverage = bitrix.list_activities_sliced(
+        [{"PROVIDER_ID": "A"}, {"PROVIDER_ID": "B"}], ["ID"], since, until,
+        step=timedelta(hours=2), concurrency=3,
+    )
+    assert len(queries) == 4 and coverage["queries"] == 4 and coverage["slices"] == 2
+    assert all(set(q) == {"PROVIDER_ID", ">=CREATED", "<CREATED"} for q in queries)
+    # по фильтру — срезы новыми первыми
+    assert [[r["ID"] for r in part] for part in streams[0]] == [["7", "5"], ["3", "1"]]
+    assert [[r["ID"] for r in part] for part in streams[1]] == [["8", "6"], ["4", "2"]]
+    assert coverage["rows"] == 8 and not coverage["truncated"]
+    assert coverage["covered_since"] == since.isoformat()
+
+
+def test_list_activities_sliced_reports_truncation(activities):
+    from datetime import datetime, timedelta, timezone
+
+    rows, _ = activities
+    since = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    until = since + timedelta(hours=4)
+    for m in range(0, 240, 20):
+        rows.append({"ID": str(m + 1), "PROVIDER_ID": "A", "CREATED": (since + timedelta(minutes=m)).isoformat()})
+
+    streams, coverage = bitrix.list_activities_sliced(
+        [{"PROVIDER_ID": "A"}], None, since, until, step=timedelta(hours=2), concurrency=1, max_rows=2,
+    )
+    assert [len(part) for part in streams[0]] == [2, 2]
+    assert coverage["truncated"]
+    # полная выгрузка — только начиная с самой поздней точки обрыва среди срезов
+    assert coverage["covered_since"] == (since + timedelta(minutes=200)).isoformat()
@@ -0,0 +1,36 @@
+import cache
+from cache import TTLCache
+
+
+def test_lru_evicts_least_recently_used():
+    c = TTLCache(2, 60)
+    c.set("a", 1)
+    c.set("b", 2)
+    assert c.get("a") == 1  # a — свежее b
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert (c.get("a"), c.get("c")) == (1, 3)
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    c = TTLCache(10, 30)
+    c.set("k", "v")
+    now[0] += 29
+    assert c.get("k") == "v"
+    now[0] += 2
+    assert c.get("k", "gone") == "gone"
+    assert c.stats()["size"] == 0
+
+
+def test_pop_clear_and_stats():
+    c = TTLCache(0, 60)  # не меньше одной записи
+    c.set("a", 1)
+    c.pop("a")
+    c.pop("missing")
+    assert c.get("a") is None
+    c.set("b", 2)
+    assert c.get("b") == 2
+    c.clear()
+    assert c.stats() == {"size": 0, "maxsize": 1, "ttl_sec": 60.0, "hits": 1, "misses": 1, "hit_rate": 0.5}
@@ -0,0 +1,128 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import logic
+from logic import CallIndex, normalize_phone
+
+T0 = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize("raw", ["+7 (900) 123-45-67", "8 900 1234567", "9001234567", "79001234567"])
+def test_normalize_phone_russian_forms(raw):
+    assert normalize_phone(raw) == "79001234567"
+
+
+@pytest.mark.parametrize("raw, expected", [(None, ""), ("", ""), ("ext. 123", "123"), ("+44 20 7946 0958", "442079460958")])
+def test_normalize_phone_other(raw, expected):
+    assert normalize_phone(raw) == expected
+
+
+def _call(minutes, **kw):
+    return {"CALL_ID": f"c{minutes}", "CALL_START_DATE": (T0 + timedelta(minutes=minutes)).isoformat(), **kw}
+
+
+def test_call_index_by_entity_skips_failed_calls():
+    idx = CallIndex(
+        [
+            _call(5, CRM_ENTITY_TYPE="LEAD", CRM_ENTITY_ID="10", CALL_FAILED_CODE="304"),
+            _call(20, CRM_ENTITY_TYPE="LEAD", CRM_ENTITY_ID="10"),
+        ],
+        [{"ID": "a1", "OWNER_TYPE_ID": "2", "OWNER_ID": "7", "CREATED": (T0 + timedelta(minutes=1)).isoformat(),
+          "COMPLETED": "Y"}],
+        covered_since=T0,
+    )
+    assert idx.first_call_after("1", "10", [], T0) == (T0 + timedelta(minutes=20), "c20")
+    assert idx.first_call_after("1", "10", [], T0 + timedelta(minutes=21)) is None
+    assert idx.first_call_after(2, 7, [], T0)[1] == "a1"
+    assert idx.covers(T0) and not idx.covers(T0 - timedelta(seconds=1))
+
+
+def test_call_index_matches_unbound_call_by_phone():
+    idx = CallIndex([_call(3, PHONE_NUMBER="8 (900) 123-45-67")], [], covered_since=T0)
+    assert idx.first_call_after("1", "10", ["79001234567"], T0)[1] == "c3"
+    assert idx.first_call_after("1", "10", ["79990000000"], T0) is None
+
+
+@pytest.fixture
+def call_log(monkeypatch):
+    """CallLog с журналом телефонии из списка; requests — с какой даты запрашивали."""
+    monkeypatch.setattr(logic, "CALL_LOG_MIN_INTERVAL", 0.0)
+    monkeypatch.setattr(logic, "CALL_LOG_OVERLAP_SEC", 3600.0)
+    journal, requests = [], []
+
+    def list_call_log(since_iso, max_rows=None, order="ASC"):
+        requests.append(datetime.fromisoformat(since_iso))
+        since = datetime.fromisoformat(since_iso)
+        rows = [c for c in journal if datetime.fromisoformat(c["CALL_START_DATE"]) >= since]
+        return sorted(rows, key=lambda c: c["CALL_START_DATE"], reverse=True)[:max_rows], "voximplant.statistic.get"
+
+    monkeypatch.setattr(logic, "list_call_log", list_call_log)
+    return logic.CallLog(), journal, requests
+
+
+def test_call_log_fetches_delta_with_overlap(call_log):
+    log, journal, requests = call_log
+    now = datetime.now(timezone.utc)
+    since = now - timedelta(days=2)
+    journal.append({"CALL_ID": "old", "CALL_START_DATE": (now - timedelta(days=1)).isoformat()})
+
+    calls, covered = log.calls(since)
+    assert [c["CALL_ID"] for c in calls] == ["old"] and covered == since
+    assert requests == [since]
+
+    # звонок начался до прошлой выгрузки, а в журнал попал после — его ловит перекрытие
+    journal.append({"CALL_ID": "long", "CALL_START_DATE": (now - timedelta(minutes=30)).isoformat()})
+    calls, _ = log.calls(since)
+    assert sorted(c["CALL_ID"] for c in calls) == ["long", "old"]
+    assert len(requests) == 2
+    assert timedelta(minutes=59) < now - requests[1] < timedelta(minutes=61)
+
+
+def test_call_log_trims_window_and_refetches_when_delta_overflows(call_log, monkeypatch):
+    log, journal, requests = call_log
+    now = datetime.now(timezone.utc)
+    journal.append({"CALL_ID": "a", "CALL_START_DATE": (now - timedelta(days=3)).isoformat()})
+    log.calls(now - timedelta(days=4))
+
+    # окно сдвинулось: звонок вне окна выпадает из журнала
+    calls, _ = log.calls(now - timedelta(days=2))
+    assert calls == []
+
+    # дельта упёрлась в лимит — журнал выгружается заново целиком
+    monkeypatch.setattr(logic, "MAX_ROWS_CALL_INDEX", 1)
+    journal.append({"CALL_ID": "b", "CALL_START_DATE": (now - timedelta(hours=30)).isoformat()})
+    journal.append({"CALL_ID": "c", "CALL_START_DATE": (now - timedelta(minutes=1)).isoformat()})
+    since = now - timedelta(days=2)
+    calls, covered = log.calls(since)
+    assert requests[-1] == since
+    assert [c["CALL_ID"] for c in calls] == ["c"]
+    assert covered > now - timedelta(minutes=2)
+
+
+def test_call_log_without_telephony(monkeypatch):
+    monkeypatch.setattr(logic, "list_call_log", lambda *a, **kw: ([], None))
+    assert logic.CallLog().calls(T0) is None
+
+
+def test_gap_call_log_finds_unbound_calls_older_than_call_log(monkeypatch):
+    requests = []
+
+    def list_call_log(since_iso, until_iso=None, max_rows=None, order="ASC"):
+        requests.append((since_iso, until_iso))
+        return [_call(30, PHONE_NUMBER="+7 900 123-45-67")], "voximplant.statistic.get"
+
+    monkeypatch.setattr(logic, "list_call_log", list_call_log)
+    call_log = CallIndex([], [], covered_since=T0 + timedelta(hours=1))
+    old = {"etype": "1", "eid": "10", "phones": ["79001234567"], "t_in": T0}
+    fresh = {"etype": "1", "eid": "11", "phones": ["79001234567"], "t_in": T0 + timedelta(hours=2)}
+    no_phone = {"etype": "1", "eid": "12", "phones": [], "t_in": T0 - timedelta(hours=1)}
+
+    # журнал по номеру нужен только входящим старше покрытия CallLog, и только до него
+    gap, capped = logic._gap_call_log([old, fresh, no_phone], call_log)
+    assert requests == [(logic._iso(T0), logic._iso(T0 + timedelta(hours=1)))]
+    assert logic._call_log_hit(old, gap)[1] == "c30" and capped == set()
+
+    monkeypatch.setattr(logic, "MAX_ROWS_CALL_INDEX", 1)
+    assert logic._gap_call_log([old, fresh], call_log)[1] == {id(old)}
+    assert logic._gap_call_log([fresh, no_phone], call_log) == (None, set())
@@ -0,0 +1,52 @@
+import itertools
+
+import pytest
+
+import entity_state
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture
+def key():
+    """Своя сущность на тест: база одна на всю сессию."""
+    return "1", f"es{next(_ids)}"
+
+
+def test_reply_after_incoming_clears(key):
+    assert entity_state.mark_incoming(*key, 100.0, activity_id="a1", provider_id="IMOPENLINES_SESSION")
+    assert entity_state.get(*key)["awaiting_since_ts"] == 100.0
+    assert entity_state.mark_replied(*key, 150.0)
+    row = entity_state.get(*key)
+    assert row["awaiting_since_ts"] is None and row["last_reply_ts"] == 150.0
+
+
+def test_late_incoming_before_known_reply_is_ignored(key):
+    entity_state.mark_replied(*key, 200.0)
+    assert not entity_state.mark_incoming(*key, 150.0)
+    assert entity_state.get(*key)["awaiting_since_ts"] is None
+
+
+def test_events_out_of_order_give_same_state(key):
+    other = (key[0], key[1] + "b")
+    entity_state.mark_incoming(*key, 100.0, activity_id="a1")
+    entity_state.mark_incoming(*key, 300.0, activity_id="a3")
+    entity_state.mark_incoming(*other, 300.0, activity_id="a3")
+    entity_state.mark_incoming(*other, 100.0, activity_id="a1")
+
+    for k in (key, other):
+        row = entity_state.get(*k)
+        assert row["awaiting_since_ts"] == 100.0
+        assert row["last_in_ts"] == 300.0 and row["activity_id"] == "a3"
+
+
+def test_reply_between_incomings_waits_for_the_last(key):
+    entity_state.mark_incoming(*key, 100.0)
+    entity_state.mark_incoming(*key, 300.0)
+    assert not entity_state.mark_replied(*key, 200.0)
+    assert entity_state.get(*key)["awaiting_since_ts"] == 300.0
+
+    # более старый ответ пришёл позже — последний ответ не откатывается
+    entity_state.mark_replied(*key, 50.0)
+    row = entity_state.get(*key)
+    assert row["awaiting_since_ts"] == 300.0 and row["last_reply_ts"] == 200.0
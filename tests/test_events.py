@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta, timezone
+
+import activity_store
+import events
+
+
+def test_activity_delete_event_drops_mirror_row(monkeypatch):
+    created = datetime.now(timezone.utc) - timedelta(hours=1)
+    activity_store.ensure_schema("activities", activity_store._DDL)
+    activity_store._upsert([{"ID": "9001", "CREATED": created.isoformat(), "OWNER_TYPE_ID": "2",
+                             "OWNER_ID": "1", "DIRECTION": "2", "PROVIDER_ID": "WAZZUP"}])
+    monkeypatch.setattr(events, "batch", lambda commands: {})
+
+    events._process([{"event": "ONCRMACTIVITYDELETE", "data": {"FIELDS": {"ID": "9001"}}, "ts": "1"}])
+    assert "9001" not in {r["ID"] for r in activity_store.query(since=created - timedelta(minutes=1))}
+    assert events.stats()["processed"] >= 1
+
+
+def test_failed_event_is_not_marked_seen(monkeypatch):
+    def apply(row):
+        if row["ID"] == "8002":
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(events, "_apply_activity", apply)
+    monkeypatch.setattr(events, "batch", lambda commands: {
+        "a8001": {"result": {"ID": "8001"}},
+        "a8002": {"result": {"ID": "8002"}},
+        "a8003": {"error": "QUERY_LIMIT_EXCEEDED", "error_description": "Too many requests"},
+    })
+    batch = [{"event": "ONCRMACTIVITYADD", "data": {"FIELDS": {"ID": i}}, "ts": "1"} for i in ("8001", "8002", "8003")]
+
+    events._process(batch)
+    keys = [events._event_key(e) for e in batch]
+    # повторная доставка упавших событий снова будет обработана
+    assert events._unseen(keys) == set(keys[1:])
@@ -0,0 +1,128 @@
+import itertools
+import time
+
+import pytest
+
+import history
+
+_ids = itertools.count(1)
+
+
+@pytest.fixture
+def portal():
+    """Свой портал на тест: база одна на всю сессию."""
+    return f"p{next(_ids)}.example"
+
+
+def _alert(eid, provider="IMOPENLINES_SESSION", responsible="5", etype="2"):
+    return {"owner_type_id": etype, "owner_id": str(eid), "provider_id": provider,
+            "responsible_id": responsible, "last_in_created": "2024-05-01T10:00:00+00:00"}
+
+
+def test_alerts_default_to_latest_full_scan(portal):
+    now = time.time()
+    history.record("s1", portal, "schedule", now - 200, now - 190, [_alert(1), _alert(2)])
+    history.record("s2", portal, "manual", now - 100, now - 90, [_alert(3)])
+    history.record("s3", portal, "sla", now - 10, now - 10, [_alert(4)])  # таймеры — не полный скан
+    history.record("s4", portal, "schedule", now - 5, now - 5, None, error="boom")
+
+    page = history.alerts(portal)
+    assert page["scan"]["scan_id"] == "s2"
+    assert [a["owner_id"] for a in page["items"]] == ["3"]
+    assert history.alerts(portal, scan_id="s3")["items"][0]["owner_id"] == "4"
+
+
+def test_alerts_cursor_pagination(portal):
+    now = time.time()
+    history.record("c1", portal, "manual", now, now, [_alert(i) for i in range(7)])
+
+    seen, cursor = [], None
+    while True:
+        page = history.alerts(portal, scan_id="c1", limit=3, cursor=cursor)
+        seen.extend(a["owner_id"] for a in page["items"])
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == [str(i) for i in range(6, -1, -1)]
+
+
+def test_alerts_filters(portal):
+    now = time.time()
+    history.record("f1", portal, "manual", now, now, [
+        _alert(1, provider="WAZZUP", responsible="7"), _alert(2), _alert(3, etype="1"),
+    ])
+    assert [a["owner_id"] for a in history.alerts(portal, scan_id="f1", provider_id="WAZZUP")["items"]] == ["1"]
+    assert [a["owner_id"] for a in history.alerts(portal, scan_id="f1", responsible_id=5)["items"]] == ["3", "2"]
+    assert [a["owner_id"] for a in history.alerts(portal, scan_id="f1", owner_type_id="1")["items"]] == ["3"]
+
+
+def test_rerecording_scan_replaces_alerts(portal):
+    now = time.time()
+    history.record("r1", portal, "manual", now, now, [_alert(1), _alert(2)])
+    history.record("r1", portal, "manual", now, now + 1, [_alert(2)])
+    assert [a["owner_id"] for a in history.alerts(portal, scan_id="r1")["items"]] == ["2"]
+
+
+def test_trends_by_day_and_group(portal):
+    now = max(time.time(), time.time() // 86400 * 86400 + 60)  # все сканы — в одних сутках UTC
+    history.record("t1", portal, "schedule", now - 30, now - 20, [_alert(1), _alert(2, provider="WAZZUP")])
+    history.record("t2", portal, "schedule", now - 10, now - 5, [_alert(1)])
+    history.record("t3", portal, "schedule", now - 3, now - 2, None, error="boom")
+
+    items = history.trends(portal, days=1)["items"]
+    assert len(items) == 1
+    day = items[0]
+    assert (day["scans"], day["failed"]) == (3, 1)
+    assert day["entities"] == 2 and day["last_scan_alerts"] == 1
+
+    groups = {g["key"]: g for g in history.trends(portal, days=1, group_by="provider")["items"][0]["groups"]}
+    assert groups["IMOPENLINES_SESSION"] == {"key": "IMOPENLINES_SESSION", "entities": 1, "last_scan_alerts": 1}
+    assert groups["WAZZUP"]["entities"] == 1 and groups["WAZZUP"]["last_scan_alerts"] == 0
+
+    with pytest.raises(ValueError):
+        history.trends(portal, group_by="owner_id")
+
+
+def _verdict(eid, outcome, evidence=None, cached=False, in_ts=1_714_557_600.0):
+    return {"owner_type_id": "2", "owner_id": str(eid), "provider_id": "IMOPENLINES_SESSION", "in_ts": in_ts,
+            "activity_id": f"a{eid}", "outcome": outcome, "evidence": evidence, "cached": cached}
+
+
+def test_verdicts_keep_every_checked_candidate(portal):
+    now = time.time()
+    checked = [_verdict(1, "replied", "r1", cached=True), _verdict(2, "called", "c2", in_ts=1_714_560_000.0),
+               _verdict(3, "unanswered")]
+    history.record("v1", portal, "manual", now, now, [_alert(3)], verdicts=checked)
+
+    page = history.verdicts(portal)
+    assert page["scan"]["scan_id"] == "v1"
+    assert [(v["owner_id"], v["outcome"], v["evidence"]) for v in page["items"]] == [
+        ("2", "called", "c2"), ("1", "replied", "r1"), ("3", "unanswered", None),
+    ]
+    assert page["items"][1]["cached"] is True and page["items"][0]["cached"] is False
+    assert [v["owner_id"] for v in history.verdicts(portal, outcome="unanswered")["items"]] == ["3"]
+
+    history.record("v1", portal, "manual", now, now + 1, [], verdicts=[_verdict(1, "replied", "r1")])
+    assert [v["owner_id"] for v in history.verdicts(portal, scan_id="v1")["items"]] == ["1"]
+
+
+def test_scan_verdicts_cover_cached_checked_and_unanswered():
+    from datetime import datetime, timezone
+
+    import logic
+
+    t_in = datetime(2024, 5, 1, 10, 0, tzinfo=timezone.utc)
+
+    def cand(eid, **kw):
+        return {"etype": "2", "eid": str(eid), "t_in": t_in, "last": {"ID": f"a{eid}", "PROVIDER_ID": "WAZZUP"}, **kw}
+
+    cached = cand(1, verdict="replied", evidence="r1", cached=True)
+    checked = cand(2, verdict="called", evidence="c2")
+    left = cand(3)
+    logic._report_verdicts([cached, checked, left], [left])
+
+    got = {v["owner_id"]: v for v in logic.scan_verdicts()}
+    assert (got["1"]["outcome"], got["1"]["evidence"], got["1"]["cached"]) == ("replied", "r1", True)
+    assert (got["2"]["outcome"], got["2"]["cached"]) == ("called", False)
+    assert (got["3"]["outcome"], got["3"]["evidence"]) == ("unanswered", None)
+    assert got["3"]["in_ts"] == t_in.timestamp() and got["3"]["provider_id"] == "WAZZUP"
@@ -0,0 +1,61 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import http_client
+
+
+class _Echo(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        body = self.headers.get("Connection", "").encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    srv = ThreadingHTTPServer(("127.0.0.1", 0), _Echo)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}/"
+    srv.shutdown()
+    srv.server_close()
+
+
+def test_client_is_shared_by_name():
+    assert http_client.get_client("tests-a") is http_client.get_client("tests-a")
+    assert http_client.get_client("tests-a") is not http_client.get_client("tests-b")
+
+
+def test_requests_reuse_one_connection(server):
+    client = http_client.HttpClient("tests-reuse")
+    for _ in range(5):
+        r = client.post(server, json={"x": 1}, timeout=5)
+        assert r.status_code == 200 and r.text == "keep-alive"
+    assert client.stats() == {"requests": 5, "connections_opened": 1, "connections_reused": 4}
+
+
+def test_threads_share_the_pool_but_not_the_session(server):
+    client = http_client.HttpClient("tests-threads")
+    sessions = []
+
+    def work():
+        client.post(server, data=b"x", timeout=5)
+        sessions.append(client._session())
+
+    threads = [threading.Thread(target=work) for _ in range(3)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert len({id(s) for s in sessions}) == 3
+    assert {id(s.get_adapter(server)) for s in sessions} == {id(client._adapter)}
+    assert client.stats()["requests"] == 3
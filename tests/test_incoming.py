@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+
+import logic
+
+T0 = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _row(rid, minutes, provider="IMOPENLINES_SESSION", owner_type="2", **kw):
+    return {"ID": str(rid), "CREATED": (T0 + timedelta(minutes=minutes)).isoformat(),
+            "PROVIDER_ID": provider, "OWNER_TYPE_ID": owner_type, "OWNER_ID": "1", **kw}
+
+
+def test_incoming_filters_push_channels_down():
+    filters = logic._incoming_filters()
+    by_id = [f["PROVIDER_ID"] for f in filters if "PROVIDER_ID" in f]
+    assert by_id == sorted(logic.PROVIDERS_MSG)
+    by_type = [f for f in filters if "PROVIDER_TYPE_ID" in f]
+    assert len(by_type) == len(logic.PROVIDERS_TYPE)
+    # подтипы исключают уже выбранные каналы: строка не приходит дважды
+    assert all(f["!PROVIDER_ID"] == sorted(logic.PROVIDERS_MSG) for f in by_type)
+    assert all(f["DIRECTION"] == 2 and f["OWNER_TYPE_ID"] == [1, 2, 3, 4] for f in filters)
+
+
+def test_merge_orders_by_created_and_drops_duplicates():
+    ol = [_row(5, 50), _row(3, 30), _row(1, 10)]
+    wa = [_row(9, 40, provider="WAZZUP"), _row(3, 30), _row(2, 20, provider="WAZZUP")]
+    rows, capped = logic._merge_incoming([ol, wa])
+    assert [r["ID"] for r in rows] == ["5", "9", "3", "2", "1"]
+    assert not capped
+
+
+def test_merge_keeps_only_tracked_message_rows():
+    stream = [
+        _row(4, 40, owner_type="7"),           # тип сущности не отслеживается
+        _row(3, 30, provider="VOXIMPLANT_CALL"),
+        _row(2, 20, provider="X", PROVIDER_TYPE_ID="WHATSAPP"),
+        _row(1, 10),
+    ]
+    rows, _ = logic._merge_incoming([stream])
+    assert [r["ID"] for r in rows] == ["2", "1"]
+
+
+def test_merge_cap_reports_truncation():
+    stream = [_row(i, i) for i in range(10, 0, -1)]
+    rows, capped = logic._merge_incoming([stream], max_rows=3)
+    assert [r["ID"] for r in rows] == ["10", "9", "8"] and capped
+    rows, capped = logic._merge_incoming([stream], max_rows=10)
+    assert len(rows) == 10 and capped  # ровно на лимите — дальше могли быть ещё строки
+    rows, capped = logic._merge_incoming([stream], max_rows=11)
+    assert len(rows) == 10 and not capped
+
+
+def test_created_desc_sorts_by_created_not_id():
+    rows = [_row(1, 30), _row(2, 10), _row(3, 20)]
+    assert [r["ID"] for r in logic._created_desc(rows)] == ["1", "3", "2"]
+
+
+def _window(monkeypatch, rows, max_rows):
+    """Окно в сутки четырьмя срезами; Bitrix — строки из списка (ID DESC, max_rows на запрос)."""
+    import bitrix
+
+    monkeypatch.setattr(logic, "ACTIVITY_STORE", False)
+    monkeypatch.setattr(logic, "INCOMING_PUSHDOWN", True)
+    monkeypatch.setattr(logic, "WINDOW_DAYS", 1)
+    monkeypatch.setattr(logic, "INCOMING_SLICE_HOURS", 6)
+    monkeypatch.setattr(logic, "INCOMING_CONCURRENCY", 2)
+    monkeypatch.setattr(logic, "MAX_ROWS_INCOMING", max_rows)
+
+    def iter_activities(flt, select, *, descending=False, max_rows=None):
+        lo, hi = datetime.fromisoformat(flt[">=CREATED"]), datetime.fromisoformat(flt["<CREATED"])
+        found = [r for r in rows if r["PROVIDER_ID"] == flt.get("PROVIDER_ID")
+                 and lo <= datetime.fromisoformat(r["CREATED"]) < hi]
+        found.sort(key=lambda r: int(r["ID"]), reverse=True)
+        return iter(found[:max_rows] if max_rows else found)
+
+    monkeypatch.setattr(bitrix, "iter_activities", iter_activities)
+
+
+def test_fetch_incoming_reports_full_coverage(monkeypatch):
+    now = datetime.now(timezone.utc)
+    rows = [{"ID": str(i), "CREATED": (now - timedelta(hours=23 - i)).isoformat(),
+             "PROVIDER_ID": "IMOPENLINES_SESSION", "OWNER_TYPE_ID": "2", "OWNER_ID": str(i)} for i in range(20)]
+    _window(monkeypatch, rows, max_rows=0)
+
+    got = logic.fetch_recent_incoming_messages()
+    assert [r["ID"] for r in got] == [str(i) for i in range(19, -1, -1)]
+    cov = logic.incoming_coverage()
+    assert cov["slices"] == 4 and cov["queries"] == 4 * len(logic._incoming_filters())
+    assert cov["rows"] == cov["messages"] == 20
+    assert not cov["truncated"] and cov["covered_since"] == cov["since"]
+
+
+def test_fetch_incoming_reports_truncation(monkeypatch):
+    now = datetime.now(timezone.utc)
+    rows = [{"ID": str(i), "CREATED": (now - timedelta(hours=23 - i)).isoformat(),
+             "PROVIDER_ID": "IMOPENLINES_SESSION", "OWNER_TYPE_ID": "2", "OWNER_ID": str(i)} for i in range(20)]
+    _window(monkeypatch, rows, max_rows=5)
+
+    got = logic.fetch_recent_incoming_messages()
+    assert [r["ID"] for r in got] == ["19", "18", "17", "16", "15"]
+    cov = logic.incoming_coverage()
+    assert cov["truncated"] and cov["messages"] == 5
+    assert datetime.fromisoformat(cov["covered_since"]) == datetime.fromisoformat(got[-1]["CREATED"])
@@ -0,0 +1,133 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import bitrix
+import logic
+from bitrix import BitrixError
+
+NOW = datetime.now(timezone.utc).replace(microsecond=0)
+SINCE = NOW - timedelta(days=1)
+
+
+def _act(rid, hours_ago, **kw):
+    return {"ID": str(rid), "CREATED": (NOW - timedelta(hours=hours_ago)).isoformat(), "OWNER_TYPE_ID": "2",
+            "OWNER_ID": str(rid), "PROVIDER_ID": "IMOPENLINES_SESSION", "DIRECTION": "1", **kw}
+
+
+@pytest.fixture
+def portal(monkeypatch):
+    """Окно в сутки четырьмя срезами; Bitrix — строки из списка, keyset по ID (ID DESC, max_rows на запрос)."""
+    monkeypatch.setattr(logic, "ACTIVITY_STORE", False)
+    monkeypatch.setattr(logic, "INCOMING_SLICE_HOURS", 6)
+    monkeypatch.setattr(logic, "INCOMING_CONCURRENCY", 2)
+    rows, queries = [], []
+
+    def iter_activities(flt, select, *, descending=False, max_rows=None):
+        queries.append((flt, descending))
+        lo, hi = datetime.fromisoformat(flt[">=CREATED"]), datetime.fromisoformat(flt["<CREATED"])
+        found = [r for r in rows if lo <= datetime.fromisoformat(r["CREATED"]) < hi]
+        found.sort(key=lambda r: int(r["ID"]), reverse=descending)
+        return iter(found[:max_rows] if max_rows else found)
+
+    monkeypatch.setattr(bitrix, "iter_activities", iter_activities)
+    return rows, queries
+
+
+def test_reply_index_reads_window_by_slices(portal):
+    rows, queries = portal
+    rows += [_act(i, 23 - i) for i in range(20)]
+
+    index = logic.build_reply_index(SINCE)
+    cov = logic.index_coverage()["reply_index"]
+    assert cov["slices"] >= 4 and len(queries) == cov["queries"] == cov["slices"]
+    assert all(desc and flt["DIRECTION"] == 1 and "order" not in flt for flt, desc in queries)
+    assert cov["rows"] == cov["indexed"] == 20 and not cov["truncated"]
+    assert index.covers(SINCE)
+    assert index.first_reply_after("2", "7", SINCE)[1] == "7"
+
+
+def test_reply_index_cap_keeps_newest_rows(portal, monkeypatch):
+    rows, _ = portal
+    monkeypatch.setattr(logic, "MAX_ROWS_REPLY_INDEX", 7)  # больше строк любого среза, меньше всего окна
+    rows += [_act(i, 23 - i) for i in range(20)]
+
+    index = logic.build_reply_index(SINCE)
+    assert index.covered_since == datetime.fromisoformat(rows[13]["CREATED"]) + timedelta(seconds=1)
+    assert index.first_reply_after("2", "13", SINCE) is not None
+    assert index.first_reply_after("2", "12", SINCE) is None and not index.covers(SINCE)
+    cov = logic.index_coverage()["reply_index"]
+    assert cov["truncated"] and cov["indexed"] == 7
+
+
+def test_reply_index_truncated_slice_is_not_trusted(portal, monkeypatch):
+    rows, _ = portal
+    monkeypatch.setattr(logic, "MAX_ROWS_REPLY_INDEX", 2)
+    # ID не растёт вместе с CREATED: по ID DESC срез отдаёт не самые поздние строки
+    rows += [_act(10, 1), _act(30, 3), _act(20, 2)]
+
+    index = logic.build_reply_index(SINCE)
+    assert index.first_reply_after("2", "30", SINCE) is not None  # найденный ответ — всё равно ответ
+    assert index.first_reply_after("2", "10", SINCE) is None
+    assert not index.covers(NOW - timedelta(hours=2))  # отсутствие ответа в срезе не доказано
+
+
+def test_call_index_coverage_is_the_later_of_both_sources(portal, monkeypatch):
+    rows, queries = portal
+    monkeypatch.setattr(logic, "MAX_ROWS_CALL_INDEX", 0)
+    log_covered = SINCE + timedelta(hours=2)
+    monkeypatch.setattr(logic._CALL_LOG, "calls", lambda since: ([], log_covered))
+    rows += [_act(1, 3, PROVIDER_ID="VOXIMPLANT_CALL", COMPLETED="Y")]
+
+    index = logic.build_call_index(SINCE)
+    assert index.covered_since == log_covered
+    assert all(flt["PROVIDER_ID"] == ["VOXIMPLANT_CALL", "CALL"] for flt, _ in queries)
+    assert logic.index_coverage()["call_index"]["rows"] == 1
+
+
+def test_failed_index_export_falls_back_to_entity_checks(monkeypatch):
+    def broken(since):
+        raise BitrixError("INTERNAL_SERVER_ERROR", "INTERNAL_SERVER_ERROR", 500, "down")
+
+    used = []
+
+    def stage(name):
+        def run(cands):
+            used.append(name)
+            return cands
+        return run
+
+    monkeypatch.setattr(logic, "REPLY_CHECK_MODE", "index")
+    monkeypatch.setattr(logic, "CALL_CHECK_MODE", "index")
+    monkeypatch.setattr(logic, "INDEX_MIN_CANDIDATES", 1)
+    monkeypatch.setattr(logic, "BATCH_CHECKS", True)
+    monkeypatch.setattr(logic.verdicts, "VERDICT_CACHE", False)
+    monkeypatch.setattr(logic, "build_reply_index", broken)
+    monkeypatch.setattr(logic, "build_call_index", broken)
+    for name in ("_batch_drop_replied", "_batch_drop_called", "_batch_drop_operator_last"):
+        monkeypatch.setattr(logic, name, stage(name))
+    failures = logic.INDEX_FAILURES.value(index="reply_index")
+
+    cand = {"etype": "2", "eid": "1", "t_in": NOW - timedelta(hours=2), "last": {"ID": "5"}}
+    assert logic._poll_candidates([cand], NOW) == [cand]
+    assert used == ["_batch_drop_replied", "_batch_drop_called", "_batch_drop_operator_last"]
+    assert logic.INDEX_FAILURES.value(index="reply_index") == failures + 1
+
+
+def test_index_drop_called_looks_up_each_candidate_once(monkeypatch):
+    index = logic.CallIndex([], [_act(1, 2, PROVIDER_ID="CALL", COMPLETED="Y")], NOW - timedelta(hours=5))
+    lookups = []
+    first_call_after = index.first_call_after
+    monkeypatch.setattr(index, "first_call_after", lambda *a: lookups.append(a[1]) or first_call_after(*a))
+    monkeypatch.setattr(logic, "BATCH_CHECKS", True)
+    fallback = []
+    monkeypatch.setattr(logic, "_batch_drop_called", lambda cands: fallback.extend(cands) or cands)
+
+    def cand(eid, hours_ago):
+        return {"etype": "2", "eid": str(eid), "phones": [], "t_in": NOW - timedelta(hours=hours_ago)}
+
+    cands = [cand(1, 3), cand(2, 3), cand(3, 10)]  # звонок есть; нет звонка; старше покрытия
+    left = logic._index_drop_called(cands, index)
+    assert [c["eid"] for c in left] == ["2", "3"]
+    assert lookups == ["1", "2", "3"]
+    assert [c["eid"] for c in fallback] == ["3"] and cands[0]["evidence"] == "1"
@@ -0,0 +1,56 @@
+import dialogs
+import logic
+import verdicts
+
+
+def _row(last_updated: str) -> dict:
+    return {"ID": "10", "CREATED": "2026-01-01T10:00:00+03:00", "LAST_UPDATED": last_updated}
+
+
+def test_incoming_select_has_last_updated():
+    assert "LAST_UPDATED" in logic._INCOMING_SELECT
+    assert logic._dialog_marker(_row("2026-01-01T10:05:00+03:00")) == "10:2026-01-01T10:05:00+03:00"
+
+
+def test_changed_last_updated_evicts_dialog_cache(monkeypatch):
+    calls = []
+
+    def fake_batch(cmds):
+        calls.append(cmds)
+        return {k: {"result": {"messages": [{"id": len(calls), "author_id": 1}], "users": []}} for k in cmds}
+
+    monkeypatch.setattr(dialogs, "batch", fake_batch)
+    dialogs._dialogs.clear()
+    first = logic._dialog_marker(_row("2026-01-01T10:00:00+03:00"))
+
+    dialogs.get_last_messages({"imol|x": first})
+    dialogs.get_last_messages({"imol|x": first})
+    assert len(calls) == 1  # тот же отпечаток — из кэша
+
+    second = logic._dialog_marker(_row("2026-01-01T10:07:00+03:00"))
+    lm = dialogs.get_last_messages({"imol|x": second})
+    assert len(calls) == 2
+    assert lm["imol|x"][0]["id"] == 2
+
+
+def test_changed_last_updated_invalidates_verdict():
+    key = ("1", "777")
+    marker = logic._dialog_marker(_row("2026-01-01T10:00:00+03:00"))
+    verdicts.save([(*key, "10", marker, "operator_last", "5")])
+    assert key in verdicts.resolved({key: ("10", marker)})
+
+    changed = logic._dialog_marker(_row("2026-01-01T10:07:00+03:00"))
+    assert verdicts.resolved({key: ("10", changed)}) == {}
+
+
+def test_dialog_batch_uses_same_params_as_single_call(monkeypatch):
+    import bitrix
+
+    sent = []
+    monkeypatch.setattr(dialogs, "batch", lambda cmds: sent.extend(cmds.values()) or {})
+    monkeypatch.setattr(bitrix, "_post", lambda method, payload: sent.append((method, payload)) or {"result": {}})
+    dialogs._dialogs.clear()
+
+    dialogs.get_last_messages({"imol|y": "m1"})
+    bitrix.get_last_openlines_messages("imol|y")
+    assert sent[0] == sent[1] == ("im.dialog.messages.get", {"DIALOG_ID": "imol|y", "LIMIT": 1, "SORT": "DESC"})
@@ -0,0 +1,54 @@
+import metrics
+
+
+def _lines(metric):
+    return metric.render().split("\n")
+
+
+def test_counter_with_labels_and_escaping():
+    c = metrics.Counter("tests_calls_total", "Вызовы", ["method", "status"])
+    c.inc(method="crm.activity.list", status="ok")
+    c.inc(2, method="crm.activity.list", status="ok")
+    c.inc(method='a"b\\c\nd', status="error")
+    assert c.value(method="crm.activity.list", status="ok") == 3
+    assert _lines(c) == [
+        "# HELP tests_calls_total Вызовы",
+        "# TYPE tests_calls_total counter",
+        'tests_calls_total{method="a\\"b\\\\c\\nd",status="error"} 1',
+        'tests_calls_total{method="crm.activity.list",status="ok"} 3',
+    ]
+
+
+def test_gauge_set_and_unlabelled_sample():
+    g = metrics.Gauge("tests_queue_size", "Очередь")
+    g.set(5)
+    g.set(2.5)
+    assert _lines(g)[1:] == ["# TYPE tests_queue_size gauge", "tests_queue_size 2.5"]
+
+
+def test_histogram_buckets_are_cumulative():
+    h = metrics.Histogram("tests_seconds", "Время", ["stage"], buckets=(0.1, 1.0))
+    for v in (0.05, 0.5, 0.7, 3.0):
+        h.observe(v, stage="fetch")
+    assert _lines(h)[2:] == [
+        'tests_seconds_bucket{stage="fetch",le="0.1"} 1',
+        'tests_seconds_bucket{stage="fetch",le="1"} 3',
+        'tests_seconds_bucket{stage="fetch",le="+Inf"} 4',
+        'tests_seconds_sum{stage="fetch"} 4.25',
+        'tests_seconds_count{stage="fetch"} 4',
+    ]
+    with h.time(stage="send"):
+        pass
+    assert 'tests_seconds_count{stage="send"} 1' in _lines(h)
+
+
+def test_registry_renders_each_metric_once():
+    a = metrics.counter("tests_registry_total", "Раз")
+    b = metrics.counter("tests_registry_total", "Раз")
+    assert a is b
+    a.inc()
+    text = metrics.render()
+    assert text.endswith("\n")
+    assert text.count("# TYPE tests_registry_total counter") == 1
+    assert "tests_registry_total 1\n" in text
+    assert metrics.CONTENT_TYPE.startswith("text/plain; version=0.0.4")
@@ -0,0 +1,31 @@
+import pytest
+
+import portals
+
+WEBHOOK = "https://a.example/rest/1/token/"
+
+
+def test_parse_portals():
+    items = portals._parse({"portals": [{"name": "a", "B24_WEBHOOK": WEBHOOK, "WINDOW_DAYS": 7}]})
+    assert [p.name for p in items] == ["a"]
+    assert items[0].env == {"STORE_PATH": "a.sqlite3", "B24_WEBHOOK": WEBHOOK, "WINDOW_DAYS": "7"}
+    assert items[0].info()["host"] == "a.example"
+
+
+@pytest.mark.parametrize("data", [
+    {"name": "a"},
+    [{"name": "a b", "B24_WEBHOOK": WEBHOOK}],
+    [{"name": "a", "B24_WEBHOOK": WEBHOOK}, {"name": "a", "B24_WEBHOOK": WEBHOOK}],
+    [{"name": "a"}],
+    [{"name": "a", "B24_WEBHOOK": WEBHOOK, "DETECT_MODE": "events"}],
+])
+def test_parse_rejects_bad_config(data):
+    with pytest.raises(RuntimeError):
+        portals._parse(data)
+
+
+def test_events_mode_from_service_env_is_rejected(monkeypatch):
+    monkeypatch.setenv("DETECT_MODE", "events")
+    with pytest.raises(RuntimeError, match="DETECT_MODE"):
+        portals._parse([{"name": "a", "B24_WEBHOOK": WEBHOOK}])
+    assert portals._parse([{"name": "a", "B24_WEBHOOK": WEBHOOK, "DETECT_MODE": "poll"}])
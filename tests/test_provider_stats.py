@@ -0,0 +1,99 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import provider_stats
+from storage import ensure_schema, get_state, transaction
+
+TODAY = datetime.now(timezone.utc).date()
+
+
+def _created(days_ago):
+    return datetime.combine(TODAY - timedelta(days=days_ago), datetime.min.time(), timezone.utc) + timedelta(hours=12)
+
+
+@pytest.fixture
+def bitrix(monkeypatch):
+    """Входящие в памяти; iter_activities понимает фильтры, которыми пользуется refresh."""
+    rows, queries = [], []
+
+    def iter_activities(flt, select):
+        queries.append(flt)
+        for r in sorted(rows, key=lambda r: r["ID"]):
+            created = r["CREATED"]
+            if ">=CREATED" in flt and created < datetime.fromisoformat(flt[">=CREATED"]):
+                continue
+            if "<CREATED" in flt and created >= datetime.fromisoformat(flt["<CREATED"]):
+                continue
+            if ">ID" in flt and r["ID"] <= flt[">ID"]:
+                continue
+            if "<=ID" in flt and r["ID"] > flt["<=ID"]:
+                continue
+            yield {**r, "ID": str(r["ID"]), "CREATED": created.isoformat()}
+
+    def add(days_ago, provider="IMOPENLINES_SESSION", ptype=""):
+        rows.append({"ID": len(rows) + 1, "CREATED": _created(days_ago),
+                     "PROVIDER_ID": provider, "PROVIDER_TYPE_ID": ptype})
+
+    get_state("")  # таблица state
+    ensure_schema("provider_daily", provider_stats._DDL)
+    with transaction() as conn:
+        conn.execute("DELETE FROM provider_daily")
+        conn.execute("DELETE FROM state WHERE key LIKE 'provider_daily.%'")
+    monkeypatch.setattr(provider_stats, "iter_activities", iter_activities)
+    monkeypatch.setattr(provider_stats, "_refreshed_at", 0.0)
+    return add, queries
+
+
+def _counts():
+    with transaction() as conn:
+        return {(r["day"], r["provider_id"]): r["n"] for r in conn.execute("SELECT * FROM provider_daily")}
+
+
+def test_repeated_refresh_without_new_rows_changes_nothing(bitrix):
+    add, queries = bitrix
+    add(1), add(1), add(2, provider="wazzup")
+    provider_stats.refresh(TODAY - timedelta(days=3))
+    first = _counts()
+    assert sum(first.values()) == 3 and get_state(provider_stats._MAX_ID_KEY) == "3"
+
+    provider_stats.refresh(TODAY - timedelta(days=3))  # TTL: в Bitrix не ходим
+    assert len(queries) == 1
+    provider_stats.refresh(TODAY - timedelta(days=3), force=True)
+    assert queries[-1] == {">ID": 3, "DIRECTION": 2}
+    assert _counts() == first
+
+
+def test_new_rows_are_counted_above_max_id(bitrix):
+    add, queries = bitrix
+    add(1)
+    provider_stats.refresh(TODAY - timedelta(days=3))
+    add(1), add(0, provider="wazzup")
+    provider_stats.refresh(TODAY - timedelta(days=3), force=True)
+
+    assert queries[-1] == {">ID": 1, "DIRECTION": 2}
+    assert _counts() == {
+        ((TODAY - timedelta(days=1)).isoformat(), "IMOPENLINES_SESSION"): 2,
+        (TODAY.isoformat(), "WAZZUP"): 1,
+    }
+    assert get_state(provider_stats._MAX_ID_KEY) == "3"
+
+
+def test_earlier_day_is_backfilled_once(bitrix):
+    add, queries = bitrix
+    add(5), add(1)
+    provider_stats.refresh(TODAY - timedelta(days=2))
+    assert sum(_counts().values()) == 1
+    add(6)  # новая строка с датой в ещё не покрытом периоде: посчитает проход по >ID, не добор
+
+    provider_stats.refresh(TODAY - timedelta(days=7))
+    backfill = queries[-2]
+    assert backfill["<=ID"] == 2 and backfill["<CREATED"].startswith((TODAY - timedelta(days=2)).isoformat())
+    counts = _counts()
+    assert counts[((TODAY - timedelta(days=5)).isoformat(), "IMOPENLINES_SESSION")] == 1
+    assert counts[((TODAY - timedelta(days=6)).isoformat(), "IMOPENLINES_SESSION")] == 1
+    assert sum(counts.values()) == 3
+    assert get_state(provider_stats._COVERED_KEY) == (TODAY - timedelta(days=7)).isoformat()
+
+    summary = provider_stats.summary(7)
+    assert summary["total"] == 3 and summary["by_PROVIDER_ID"] == [("IMOPENLINES_SESSION", 3)]
@@ -0,0 +1,98 @@
+import asyncio
+
+from scans import ScanManager
+
+
+def test_second_submit_joins_running_scan():
+    calls = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def runner():  # скан «идёт», пока тест его не отпустит
+            calls.append(1)
+            await release.wait()
+            return [{"owner_id": "1"}], []
+
+        mgr = ScanManager(runner)
+        job, created = mgr.submit("manual")
+        again, created_again = mgr.submit("schedule")
+        assert created and not created_again
+        assert again is job and job.joined == 1 and mgr.current() is job
+        await asyncio.sleep(0)
+        assert job.info()["status"] == "running" and job.info()["alerts_count"] is None
+        release.set()
+        await job.done.wait()
+        assert mgr.current() is None
+        third, created_third = mgr.submit("manual")
+        assert created_third and third is not job
+        await third.done.wait()
+        return mgr, job
+
+    mgr, job = asyncio.run(main())
+    assert len(calls) == 2
+    assert job.status == "done" and job.result()["alerts"] == [{"owner_id": "1"}]
+    assert mgr.get(job.id) is job
+    assert [j["id"] for j in mgr.jobs()][-1] == job.id
+
+
+def test_failed_scan_keeps_error_and_previous_latest():
+    outcomes = [[{"owner_id": "7"}], RuntimeError("bitrix down")]
+
+    async def runner():
+        out = outcomes.pop(0)
+        if isinstance(out, Exception):
+            raise out
+        return out, []
+
+    async def main():
+        mgr = ScanManager(runner)
+        ok = await mgr.run("manual")
+        bad = await mgr.run("manual")
+        return mgr, ok, bad
+
+    mgr, ok, bad = asyncio.run(main())
+    assert bad.status == "failed" and bad.error == "bitrix down"
+    assert bad.info()["alerts_count"] is None and bad.finished_at is not None
+    assert mgr.latest()["id"] == ok.id
+
+
+def test_latest_result_survives_restart():
+    async def runner():
+        return [{"owner_id": "42"}], []
+
+    job = asyncio.run(ScanManager(runner).run("schedule"))
+    latest = ScanManager(runner).latest()  # новый процесс: результат — из базы
+    assert latest["id"] == job.id and latest["alerts"] == [{"owner_id": "42"}]
+
+
+def test_scan_verdicts_go_to_history():
+    import history
+
+    verdict = {"owner_type_id": "2", "owner_id": "9", "provider_id": "WAZZUP", "in_ts": 1_714_557_600.0,
+               "activity_id": "a9", "outcome": "replied", "evidence": "r9", "cached": False}
+
+    async def runner():
+        return [], [verdict]
+
+    job = asyncio.run(ScanManager(runner, name="verdicts.example").run("manual"))
+    items = history.verdicts("verdicts.example", scan_id=job.id)["items"]
+    assert [(v["owner_id"], v["outcome"], v["evidence"]) for v in items] == [("9", "replied", "r9")]
+
+
+def test_results_are_saved_off_the_event_loop(monkeypatch):
+    import threading
+
+    import history
+    import scans
+
+    threads = []
+    monkeypatch.setattr(history, "record", lambda *a: threads.append(threading.current_thread()))
+    monkeypatch.setattr(scans, "set_state", lambda *a: threads.append(threading.current_thread()))
+
+    async def runner():
+        return [], []
+
+    job = asyncio.run(ScanManager(runner, name="threads.example").run("manual"))
+    assert job.status == "done" and len(threads) == 2
+    assert all(t is not threading.main_thread() for t in threads)
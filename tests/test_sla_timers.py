@@ -0,0 +1,48 @@
+import time
+
+from sla_timers import TimerWheel
+
+A = ("2", "1")
+B = ("1", "7")
+
+
+def test_schedule_fires_at_deadline_only():
+    wheel = TimerWheel(1.0)
+    now = time.time()
+    wheel.schedule(A, now + 5)
+    wheel.schedule(B, now + 2)
+    assert wheel.advance(now) == []
+    assert wheel.advance(now + 2.5) == [B]
+    assert len(wheel) == 1 and wheel.deadline(A) == now + 5
+    assert wheel.advance(now + 10) == [A]
+    assert len(wheel) == 0 and wheel.deadline(A) is None
+
+
+def test_cancel_and_reschedule():
+    wheel = TimerWheel(1.0)
+    now = time.time()
+    wheel.schedule(A, now + 3)
+    wheel.cancel(A)
+    wheel.cancel(B)  # не было — не ошибка
+    assert wheel.advance(now + 4) == []
+
+    wheel.schedule(B, now + 5)
+    wheel.schedule(B, now + 8)  # новый дедлайн заменяет прежний
+    assert len(wheel) == 1
+    assert wheel.advance(now + 6) == []
+    assert wheel.advance(now + 9) == [B]
+
+
+def test_overdue_deadline_fires_on_next_tick():
+    wheel = TimerWheel(1.0)
+    now = time.time()
+    wheel.schedule(A, now - 600)
+    assert wheel.advance(now) == [A]
+
+
+def test_deadline_later_in_the_same_slot_waits():
+    wheel = TimerWheel(60.0)
+    start = wheel._cursor * 60.0  # начало текущей ячейки
+    wheel.schedule(A, start + 50)
+    assert wheel.advance(start + 10) == []
+    assert wheel.advance(start + 50) == [A]
@@ -0,0 +1,38 @@
+from telegram_bot import split_message
+
+
+def test_short_text_is_one_chunk():
+    assert split_message("a\nb", limit=100) == ["a\nb"]
+    assert split_message("", limit=100) == [""]
+
+
+def test_split_on_line_boundaries_and_numbers_parts():
+    lines = [f"line {i:02d}" for i in range(10)]  # по 7 символов
+    chunks = split_message("\n".join(lines), limit=23)
+    bodies = [c.rsplit("\n<i>", 1)[0] for c in chunks]
+    assert bodies == ["\n".join(lines[i:i + 3]) for i in range(0, 10, 3)]
+    assert [c.rsplit("\n", 1)[1] for c in chunks] == [f"<i>({i}/4)</i>" for i in range(1, 5)]
+    assert all(len(b) <= 23 for b in bodies)
+
+
+def test_overlong_line_is_cut_as_is():
+    chunks = split_message("x" * 25 + "\nok", limit=10)
+    bodies = [c.rsplit("\n<i>", 1)[0] for c in chunks]
+    assert bodies == ["x" * 10, "x" * 10, "x" * 5 + "\nok"]
+
+
+def test_format_alerts_escapes_portal_text():
+    from telegram_bot import format_alerts
+
+    text = format_alerts([{
+        "owner_type_id": "2", "owner_id": "15",
+        "url": "https://portal.example/crm/deal/details/15/?a=1&b=2",
+        "title": "<b>Окна & двери</b>", "responsible_name": "Иван <script>",
+        "provider_id": "IMOPENLINES_SESSION", "last_in_created": "2024-05-01T10:00:00+03:00",
+        "phone": "+7 900 <1>",
+    }])
+    line = text.split("\n")[1]
+    assert '<a href="https://portal.example/crm/deal/details/15/?a=1&amp;b=2">' in line
+    assert "«&lt;b&gt;Окна &amp; двери&lt;/b&gt;»" in line
+    assert "Иван &lt;script&gt;" in line and "+7 900 &lt;1&gt;" in line
+    assert "<script>" not in text and "<b>Окна" not in text
@@ -0,0 +1,22 @@
+import verdicts
+
+
+def test_resolved_reads_only_candidate_keys_in_chunks(monkeypatch):
+    monkeypatch.setattr(verdicts, "_KEYS_PER_QUERY", 2)
+    verdicts.save([
+        ("3", "1", "a1", "m1", "replied", "r1"),
+        ("3", "2", "a2", "m2", "called", "c2"),
+        ("3", "3", "a3", "m3", "unanswered", None),
+        ("3", "4", "a4", "m4", "replied", "r4"),
+        ("3", "5", "a5", "m5", "replied", "r5"),  # не кандидат этого скана
+    ])
+    current = {
+        ("3", "1"): ("a1", "m1"),
+        ("3", "2"): ("a2", "m2"),
+        ("3", "3"): ("a3", "m3"),
+        ("3", "4"): ("new", "m4"),  # пришло новое входящее — итог устарел
+        ("3", "9"): ("a9", "m9"),
+    }
+    found = verdicts.resolved(current)
+    assert sorted(found) == [("3", "1"), ("3", "2")]
+    assert found[("3", "2")]["evidence"] == "c2"
@@ -0,0 +1,117 @@
+# verdicts.py — итоги проверок по сущностям: (сущность, последнее входящее) -> ответили / дозвонились / без ответа
+from __future__ import annotations
+
+import os
+import time
+import typing as t
+
+from storage import ensure_schema, transaction
+
+# Повторный скан не перепроверяет сущность, если её последнее входящее то же и ответ на него уже найден
+VERDICT_CACHE = os.getenv("VERDICT_CACHE", "1") == "1"
+# «Последнее сообщение в диалоге ОЛ от менеджера» — не окончательно: клиент может написать
+# в ту же сессию, не создав новой активности. Такой итог живёт не дольше N секунд.
+VERDICT_DIALOG_TTL = float(os.getenv("VERDICT_DIALOG_TTL", os.getenv("DIALOG_CACHE_TTL", "600")))
+
+_DDL = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    owner_type_id TEXT NOT NULL,
+    owner_id      TEXT NOT NULL,
+    activity_id   TEXT NOT NULL,      -- последнее входящее, к которому относится итог
+    marker        TEXT NOT NULL,      -- отпечаток активности (ID:LAST_UPDATED), см. logic._dialog_marker
+    outcome       TEXT NOT NULL,      -- replied / operator_last / called / unanswered
+    evidence      TEXT,               -- ID ответа или звонка, если известен
+    checked_ts    REAL NOT NULL,
+    PRIMARY KEY (owner_type_id, owner_id)
+);
+CREATE INDEX IF NOT EXISTS verdicts_checked ON verdicts(checked_ts);
+"""
+
+# Итоги, которые не меняются, пока у сущности нет нового входящего
+FINAL = {"replied", "called"}
+
+Key = t.Tuple[str, str]
+
+# Сущностей на один SELECT в resolved: по два параметра на ключ, старый лимит SQLite — 999
+_KEYS_PER_QUERY = 400
+
+
+def _valid(row: t.Mapping[str, t.Any], now: float) -> bool:
+    if row["outcome"] in FINAL:
+        return True
+    return row["outcome"] == "operator_last" and now - row["checked_ts"] < VERDICT_DIALOG_TTL
+
+
+def resolved(current: t.Mapping[Key, tuple[str, str]]) -> t.Dict[Key, dict]:
+    """
+    current: сущность -> (ID последнего входящего, отпечаток).
+    Возвращает сущности, по которым ответ на это же входящее уже найден.
+    """
+    if not current:
+        return {}
+    ensure_schema("verdicts", _DDL)
+    now = time.time()
+    keys = list(current)
+    rows = []
+    with transaction() as conn:
+        # Только строки кандидатов — по первичному ключу, пачками в пределах лимита параметров SQLite
+        for i in range(0, len(keys), _KEYS_PER_QUERY):
+            part = keys[i:i + _KEYS_PER_QUERY]
+            rows.extend(conn.execute(
+                "SELECT * FROM verdicts WHERE (owner_type_id, owner_id) IN "
+                f"(VALUES {','.join(['(?, ?)'] * len(part))}) AND outcome != 'unanswered'",
+                [v for key in part for v in key],
+            ).fetchall())
+    found: t.Dict[Key, dict] = {}
+    for r in rows:
+        key = (r["owner_type_id"], r["owner_id"])
+        cur = current.get(key)
+        if cur and cur[0] == r["activity_id"] and cur[1] == r["marker"] and _valid(r, now):
+            found[key] = dict(r)
+    return found
+
+
+def save(items: t.Iterable[tuple[str, str, str, str, str, str | None]]) -> int:
+    """items: (OWNER_TYPE_ID, OWNER_ID, ID входящего, отпечаток, итог, evidence). Новый итог заменяет прежний."""
+    ensure_schema("verdicts", _DDL)
+    now = time.time()
+    rows = [(*item, now) for item in items]
+    if not rows:
+        return 0
+    with transaction() as conn:
+        conn.executemany(
+            "INSERT INTO verdicts(owner_type_id, owner_id, activity_id, marker, outcome, evidence, checked_ts) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(owner_type_id, owner_id) DO UPDATE SET activity_id = excluded.activity_id, "
+            "marker = excluded.marker, outcome = excluded.outcome, evidence = excluded.evidence, "
+            "checked_ts = excluded.checked_ts",
+            rows,
+        )
+    return len(rows)
+
+
+def prune(older_than: float) -> int:
+    """Удаляет итоги по сущностям, входящие которых вышли из окна скана."""
+    ensure_schema("verdicts", _DDL)
+    with transaction() as conn:
+        return conn.execute("DELETE FROM verdicts WHERE checked_ts < ?", (older_than,)).rowcount
+
+
+def get(owner_type_id: str, owner_id: str) -> dict | None:
+    ensure_schema("verdicts", _DDL)
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT * FROM verdicts WHERE owner_type_id = ? AND owner_id = ?",
+            (str(owner_type_id), str(owner_id)),
+        ).fetchone()
+    return dict(row) if row else None
+
+
+def stats() -> dict:
+    ensure_schema("verdicts", _DDL)
+    with transaction() as conn:
+        rows = conn.execute("SELECT outcome, COUNT(*) AS n FROM verdicts GROUP BY outcome").fetchall()
+    return {r["outcome"]: r["n"] for r in rows}
+
+
+__all__ = ["VERDICT_CACHE", "VERDICT_DIALOG_TTL", "resolved", "save", "prune", "get", "stats"]